@@ -0,0 +1,393 @@
+"""A headless geximon agent and the client side of its protocol.
+
+The agent runs on the mail server and streams log lines, queue changes and
+the process list to geximon over a single connection: the stdio of an ssh
+session, or a local unix socket.  Each frame is a one character kind, the
+payload length as a 32-bit big-endian integer and a JSON payload:
+
+    'H'  the protocol version; always the first frame
+    'L'  a list of new log lines
+    'Q'  a queue delta: [added, removed, changed], where added and changed
+         are lists of packed messages and removed is a list of message ids
+    'P'  the process list: [[[pid, info], ...], status]
+
+All strings are sent as latin-1 so that arbitrary bytes survive the trip.
+"""
+
+import os
+import sys
+import time
+import select
+import socket
+import struct
+import threading
+import subprocess
+import optparse
+import json
+
+from exim import LogWatcher, QueueManager, ProcessManager, Message
+from exim import ssh_connections
+
+__metaclass__ = type
+
+HEADER = struct.Struct('!cI')
+VERSION = 1
+MAX_FRAME = 64 * 1024 * 1024
+
+
+def pack_message(msg):
+    """Convert a Message to a list for sending.
+
+    >>> msg = Message(' 5m   300 1AttSl-0002qC-00 <joe@x.org>')
+    >>> msg.set_recipients(['D ann@x.org', 'bob@x.org'])
+    >>> unpack_message(json.loads(json.dumps(pack_message(msg)))) == msg
+    True
+    """
+    return [getattr(msg, name) for name in Message.__slots__]
+
+
+def unpack_message(data):
+    """Convert a list received from the agent back to a Message."""
+    msg = Message()
+    for name, value in zip(Message.__slots__, data):
+        if isinstance(value, unicode):
+            value = value.encode('latin-1')
+        elif isinstance(value, list):
+            value = tuple([v.encode('latin-1') for v in value])
+        setattr(msg, name, value)
+    return msg
+
+
+def write_frame(output, kind, payload):
+    """Write a frame to a file object."""
+    data = json.dumps(payload, encoding='latin-1', separators=(',', ':'))
+    output.write(HEADER.pack(kind, len(data)) + data)
+    output.flush()
+
+
+def read_frame(input):
+    """Read a frame from a file object.
+
+    Returns a tuple (kind, payload), or None at the end of the stream.
+    """
+    header = input.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    kind, length = HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError("frame too long")
+    data = input.read(length)
+    if len(data) < length:
+        return None
+    return kind, json.loads(data)
+
+
+class Agent:
+    """Stream exim data to a geximon client.
+
+    The agent uses the usual LogWatcher, QueueManager and ProcessManager on
+    the local host and forwards what they produce.
+    """
+
+    def __init__(self, log_dir, mainlog_name, bin_dir, exim_binary,
+                 spool_dir=None, log_interval=200, queue_interval=2000,
+                 process_interval=5000):
+        self.intervals = (log_interval, queue_interval, process_interval)
+        self._output = None
+        self._lock = threading.Lock()
+        self.logwatcher = LogWatcher(log_dir, mainlog_name, bin_dir,
+                                     False, False, '')
+        self.queue_mgr = QueueManager(self.sendQueue, bin_dir, exim_binary,
+                                      False, False, '', spool_dir)
+        self.process_mgr = ProcessManager(self.sendProcesses, bin_dir,
+                                          False, False, '')
+
+    def serve(self, output):
+        """Stream data to `output` until the client goes away."""
+        self._output = output
+        self.queue_mgr.messages = {} # the client needs the whole queue
+        self._send('H', VERSION)
+        log_interval, queue_interval, process_interval = self.intervals
+        next_queue = next_processes = 0
+        reader = self.logwatcher.reader()
+        try:
+            while self._output is not None:
+                now = time.time() * 1000
+                if now >= next_queue:
+                    self.queue_mgr.schedule_update()
+                    next_queue = now + queue_interval
+                if now >= next_processes:
+                    self.process_mgr.schedule_update()
+                    next_processes = now + process_interval
+                self.logwatcher.update()
+                lines = [record.line for record in reader.read()]
+                if reader.dropped:
+                    lines.insert(0, _("(%d lines dropped)")
+                                    % reader.dropped)
+                if lines:
+                    self._send('L', lines)
+                self._wait(min(next_queue, next_processes) - now,
+                           log_interval)
+        finally:
+            self._output = None
+
+    def _wait(self, timeout, poll_interval):
+        """Sleep for `timeout` ms or until the log changes.
+
+        If the log cannot be watched, it is polled every `poll_interval` ms;
+        otherwise updates are still at least `poll_interval` ms apart.
+        """
+        fd = self.logwatcher.fileno()
+        if fd is None or self.logwatcher.pending():
+            time.sleep(min(timeout, poll_interval) / 1000.0)
+        elif select.select([fd], [], [], max(timeout, 0) / 1000.0)[0]:
+            # let the lines that follow accumulate into one frame
+            time.sleep(poll_interval / 1000.0)
+
+    def stop(self):
+        self.queue_mgr.stop()
+        self.process_mgr.stop()
+
+    def sendQueue(self, delta):
+        """Forward a queue delta (called by the queue manager)."""
+        if delta:
+            self._send('Q', [[pack_message(m) for m in delta.added],
+                             delta.removed,
+                             [pack_message(m) for m in delta.changed]])
+
+    def sendProcesses(self, processes, status):
+        """Forward the process list (called by the process manager)."""
+        self._send('P', [processes.items(), status])
+
+    def _send(self, kind, payload):
+        self._lock.acquire()
+        try:
+            if self._output is None:
+                return
+            try:
+                write_frame(self._output, kind, payload)
+            except (IOError, socket.error):
+                self._output = None # the client has gone away
+        finally:
+            self._lock.release()
+
+
+class AgentConnection:
+    """A connection to a geximon agent.
+
+    A background thread reads frames from the agent and keeps the latest
+    state; LogWatcher, QueueManager and ProcessManager take their data from
+    here instead of running commands when a connection is attached to them.
+    """
+
+    RESTART_DELAY = 10 # seconds to wait before reconnecting
+
+    def __init__(self, agent_command='geximon-agent', args='',
+                 use_sudo=False, hostname='', socket_path=None):
+        self.agent_command = agent_command
+        self.args = args
+        self.use_sudo = use_sudo
+        self.hostname = hostname
+        self.socket_path = socket_path
+        self._lock = threading.Lock()
+        self._input = None
+        self._process = None # the ssh session, or
+        self._socket = None # the connection to the agent's socket
+        self._started = 0
+        self.error = None
+        self._start()
+
+    def _start(self):
+        """Start the agent (or connect to its socket)."""
+        self._lock.acquire()
+        try:
+            self._started = time.time()
+            self._log_lines = []
+            self._queue = {}
+            self._processes = ({}, _("Waiting for the geximon agent..."))
+        finally:
+            self._lock.release()
+        process = sock = None
+        try:
+            if self.socket_path:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.socket_path)
+                input = sock.makefile('rb')
+            else:
+                # stderr is left alone, it must not get into the stream;
+                # exec, so that terminating the process ends the session
+                cmd = ('exec ' + ssh_connections.command(self.hostname) +
+                       (self.use_sudo and 'sudo ' or '') +
+                       self.agent_command + ' ' + self.args)
+                process = subprocess.Popen(cmd, shell=True,
+                                           stdout=subprocess.PIPE,
+                                           close_fds=True)
+                input = process.stdout
+        except (IOError, OSError, socket.error), e:
+            self._input = None
+            self.error = _("Could not connect to the geximon agent: %s") % e
+            return
+        self._process, self._socket = process, sock
+        self._input = input
+        self.error = None
+        thread = threading.Thread(target=self._read,
+                                  args=(input, process))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _read(self, input, process):
+        """Read frames until the connection is closed.
+
+        The input is only ever closed here: closing a file that another
+        thread is reading from fails, so close() ends the connection at the
+        other side instead.
+        """
+        handlers = {'L': self._logLines, 'Q': self._queueDelta,
+                    'P': self._processList}
+        try:
+            try:
+                frame = read_frame(input)
+            except (ValueError, struct.error):
+                frame = None
+            if frame != ('H', VERSION):
+                return # not talking to a compatible agent
+            while True:
+                try:
+                    frame = read_frame(input)
+                except (ValueError, struct.error):
+                    frame = None
+                if frame is None:
+                    break
+                kind, payload = frame
+                handler = handlers.get(kind)
+                if handler is not None:
+                    self._lock.acquire()
+                    try:
+                        handler(payload)
+                    finally:
+                        self._lock.release()
+        finally:
+            input.close()
+            if process is not None:
+                process.wait()
+            if self._input is input:
+                self._input = None
+                self.error = _("Lost the connection to the geximon agent.")
+
+    def _logLines(self, lines):
+        self._log_lines += [line.encode('latin-1') for line in lines]
+
+    def _queueDelta(self, (added, removed, changed)):
+        queue = self._queue
+        for id in removed:
+            queue.pop(id.encode('latin-1'), None)
+        for data in added + changed:
+            msg = unpack_message(data)
+            queue[msg.id] = msg
+
+    def _processList(self, (processes, status)):
+        self._processes = (dict([(int(pid), info.encode('latin-1'))
+                                 for pid, info in processes]),
+                           status.encode('latin-1'))
+
+    def check(self):
+        """Reconnect if the connection has been lost a while ago.
+
+        Returns an error message if there is no connection, None otherwise.
+        This is called from several threads; only one of them reconnects.
+        """
+        self._lock.acquire()
+        try:
+            restart = (self._input is None
+                       and time.time() - self._started > self.RESTART_DELAY)
+            if restart:
+                self._started = time.time() # keep the others from restarting
+        finally:
+            self._lock.release()
+        if restart:
+            self._start()
+        return self.error
+
+    def get_log_lines(self):
+        """Get the log lines received since the last call."""
+        self._lock.acquire()
+        try:
+            lines = self._log_lines
+            self._log_lines = []
+            return lines
+        finally:
+            self._lock.release()
+
+    def get_queue(self):
+        """Get a snapshot of the queue: a mapping from IDs to messages."""
+        self._lock.acquire()
+        try:
+            return dict(self._queue)
+        finally:
+            self._lock.release()
+
+    def get_processes(self):
+        """Get the latest process list and status string."""
+        return self._processes
+
+    def close(self):
+        """End the connection; the reading thread then closes the input."""
+        self._input = None
+        process, self._process = self._process, None
+        sock, self._socket = self._socket, None
+        if process is not None:
+            try:
+                process.terminate()
+            except OSError:
+                pass # it has exited already
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+
+def main():
+    import gettext
+    gettext.install('geximon')
+
+    parser = optparse.OptionParser(usage="%prog [options]",
+            description="Stream exim log, queue and process data to geximon.")
+    parser.add_option('--log-dir', default='/var/log/exim')
+    parser.add_option('--mainlog', default='mainlog')
+    parser.add_option('--bin-dir', default='/usr/sbin')
+    parser.add_option('--exim-binary', default='exim')
+    parser.add_option('--spool-dir', default=None,
+            help="read the queue from this spool directory")
+    parser.add_option('--socket', default=None,
+            help="serve clients on this unix socket instead of stdout")
+    parser.add_option('--queue-interval', type='int', default=2000)
+    parser.add_option('--process-interval', type='int', default=5000)
+    options, args = parser.parse_args()
+
+    agent = Agent(options.log_dir, options.mainlog, options.bin_dir,
+                  options.exim_binary, options.spool_dir,
+                  queue_interval=options.queue_interval,
+                  process_interval=options.process_interval)
+    try:
+        if options.socket:
+            if os.path.exists(options.socket):
+                os.unlink(options.socket)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(options.socket)
+            server.listen(1)
+            while True:
+                client, address = server.accept()
+                output = client.makefile('wb')
+                client.close()
+                agent.serve(output)
+                output.close()
+        else:
+            agent.serve(sys.stdout)
+    finally:
+        agent.stop()
+
+
+if __name__ == '__main__':
+    main()
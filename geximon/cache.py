@@ -0,0 +1,80 @@
+"""A size-limited cache of message details."""
+
+import threading
+
+__metaclass__ = type
+
+
+class LRUCache:
+    """Strings kept up to a total size, least recently used dropped first.
+
+    Lookups and insertions may come from several threads.
+
+    >>> cache = LRUCache(10)
+    >>> cache.put('a', 'xxxx'); cache.put('b', 'yyyy')
+    >>> cache.get('a')
+    'xxxx'
+    >>> cache.put('c', 'zzzz') # 'b' has been used least recently
+    >>> cache.get('b'), cache.get('c'), cache.size
+    (None, 'zzzz', 8)
+    >>> cache.put('d', 'x' * 11) # too large to keep
+    >>> cache.get('d'), len(cache)
+    (None, 2)
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._items = {} # key -> [last use, value]
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Return the value for key, or None."""
+        self._lock.acquire()
+        try:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._clock += 1
+            item[0] = self._clock
+            return item[1]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        """Store a value, dropping old ones to make room for it."""
+        if len(value) > self.max_size:
+            return
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            if self.size + len(value) > self.max_size:
+                # evict in one go rather than scanning for every item
+                items = [(use, old_key) for old_key, (use, old_value)
+                         in self._items.iteritems()]
+                items.sort()
+                for use, old_key in items:
+                    self._remove(old_key)
+                    if self.size + len(value) <= self.max_size:
+                        break
+            self._clock += 1
+            self._items[key] = [self._clock, value]
+            self.size += len(value)
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        self._lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self._lock.release()
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= len(item[1])
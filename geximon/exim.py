@@ -1,7 +1,19 @@
 """Interfacing with exim processes."""
 
-import os, fcntl, select
+import os, errno
+import re
+import sys
+import shutil
+import tempfile
 import threading
+import time
+import Queue
+from fnmatch import fnmatchcase
+
+from spool import SpoolReader, SpoolEditor, format_age, format_size
+from logfollow import LogFollower, PipeFollower, READ_SIZE
+from logsearch import LogSearch, log_files
+from cache import LRUCache
 
 __metaclass__ = type
 
@@ -16,7 +28,7 @@ def get_output(path='', filename='', args='', use_sudo=False, use_ssh=False, hos
 
 def get_pipe(path='', filename='', args='', use_sudo=False, use_ssh=False, hostname=''):
     """Run a command and return its handle."""
-    cmd = (use_ssh and 'ssh %s '%hostname or '') + \
+    cmd = (use_ssh and ssh_connections.command(hostname) or '') + \
           (use_sudo and 'sudo ' or '') + \
           os.path.join(path, filename)
     if args:
@@ -25,74 +37,686 @@ def get_pipe(path='', filename='', args='', use_sudo=False, use_ssh=False, hostn
     stdin.close()
     return stdouterr
 
+def split_hosts(hostname):
+    """Split a hostname setting into a list of hosts.
+
+    Several hosts can be given, separated by spaces or commas.
+
+    >>> split_hosts('relay1, relay2 relay3'), split_hosts('')
+    (['relay1', 'relay2', 'relay3'], [''])
+    """
+    return hostname.replace(',', ' ').split() or ['']
+
+
+def host_list(use_ssh, hostname):
+    """Return the list of hosts to work with ('' for the local host)."""
+    if not use_ssh:
+        return ['']
+    return split_hosts(hostname)
+
+
+class Job:
+    """A function call submitted to a WorkerPool."""
+
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._result = self._func(*self._args)
+        except:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def wait(self):
+        """Wait for the call to finish; return its result or raise its
+        error."""
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class WorkerPool:
+    """A bounded pool of worker threads.
+
+    Threads are started as jobs are submitted, up to `size` of them, and then
+    stay around waiting for more work.  If `size` is lowered, the threads
+    beyond it exit as they pick up their next job, leaving it to the others.
+    Jobs must not wait for other jobs submitted to the same pool.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._jobs = Queue.Queue()
+        self._threads = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """Call func(*args) in a worker thread; return a Job."""
+        job = Job(func, args)
+        self._lock.acquire()
+        try:
+            if self._threads < self.size:
+                self._threads += 1
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            self._lock.release()
+        self._jobs.put(job)
+        return job
+
+    def map(self, func, items):
+        """Call func on every item in parallel; return the list of results."""
+        jobs = [self.submit(func, item) for item in items]
+        return [job.wait() for job in jobs]
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            self._lock.acquire()
+            try:
+                surplus = self._threads > self.size
+                if surplus:
+                    self._threads -= 1
+            finally:
+                self._lock.release()
+            if surplus:
+                self._jobs.put(job)
+                return
+            job.run()
+
+# used to talk to several hosts at once
+host_pool = WorkerPool(4)
+
+# runs queue actions requested in the GUI, so that it does not wait for them;
+# actions may use host_pool, but not this pool
+action_pool = WorkerPool(4)
+
+# bytes of message ids to pass to one exim process; well below ARG_MAX and
+# the limit on the single argument that a command run over ssh becomes
+MAX_ID_BYTES = 32 * 1024
+
+
+def id_chunks(ids, limit=MAX_ID_BYTES):
+    """Split a list of message ids into chunks that fit on a command line.
+
+    >>> ids = ['1AttSk-0002q%d-00' % i for i in range(5)]
+    >>> [len(chunk) for chunk in id_chunks(ids, 40)]
+    [2, 2, 1]
+    >>> id_chunks([])
+    []
+    """
+    chunks = []
+    chunk = []
+    size = 0
+    for id in ids:
+        if chunk and size + len(id) + 1 > limit:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append(id)
+        size += len(id) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+
+class SSHMultiplexer:
+    """Share one ssh connection per remote host between all commands.
+
+    This uses OpenSSH connection multiplexing: a master connection is started
+    in the background the first time a host is used, and later commands talk
+    to it through a control socket instead of doing a new handshake.  If the
+    master goes away, it is restarted on the next command; if it cannot be
+    started, ssh simply makes a connection of its own, and starting it is
+    not tried again for a while (longer after every failure).  Commands to
+    different hosts do not wait for each other.
+    """
+
+    PERSIST = 600 # seconds an idle master connection is kept for
+    RETRY = 30 # seconds until a failed master is first tried again
+
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock() # guards the tables below
+        self._socket_dir = None
+        self._hosts = {} # hostname -> control socket path
+        self._host_locks = {} # hostname -> lock held while starting
+        self._failed = {} # hostname -> (time of next try, delay)
+        self._sockets = 0
+
+    def command(self, hostname):
+        """Return the command prefix to run a command on `hostname`."""
+        if not self.enabled:
+            return 'ssh %s ' % hostname
+        self._lock.acquire()
+        try:
+            host_lock = self._host_locks.setdefault(hostname,
+                                                    threading.Lock())
+        finally:
+            self._lock.release()
+        host_lock.acquire()
+        try:
+            path = self._hosts.get(hostname)
+            if path is None or not os.path.exists(path):
+                next_try, delay = self._failed.get(hostname, (0, 0))
+                if time.time() < next_try:
+                    return 'ssh %s ' % hostname
+                path = self._newSocket(hostname)
+                if self._startMaster(hostname, path):
+                    self._failed.pop(hostname, None)
+                else:
+                    delay = min(max(delay * 2, self.RETRY), self.PERSIST)
+                    self._failed[hostname] = (time.time() + delay, delay)
+                    return 'ssh %s ' % hostname
+        finally:
+            host_lock.release()
+        return 'ssh -o ControlPath=%s %s ' % (path, hostname)
+
+    def _newSocket(self, hostname):
+        """Return the path for a new control socket to `hostname`."""
+        self._lock.acquire()
+        try:
+            if self._socket_dir is None:
+                self._socket_dir = tempfile.mkdtemp(prefix='geximon-ssh-')
+            self._sockets += 1
+            path = os.path.join(self._socket_dir, str(self._sockets))
+            self._hosts[hostname] = path
+            return path
+        finally:
+            self._lock.release()
+
+    def _startMaster(self, hostname, path):
+        """Start a master connection to `hostname` in the background.
+
+        Returns True if its control socket at `path` is there.
+        """
+        # -f only returns once the connection has been authenticated
+        os.system('ssh -f -N -o ControlMaster=yes -o ControlPath=%s'
+                  ' -o ControlPersist=%d %s </dev/null >/dev/null 2>&1'
+                  % (path, self.PERSIST, hostname))
+        return os.path.exists(path)
+
+    def close(self):
+        """Shut down all master connections."""
+        self._lock.acquire()
+        try:
+            for hostname, path in self._hosts.items():
+                if os.path.exists(path):
+                    os.system('ssh -o ControlPath=%s -O exit %s'
+                              ' </dev/null >/dev/null 2>&1' % (path, hostname))
+            self._hosts = {}
+            if self._socket_dir is not None:
+                shutil.rmtree(self._socket_dir, True)
+                self._socket_dir = None
+        finally:
+            self._lock.release()
+
+ssh_connections = SSHMultiplexer()
+
+
+LOG_FLAGS = frozenset(['<=', '=>', '->', '>>', '*>', '**', '=='])
+LOG_FIELDS = {'T=': 'transport', 'R=': 'router', 'H=': 'host'}
+
+
+class LogRecord:
+    """A main log line, split into the fields geximon cares about.
+
+    Lines are parsed once, when they are read; all consumers share the
+    records.  Fields that are absent from the line are empty (0 for size).
+
+    >>> r = LogRecord('2004-12-03 12:34:56 1AttSk-0002qB-00 => joe@x.org '
+    ...               'R=dnslookup T=remote_smtp H=mx.x.org [10.0.0.1]')
+    >>> r.date, r.time, r.id, r.flag
+    ('2004-12-03', '12:34:56', '1AttSk-0002qB-00', '=>')
+    >>> r.router, r.transport, r.host, r.size
+    ('dnslookup', 'remote_smtp', 'mx.x.org', 0)
+    >>> r = LogRecord('2004-12-03 12:34:56.789 +0100 [4321] 1AttSk-0002qB-00 '
+    ...               '<= <> H=(helo) [10.0.0.2] P=esmtp S=1234')
+    >>> r.time, r.id, r.flag, r.host, r.size
+    ('12:34:56.789', '1AttSk-0002qB-00', '<=', '(helo)', 1234)
+    >>> r = LogRecord('2004-12-03 12:34:56 Start queue run: pid=4321')
+    >>> r.id, r.flag, r.text
+    ('', '', '12:34:56 Start queue run: pid=4321')
+    """
+
+    __slots__ = ('line', 'date', 'time', 'id', 'flag', 'transport',
+                 'router', 'host', 'size')
+
+    def __init__(self, line):
+        self.line = line
+        self.date = self.time = self.id = self.flag = ''
+        self.transport = self.router = self.host = ''
+        self.size = 0
+
+        words = line.split(' ')
+        i = 0
+        count = len(words)
+        word = words[0]
+        if len(word) == 10 and word[4] == '-' and word[7] == '-':
+            self.date = word
+            i = 1
+            if i < count:
+                word = words[i]
+                if len(word) >= 8 and word[2] == ':' and word[5] == ':':
+                    self.time = word
+                    i += 1
+        # optional timezone and process id
+        if i < count and words[i][:1] in ('+', '-') and len(words[i]) == 5:
+            i += 1
+        if i < count and words[i][:1] == '[' and words[i][-1:] == ']':
+            i += 1
+        if i < count:
+            word = words[i]
+            if len(word) == 16 and word[6] == '-' and word[13] == '-':
+                self.id = word
+                i += 1
+        if i < count and words[i] in LOG_FLAGS:
+            self.flag = words[i]
+            for word in words[i+2:]:
+                name = LOG_FIELDS.get(word[:2])
+                if name is not None:
+                    if not getattr(self, name):
+                        setattr(self, name, word[2:])
+                elif word[:2] == 'S=' and not self.size:
+                    try:
+                        self.size = int(word[2:])
+                    except ValueError:
+                        pass
+
+    def text(self):
+        """The line without the date."""
+        if self.date:
+            return self.line[len(self.date)+1:]
+        return self.line
+    text = property(text)
+
+    def address(self):
+        """Return the address after the flag ('' if there is none).
+
+        >>> LogRecord('2004-12-03 12:34:56 1AttSk-0002qB-00 <= <> P=local'
+        ...           ).address()
+        '<>'
+        >>> LogRecord('2004-12-03 12:34:56 1AttSk-0002qB-00 <=').address()
+        ''
+        """
+        if not self.flag:
+            return ''
+        words = self.text.split(' ')
+        i = words.index(self.flag) + 1
+        return i < len(words) and words[i] or ''
+
+    def timestamp(self):
+        """Return the time of the line in seconds since the epoch, or None.
+
+        >>> r = LogRecord('2004-12-03 12:34:56 Start queue run: pid=4321')
+        >>> r.timestamp() == time.mktime((2004, 12, 3, 12, 34, 56, 0, 0, -1))
+        True
+        """
+        if not self.time:
+            return None
+        key = self.date + self.time[:8]
+        cached = LogRecord._last_time # lines come in bursts of a second
+        if cached[0] == key:
+            return cached[1]
+        try:
+            value = time.mktime(time.strptime(key, '%Y-%m-%d%H:%M:%S'))
+        except ValueError:
+            return None
+        LogRecord._last_time = (key, value)
+        return value
+
+LogRecord._last_time = (None, None)
+
+
+def read_log_tail(path, since, until=None):
+    """Return LogRecords for the lines of a log written in a time range.
+
+    The log is read backwards from the end, in large blocks, until a line
+    older than `since` is found; lines from `until` on are left out, and so
+    is an incomplete last line.  Raises IOError if the log cannot be read.
+    """
+    f = open(path, 'rb')
+    try:
+        f.seek(0, 2)
+        pos = f.tell()
+        blocks = []
+        rest = ''
+        while pos > 0:
+            size = min(READ_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size) + rest
+            if pos > 0:
+                # the first line of the block may have started earlier
+                start = data.find('\n') + 1
+                if not start:
+                    rest = data
+                    continue
+                rest, data = data[:start], data[start:]
+            blocks.append(data)
+            first = LogRecord(data[:data.find('\n')]).timestamp()
+            if first is not None and first < since:
+                break
+    finally:
+        f.close()
+    blocks.reverse()
+    lines = ''.join(blocks).split('\n')
+    lines.pop() # empty, or an incomplete line
+
+    records = []
+    for line in lines:
+        record = LogRecord(line)
+        timestamp = record.timestamp()
+        if (timestamp is not None and timestamp >= since
+                and (until is None or timestamp < until)):
+            records.append(record)
+    return records
+
+
+DEFAULT_PLOT_SERIES = ('in: <= : yellow, out: => : red, '
+                       'local: => R=local* : blue, smtp: => T=*smtp* : green, '
+                       'queue: queue : white')
+
+
+def parse_plot_series(spec):
+    """Parse a plot series specification.
+
+    The specification is a list of series separated by commas; each
+    series is "label: condition: color".  The condition is a log flag (or
+    `*` for any line) followed by tests of the T=, R= and H= fields against
+    shell-style patterns; all of them must match.  The condition `queue`
+    plots the length of the queue instead.
+
+    Returns a list of (label, condition, color) tuples, where condition is
+    None for the queue and a (flag, tests) tuple otherwise.  Raises
+    ValueError if the specification is invalid.
+
+    >>> parse_plot_series('in: <= : yellow, queue: queue: white')
+    [('in', ('<=', ()), 'yellow'), ('queue', None, 'white')]
+    >>> parse_plot_series('local: => R=local* T=*: blue')
+    [('local', ('=>', (('router', 'local*'), ('transport', '*'))), 'blue')]
+    """
+    series = []
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        try:
+            label, condition, color = [part.strip()
+                                       for part in item.split(':')]
+        except ValueError:
+            raise ValueError("invalid plot series: %r" % item.strip())
+        words = condition.split()
+        if words == ['queue']:
+            series.append((label, None, color))
+            continue
+        if not words or (words[0] != '*' and words[0] not in LOG_FLAGS):
+            raise ValueError("invalid log flag in plot series %r" % label)
+        tests = []
+        for word in words[1:]:
+            field = LOG_FIELDS.get(word[:2])
+            if field is None:
+                raise ValueError("invalid test %r in plot series %r"
+                                 % (word, label))
+            tests.append((field, word[2:]))
+        series.append((label, (words[0], tuple(tests)), color))
+    return series
+
+
+class LogClassifier:
+    """Assign log records to plot series in a single pass.
+
+    `conditions` is a list of conditions as returned by parse_plot_series
+    (None entries are skipped).  Records are looked up by their flag and
+    fields; the result is cached for each combination of these, so the cost
+    per record hardly depends on the number of series.
+
+    >>> c = LogClassifier([('<=', ()), ('=>', ()), None,
+    ...                    ('=>', (('router', 'local*'),))])
+    >>> c.count([LogRecord('1AttSk-0002qB-00 => joe R=localuser'),
+    ...          LogRecord('1AttSk-0002qB-00 => ann R=dnslookup')])
+    [0, 2, 0, 1]
+    """
+
+    CACHE_SIZE = 10000
+
+    def __init__(self, conditions):
+        self.size = len(conditions)
+        self._by_flag = {} # flag -> [(series index, tests)]
+        for index, condition in enumerate(conditions):
+            if condition is not None:
+                flag, tests = condition
+                self._by_flag.setdefault(flag, []).append((index, tests))
+        self._any = self._by_flag.pop('*', [])
+        self._cache = {}
+
+    def classify(self, record):
+        """Return the indices of the series a record belongs to."""
+        key = (record.flag, record.transport, record.router, record.host)
+        indices = self._cache.get(key)
+        if indices is None:
+            indices = []
+            for index, tests in self._by_flag.get(record.flag, []) + self._any:
+                for field, pattern in tests:
+                    if not fnmatchcase(getattr(record, field), pattern):
+                        break
+                else:
+                    indices.append(index)
+            indices.sort()
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.clear()
+            self._cache[key] = indices
+        return indices
+
+    def count(self, records):
+        """Return the number of records in each series."""
+        counts = [0] * self.size
+        classify = self.classify
+        for record in records:
+            for index in classify(record):
+                counts[index] += 1
+        return counts
+
+
+class LogBuffer:
+    """A bounded buffer of log lines, shared by several readers.
+
+    The buffer keeps the last `size` lines (LogRecords, as LogWatcher uses
+    it).  Every consumer reads through its own LogReader, so a slow or idle
+    consumer does not hold on to memory; it misses the lines that were
+    overwritten instead, and is told how many.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lines = [None] * size
+        self.count = 0 # lines ever appended
+
+    def extend(self, lines):
+        """Append lines, overwriting the oldest ones."""
+        if len(lines) > self.size:
+            self.count += len(lines) - self.size
+            lines = lines[-self.size:]
+        start = self.count % self.size
+        end = start + len(lines)
+        if end <= self.size:
+            self._lines[start:end] = lines
+        else:
+            split = self.size - start
+            self._lines[start:] = lines[:split]
+            self._lines[:end - self.size] = lines[split:]
+        self.count += len(lines)
+
+    def oldest(self):
+        """Return the number of the oldest line still in the buffer."""
+        return max(0, self.count - self.size)
+
+    def get(self, start):
+        """Return the lines from line number `start` on."""
+        start = max(start, self.oldest())
+        first = start % self.size
+        last = first + (self.count - start)
+        if last <= self.size:
+            return self._lines[first:last]
+        return self._lines[first:] + self._lines[:last - self.size]
+
+    def reader(self):
+        """Return a reader that starts at the oldest line in the buffer."""
+        return LogReader(self)
+
+
+class LogReader:
+    """A consumer's position in a LogBuffer.
+
+    >>> buffer = LogBuffer(3)
+    >>> reader = buffer.reader()
+    >>> buffer.extend(['a', 'b'])
+    >>> reader.read(), reader.dropped
+    (['a', 'b'], 0)
+    >>> buffer.extend(['c', 'd', 'e', 'f'])
+    >>> reader.read(), reader.dropped
+    (['d', 'e', 'f'], 1)
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.position = buffer.oldest()
+        self.dropped = 0
+
+    def read(self):
+        """Return the lines added since the last call.
+
+        `dropped` is set to the number of lines that were overwritten
+        before they could be read.
+        """
+        buffer = self.buffer
+        self.dropped = max(0, buffer.oldest() - self.position)
+        lines = buffer.get(self.position)
+        self.position = buffer.count
+        return lines
+
+
 class LogWatcher:
-    """Watch exim logs."""
+    """Watch exim logs.
 
-    def __init__(self, log_dir, mainlog_name, bin_dir, sudo, ssh, hostname, line_limit=500):
+    New lines are parsed into LogRecords and kept in a LogBuffer; consumers
+    get their own cursor into it with reader().
+    """
+
+    BUFFER_SIZE = 20000 # lines to keep for consumers that lag behind
+
+    def __init__(self, log_dir, mainlog_name, bin_dir, sudo, ssh, hostname, line_limit=500,
+                 index_path=None, stats_path=None):
         self.line_limit = line_limit
-        self.for_processing = []
+        self.lines = LogBuffer(self.BUFFER_SIZE)
         self._valid = True
         self.bin_dir = bin_dir
         self.use_sudo = sudo
         self.use_ssh = ssh
         self.hostname = hostname
+        self.agent = None
+        self.followers = []
+        self.index_path = index_path
+        self._index = None
+        self.stats_path = stats_path
+        self._stats = None
         self.open(log_dir, mainlog_name)
 
     def open(self, log_dir, mainlog_name):
+        """Start following the main log (on every host, if several).
+
+        A local log is read directly; remote logs (and local ones that can
+        only be read with sudo) are followed with `tail -F`.
+        """
         self.log_dir = log_dir
         self.mainlog_name = mainlog_name
         mainlog_path = os.path.join(log_dir, mainlog_name)
+        self.close()
+        if self.agent is not None:
+            # the agent sends the log lines, no need to tail the log
+            return
         try:
-    #        self.mainlog = open(mainlog_path)
-    #        self.mainlog_inode = os.fstat(self.mainlog.fileno()).st_ino
-    #        self._valid = True
-            self.mainlog = get_pipe('/usr/bin','tail','-F %s'%mainlog_path,self.use_sudo, self.use_ssh, self.hostname)
-            self.mainlog_fd = self.mainlog.fileno()
-            fl = fcntl.fcntl(self.mainlog_fd, fcntl.F_GETFL)
-            fcntl.fcntl(self.mainlog_fd, fcntl.F_SETFL, fl|os.O_NONBLOCK)
+            for host in host_list(self.use_ssh, self.hostname):
+                self.followers.append(self._follow(mainlog_path, host))
             self._valid = True
-        except IOError:
+        except (IOError, OSError):
             if self._valid:
                 # XXX should show a popup
-                self.unseen = \
-                    [_("Error: could not open the exim log file at `%s`!")
-                                                              % mainlog_path]
+                self.lines.extend([LogRecord(
+                    _("Error: could not open the exim log file at `%s`!")
+                                                            % mainlog_path)])
                 self._valid = False
-            self.mainlog = None
-        else:
-    #        self.unseen = self.mainlog.readlines()[-self.line_limit:]
-    #        self.unseen = [s[:-1] for s in self.unseen]
-            self.unseen = []
+            self.close()
+
+    def _follow(self, mainlog_path, host):
+        """Return a follower for the main log on `host` ('' is local)."""
+        if not host:
+            try:
+                return LogFollower(mainlog_path)
+            except (IOError, OSError), e:
+                if not (self.use_sudo and e.errno == errno.EACCES):
+                    raise
+        mainlog = get_pipe('/usr/bin', 'tail', '-F %s' % mainlog_path,
+                           self.use_sudo, self.use_ssh, host)
+        return PipeFollower(mainlog)
+
+    def fileno(self):
+        """Return a descriptor that becomes readable when there is news.
+
+        Returns None if update() has to be polled instead.
+        """
+        if self.agent is None and len(self.followers) == 1:
+            return self.followers[0].fileno()
+        return None
+
+    def pending(self):
+        """Tell whether there was more data than one update() takes."""
+        for follower in self.followers:
+            if follower.pending():
+                return True
+        return False
 
     def update(self):
-        """Read the log file for new entries."""
-        mainlog_path = os.path.join(self.log_dir, self.mainlog_name)
-        if self.mainlog:
+        """Read the log file for new entries.
+
+        Only complete lines are taken, and at most about a megabyte per
+        log; the rest is left for the next call (see pending()).
+        """
+        if self.agent is not None:
+            new_entries = self.agent.get_log_lines()
+        elif self.followers:
             new_entries = []
-            if (select.select([self.mainlog_fd],[],[],0))[0]:
-                buffer = os.read(self.mainlog_fd, 2000)
-                for line in buffer.split("\n"):
-                    if line:
-                        new_entries.append(line)
+            for follower in self.followers:
+                new_entries += [line for line in follower.readlines() if line]
         else:
             new_entries = []
             self.open(self.log_dir, self.mainlog_name)
             return
 
-        self.unseen += new_entries
-        self.for_processing += new_entries
+        self.lines.extend(map(LogRecord, new_entries))
+
+    def close(self):
+        """Stop following the main log."""
+        for follower in self.followers:
+            follower.close()
+        self.followers = []
 
-    def get_unseen(self):
-        """Get unseen entries."""
-        unseen = self.unseen
-        self.unseen = []
-        return unseen
+    def setAgent(self, agent):
+        """Take log lines from an AgentConnection (or None) from now on."""
+        self.agent = agent
+        self._valid = True
+        self.open(self.log_dir, self.mainlog_name)
 
-    def get_for_processing(self):
-        """Get list of lines that have not been processed yet."""
-        for_processing = self.for_processing
-        self.for_processing = []
-        return for_processing
+    def reader(self):
+        """Return a LogReader for a new consumer of log records."""
+        return self.lines.reader()
 
     def runExigrep(self, pattern, literal, all_logs):
         """Run exigrep with the provided pattern.
@@ -104,8 +728,64 @@ class LogWatcher:
         filename = os.path.join(self.log_dir, all_logs and '*'
                                               or self.mainlog_name)
         pattern = "'" + pattern + "'"
-        return get_output(self.bin_dir, 'exigrep',
-                (literal and '-l' or '') + pattern + ' ' + filename, self.use_sudo, self.use_ssh, self.hostname)
+        return self._runOnHosts('exigrep',
+                (literal and '-l' or '') + pattern + ' ' + filename)
+
+    def startExigrep(self, pattern, literal, all_logs, found, finished):
+        """Search local logs in parallel, like runExigrep.
+
+        Returns a LogSearch (see logsearch.py), which calls `found` with
+        batches of results from the log files as they come in; the caller
+        may cancel it.  Returns None if the logs are not local, in which case
+        runExigrep has to be used.  Raises ValueError if the pattern is not
+        a valid regular expression.
+        """
+        if self.use_ssh or self.use_sudo and not os.access(
+                os.path.join(self.log_dir, self.mainlog_name), os.R_OK):
+            return None
+        if all_logs:
+            paths = log_files(self.log_dir, self.mainlog_name)
+        else:
+            paths = [os.path.join(self.log_dir, self.mainlog_name)]
+        return LogSearch(paths, pattern, literal, found, finished)
+
+    def searchMessages(self, strings):
+        """Find the log entries of messages by their ids or addresses.
+
+        Local logs are looked up in the log index (see logindex.py), which
+        is brought up to date first; otherwise exigrep searches all logs
+        for the strings.  The output is in the format of exigrep.
+        """
+        index = self._getIndex()
+        if index is None:
+            pattern = '|'.join([re.escape(s) for s in strings])
+            return self.runExigrep(pattern, False, True)
+        index.update()
+        return index.search(strings)
+
+    def updateIndex(self):
+        """Bring the log index up to date in a background thread."""
+        index = self._getIndex()
+        if index is not None:
+            thread = threading.Thread(target=index.update)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _getIndex(self):
+        """Return the LogIndex for the local logs, or None."""
+        if not self.index_path or self.use_ssh:
+            return None
+        if self._index is None:
+            from logindex import LogIndex
+            try:
+                self._index = LogIndex(os.path.expanduser(self.index_path),
+                                       self.log_dir, self.mainlog_name)
+            except (IOError, OSError):
+                self.index_path = None
+                return None
+        self._index.log_dir = self.log_dir
+        self._index.mainlog_name = self.mainlog_name
+        return self._index
 
     def runEximstats(self, args, all_logs):
         """Run eximstats.
@@ -115,7 +795,34 @@ class LogWatcher:
         """
         filename = os.path.join(self.log_dir, all_logs and '*'
                                               or self.mainlog_name)
-        return get_output(self.bin_dir, 'eximstats', args + ' ' + filename, self.use_sudo, self.use_ssh, self.hostname)
+        return self._runOnHosts('eximstats', args + ' ' + filename)
+
+    def canCollectStatistics(self):
+        """Tell whether getStatistics can be used for the logs."""
+        return bool(self.stats_path) and not self.use_ssh and os.access(
+                os.path.join(self.log_dir, self.mainlog_name), os.R_OK)
+
+    def getStatistics(self, all_logs):
+        """Return statistics for the local logs as text.
+
+        Statistics for each log file are kept in a file between runs (see
+        stats.py), so only entries that have not been seen before are read.
+        """
+        if self._stats is None:
+            from stats import StatsStore
+            self._stats = StatsStore(os.path.expanduser(self.stats_path))
+        return self._stats.statistics(self.log_dir, self.mainlog_name,
+                                      all_logs).report()
+
+    def _runOnHosts(self, filename, args):
+        """Run a command on every watched host, return the joined output."""
+        hosts = host_list(self.use_ssh, self.hostname)
+        outputs = host_pool.map(lambda host: get_output(self.bin_dir,
+                    filename, args, self.use_sudo, self.use_ssh, host), hosts)
+        if len(hosts) == 1:
+            return outputs[0]
+        return "\n\n".join(["==== %s ====\n%s" % (host, output)
+                             for host, output in zip(hosts, outputs)])
 
     def getRejectlog(self):
         """Get the contents of the rejectlog."""
@@ -195,18 +902,33 @@ class QueueManager(BackgroundJob):
 
     Queue manager calls exim and parses its output in a background thread to
     get the status of the exim queue.  Once the status is available, the queue
-    manager calls the registered callback.
+    manager compares it with the previous one and passes the differences to
+    the registered callback as a QueueDelta.
     """
 
-    def __init__(self, callback, bin_dir, exim_binary, sudo, ssh, hostname):
+    STREAM_BATCH = 1000 # messages to show first while the queue is listed
+    DETAIL_CACHE_SIZE = 16 * 1024 * 1024 # bytes of message views to keep
+    PREFETCH_LIMIT = 50 # selected messages to fetch the headers of
+
+    def __init__(self, callback, bin_dir, exim_binary, sudo, ssh, hostname,
+                 spool_dir=None, concurrency=4, spool_actions=False,
+                 mainlog_path=None):
         """Initialize and start the background thread.
 
-        callback is a callable that takes one argument -- a mapping from
-        message IDs to message objects.  It will be called from the background
-        thread.
+        callback is a callable that takes one argument -- a QueueDelta
+        describing the changes since the previous update.  It will be called
+        from the background thread.
 
         bin_dir is the path to exim.
         use_sudo indicates if sudo is to be used.
+        spool_dir, if given, is the exim spool directory to read the queue
+        from instead of running `exim -bpr` (only used for local hosts).
+        concurrency is the number of exim processes that an action on many
+        messages may run at once.
+        spool_actions tells whether local messages are frozen, thawed and
+        removed by editing the spool in spool_dir instead of running exim
+        (see SpoolEditor); exim's lines about that are then written to the
+        main log at mainlog_path.
         """
         BackgroundJob.__init__(self)
         self.callback = callback
@@ -215,52 +937,269 @@ class QueueManager(BackgroundJob):
         self.use_sudo = sudo
         self.use_ssh = ssh
         self.hostname = hostname
+        self.spool_dir = spool_dir
+        self.agent = None
         self.queue_length = 0
+        self.messages = {}
+        self._spool_reader = None
+        self._spool_messages = {}
+        # runs exim for the chunks of bulk actions; see setConcurrency
+        self._chunk_pool = WorkerPool(concurrency)
+        self.spool_actions = spool_actions
+        self.mainlog_path = mainlog_path
+        self._details = LRUCache(self.DETAIL_CACHE_SIZE)
+        self._prefetch_pool = WorkerPool(2)
+        self._prefetching = set()
 
     def do_update(self):
         """Get the current exim queue in a separate thread."""
-        data = self.getEximOutput(['-bpr'])
+        if self.agent is not None:
+            error = self.agent.check()
+            if error:
+                self._reportError(error)
+            else:
+                self._publish(self.agent.get_queue())
+            return
+        hosts = host_list(self.use_ssh, self.hostname)
+        if len(hosts) > 1:
+            self._pollHosts(hosts)
+            return
+        if self.spool_dir and not self.use_ssh:
+            self.readSpool()
+            return
 
-        if (data.find('No such file or directory') != -1
+        messages, error = self._listQueue(hosts[0], not self.messages)
+        if error:
+            self._reportError(error)
+        else:
+            self._publish(messages)
+
+    def _listQueue(self, host, streaming=False):
+        """Run `exim -bpr` on `host` and parse its output.
+
+        Returns a tuple (messages, error), where messages is a mapping from
+        message ids to messages and error is a problem description or None.
+        If `streaming` is true, partial queues are published while exim is
+        still listing messages, so that the first ones can be shown early.
+        """
+        pipe = self.getEximPipe(['-bpr'], host)
+        odd_lines = []
+        messages = {}
+        # the batches grow so that copying stays linear overall
+        batch_size = self.STREAM_BATCH
+        try:
+            for message in parse_queue(pipe, odd_lines):
+                messages[message.id] = message
+                if streaming and len(messages) >= batch_size:
+                    self._publish(dict(messages))
+                    batch_size *= 2
+        finally:
+            pipe.close()
+
+        data = "\n".join(odd_lines)
+        if not messages and (data.find('No such file or directory') != -1
                 or data.find(' not found') != -1
                 or data.find('exim: permission denied') != -1):
             # complain in case of problems
-            m = Message()
-            m.frozen, m.time, m.size, m.sender = True, "", "", "",
-            # XXX should show a popup
-            m.id, m.recipients = 'error', \
-                [_("Error invoking `exim -bpr`:\n") + data]
-            self.messages = {'error': m}
-            self.callback(self.messages)
+            return {}, _("Error invoking `exim -bpr`:\n") + data
+        return messages, None
+
+    def _pollHosts(self, hosts):
+        """Get the queues of several hosts in parallel and merge them.
+
+        The messages are tagged with their host and keyed by Message.key.
+        """
+        messages = {}
+        results = host_pool.map(self._listQueue, hosts)
+        for host, (host_messages, error) in zip(hosts, results):
+            if error:
+                host_messages = {'error': ErrorMessage(error)}
+            for message in host_messages.itervalues():
+                message.host = host
+                messages[message.key] = message
+        self._publish(messages)
+
+    def readSpool(self):
+        """Get the current exim queue from the spool directory.
+
+        Only -H files that have changed since the last call are parsed, and
+        Message objects are reused for messages that have not changed.
+        """
+        reader = self._spool_reader
+        if reader is None or reader.spool_dir != self.spool_dir:
+            reader = self._spool_reader = SpoolReader(self.spool_dir)
+            self._spool_messages = {}
+        try:
+            entries = reader.read()
+        except OSError, e:
+            self._reportError(_("Error reading the spool directory `%s`:\n")
+                              % self.spool_dir + str(e))
             return
 
-        data = data.splitlines()
+        now = time.time()
+        old_messages = self._spool_messages
+        spool_messages = {}
         messages = {}
-        recipient_list = False
-        message = None
-        for line in data:
-            if not recipient_list:
-                try:
-                    message = Message(status_line=line)
-                except ValueError:
-                    pass # probably an odd status line, ignore it
-                else:
-                    messages[message.id] = message
-                recipient_list = True
-            elif line:
-                message.add_recipient(line)
+        for entry, size in entries:
+            age = format_age(now - entry.received)
+            cached = old_messages.get(entry.id)
+            if cached is not None and cached[0] is entry and cached[1] == age:
+                message = cached[2]
             else:
-                recipient_list = False
+                message = Message()
+                message.id, message.frozen, message.sender = \
+                        entry.id, entry.frozen, entry.sender
+                message.time, message.size = age, format_size(size)
+                message.age = int(now - entry.received) / 60
+                message.size_bytes = size
+                delivered = dict.fromkeys(entry.delivered)
+                message.recipients = tuple([r for r in entry.recipients
+                                            if r not in delivered])
+                message.delivered = len(entry.recipients) \
+                                    - len(message.recipients)
+            spool_messages[entry.id] = (entry, age, message)
+            messages[entry.id] = message
+        self._spool_messages = spool_messages
+        self._publish(messages)
+
+    def _publish(self, messages):
+        """Compare the new queue with the previous one, notify the callback.
+
+        Messages that have not changed are usually the very same objects as
+        in the previous queue, so they are recognized without comparing them
+        field by field.
+        """
+        old_messages = self.messages
+        added = []
+        changed = []
+        frozen = 0
+        for key, message in messages.iteritems():
+            if message.frozen:
+                frozen += 1
+            old_message = old_messages.get(key)
+            if old_message is None:
+                added.append(message)
+            elif old_message is not message and old_message != message:
+                changed.append(message)
+        if len(old_messages) + len(added) == len(messages):
+            removed = [] # nothing can have left the queue
+        else:
+            removed = [key for key in old_messages if key not in messages]
+        self.messages = messages
         self.queue_length = len(messages)
-        self.callback(messages)
+        self.callback(QueueDelta(messages, added, removed, changed, frozen))
 
-    def getEximOutput(self, args):
+    def _reportError(self, text):
+        """Pass a single pseudo-message describing an error to the callback."""
+        # XXX should show a popup
+        self._publish({'error': ErrorMessage(text)})
+
+    def getEximPipe(self, args, host=None):
+        """Invoke exim with arguments, return a pipe to read the output from.
+
+        args is a list of strings (the parameters to be passed).  host is
+        the host to run exim on; the first configured one by default.
+        """
+        if host is None:
+            host = host_list(self.use_ssh, self.hostname)[0]
+        return get_pipe(self.bin_dir, self.exim_binary,
+                " ".join(args), self.use_sudo, self.use_ssh, host)
+
+    def getEximOutput(self, args, host=None):
         """Invoke exim with arguments, return command output.
 
-        args is a list of strings (the parameters to be passed).
+        args is a list of strings (the parameters to be passed).  host is
+        the host to run exim on; the first configured one by default.
         """
+        if host is None:
+            host = host_list(self.use_ssh, self.hostname)[0]
         return get_output(self.bin_dir, self.exim_binary,
-                " ".join(args), self.use_sudo, self.use_ssh, self.hostname)
+                " ".join(args), self.use_sudo, self.use_ssh, host)
+
+    def _splitKey(self, key):
+        """Split a message key into a message id and a host (or None)."""
+        if '@' in key:
+            return key.split('@', 1)
+        return key, None
+
+    def setConcurrency(self, concurrency):
+        """Change the number of exim processes a bulk action may run.
+
+        Lowering the number takes effect as the running processes finish.
+        """
+        self._chunk_pool.size = concurrency
+
+    def _runForMessages(self, args, keys, check=None, progress=None):
+        """Invoke exim with arguments followed by message ids.
+
+        keys is a list of message keys.  They are grouped by host and split
+        into chunks that fit on a command line (see id_chunks); exim is run
+        once for every chunk, on as many chunks at a time as the concurrency
+        allows.  Returns the joined output or, if `check` is given, the
+        combined results of calling check(output, id_count) for every chunk
+        (see checkOutput).  `progress`, if given, is called with the number
+        of messages done so far and the total after every chunk, from a
+        worker thread.
+        """
+        hosts = []
+        ids = {}
+        for key in keys:
+            id, host = self._splitKey(key)
+            if host not in ids:
+                hosts.append(host)
+                ids[host] = []
+            ids[host].append(id)
+        chunks = []
+        for host in hosts:
+            chunks += [(host, chunk) for chunk in id_chunks(ids[host])]
+
+        done = [0]
+        lock = threading.Lock()
+        def run(item):
+            host, chunk = item
+            output = self._runChunk(args, chunk, host)
+            if check is not None:
+                output = check(output, len(chunk))
+            if progress is not None:
+                lock.acquire()
+                try:
+                    done[0] += len(chunk)
+                    progress(done[0], len(keys))
+                finally:
+                    lock.release()
+            return output
+        jobs = [self._chunk_pool.submit(run, chunk) for chunk in chunks]
+        results = [job.wait() for job in jobs]
+        if check is None:
+            return "\n".join(results)
+        reports = [report for success, report in results if not success]
+        if reports:
+            return (False, "\n".join(reports))
+        return check('', len(keys))
+
+    # exim options that SpoolEditor can carry out itself
+    SPOOL_ACTIONS = {'-Mf': 'freezeMessages', '-Mt': 'thawMessages',
+                     '-Mrm': 'removeMessages'}
+
+    def _runChunk(self, args, ids, host):
+        """Run exim for some messages on a host, return its output.
+
+        Local messages are edited in the spool instead if spool_actions is
+        set and the action allows it; the output is the same.
+        """
+        if (self.spool_actions and self.spool_dir and not host
+                and not self.use_ssh and len(args) == 1
+                and args[0] in self.SPOOL_ACTIONS):
+            editor = SpoolEditor(self.spool_dir, self.mainlog_path)
+            return getattr(editor, self.SPOOL_ACTIONS[args[0]])(ids)
+        return self.getEximOutput(args + ids, host)
+
+    def _checkedAction(self, args, keys, expected, action_name, progress):
+        """Run exim for messages, check its output (see checkOutput)."""
+        return self._runForMessages(args, keys,
+                lambda output, count: self.checkOutput(output, expected,
+                                                       count, action_name),
+                progress)
 
     def checkOutput(self, output, expected, msg_count, action_name):
         """Check if a string has `expected` as a substring on each line.
@@ -282,13 +1221,14 @@ class QueueManager(BackgroundJob):
     def runQueue(self):
         """Run the queue now."""
         # XXX a little dirty, but will do for now
-	cmd = ''
-	if self.use_ssh:
-		cmd = cmd + 'ssh %s ' % self.hostname
-	if self.use_sudo:
-		cmd = cmd + 'sudo '
-	cmd = cmd + os.path.join(self.bin_dir, self.exim_binary) + ' -q &'
-	os.system(cmd)
+        for host in host_list(self.use_ssh, self.hostname):
+            cmd = ''
+            if self.use_ssh:
+                cmd = cmd + ssh_connections.command(host)
+            if self.use_sudo:
+                cmd = cmd + 'sudo '
+            cmd = cmd + os.path.join(self.bin_dir, self.exim_binary) + ' -q &'
+            os.system(cmd)
         return _("Spawning a queue runner in the background.")
 
     def getConfiguration(self):
@@ -296,114 +1236,339 @@ class QueueManager(BackgroundJob):
         return self.getEximOutput(['-bP'])
 
     # -- message actions --
-    # methods must return a tuple: (action_successful, message)
+    # methods must return a tuple: (action_successful, message);
+    # messages are identified by their keys (see Message.key); actions on
+    # several messages report their progress to an optional callback (see
+    # _runForMessages)
 
     def getMessageBody(self, id):
         """Get the body of the message with the given ID."""
-        return (True, self.getEximOutput(['-Mvb', id]))
+        return (True, self._getView('-Mvb', id))
 
     def getMessageHeaders(self, id):
         """Get the headers of the message with the given ID."""
-        return (True, self.getEximOutput(['-Mvh', id]))
+        return (True, self._getView('-Mvh', id))
 
     def getMessageAll(self, id):
         """Get the entire message with the given ID."""
-	return (True, self.getEximOutput(['-Mvc', id]))
-    
+        return (True, self._getView('-Mvc', id))
+
     def getMessageLog(self, id):
         """Get the log of the message with the given ID."""
-        return (True, self.getEximOutput(['-Mvl', id]))
+        return (True, self._getView('-Mvl', id))
+
+    def prefetchHeaders(self, keys):
+        """Fetch the headers of messages into the cache in the background.
+
+        Only the first PREFETCH_LIMIT messages are looked at.
+        """
+        for key in keys[:self.PREFETCH_LIMIT]:
+            message = self.messages.get(key)
+            if message is None or isinstance(message, ErrorMessage):
+                continue
+            if key not in self._prefetching:
+                self._prefetching.add(key)
+                self._prefetch_pool.submit(self._prefetch, key)
+
+    def _prefetch(self, key):
+        try:
+            self._getView('-Mvh', key)
+        finally:
+            self._prefetching.discard(key)
 
-    def removeMessages(self, ids):
+    # the spool file that each view of a message is made from
+    VIEW_FILES = {'-Mvb': ('input', '-D'), '-Mvh': ('input', '-H'),
+                  '-Mvc': ('input', '-H'), '-Mvl': ('msglog', '')}
+
+    def _getView(self, option, key):
+        """Return the output of `exim <option> <id>` for a message.
+
+        Views are kept in an LRU cache as long as the message has not
+        changed; see _viewVersion.
+        """
+        version = self._viewVersion(option, key)
+        cache_key = (option, key, version)
+        text = None
+        if version is not None:
+            text = self._details.get(cache_key)
+        if text is None:
+            id, host = self._splitKey(key)
+            text = self.getEximOutput([option, id], host)
+            if version is not None:
+                self._details.put(cache_key, text)
+        return text
+
+    def _viewVersion(self, option, key):
+        """Return what a view of a message depends on, or None if unknown.
+
+        For local messages this is the identity and modification time of the
+        spool file the view is made from (exim replaces the -H file when it
+        changes it).  Elsewhere it is the state of the message in the queue
+        listing, which does not tell when the message log has grown, so
+        message logs of remote messages are not cached.
+        """
+        id, host = self._splitKey(key)
+        if self.spool_dir and not host and not self.use_ssh:
+            directory, suffix = self.VIEW_FILES[option]
+            for subdir in ('', id[5]): # split_spool_directory
+                try:
+                    st = os.stat(os.path.join(self.spool_dir, directory,
+                                              subdir, id + suffix))
+                except OSError:
+                    continue
+                return (st.st_ino, st.st_mtime, st.st_size)
+            return None # not in the queue (any more)
+        message = self.messages.get(key)
+        if message is None or option == '-Mvl':
+            return None
+        return (message.sender, message.frozen, message.delivered,
+                message.recipients)
+
+    def removeMessages(self, ids, progress=None):
         """Remove messages with given IDs."""
-        output = self.getEximOutput(['-Mrm'] + ids)
-        return self.checkOutput(output,
-                "has been removed", len(ids), _("removed"))
+        return self._checkedAction(['-Mrm'], ids,
+                "has been removed", _("removed"), progress)
 
-    def freezeMessages(self, ids):
+    def freezeMessages(self, ids, progress=None):
         """Freeze messages with given IDs."""
-        output = self.getEximOutput(['-Mf'] + ids)
-        return self.checkOutput(output,
-                "is now frozen", len(ids), _("frozen"))
+        return self._checkedAction(['-Mf'], ids,
+                "is now frozen", _("frozen"), progress)
 
-    def thawMessages(self, ids):
+    def thawMessages(self, ids, progress=None):
         """Unfreeze messages with given IDs."""
-        output = self.getEximOutput(['-Mt'] + ids)
-        return self.checkOutput(output,
-                "is no longer frozen", len(ids), _("thawed"))
+        return self._checkedAction(['-Mt'], ids,
+                "is no longer frozen", _("thawed"), progress)
 
-    def deliverMessages(self, ids):
+    def deliverMessages(self, ids, progress=None):
         """Force the delivery of messages with given IDs."""
-        return (True, self.getEximOutput(['-M'] + ids))
+        return (True, self._runForMessages(['-M'], ids, progress=progress))
 
-    def giveUpMessages(self, ids):
+    def giveUpMessages(self, ids, progress=None):
         """Give up trying to deliver messages with given IDs."""
-        return (True, self.getEximOutput(['-Mg'] + ids))
+        return (True, self._runForMessages(['-Mg'], ids, progress=progress))
 
     def addRecipients(self, id, recipients):
         """Add more recipients to a message with a given ID."""
-        output = self.getEximOutput(['-Mar', id] + recipients.split())
+        id, host = self._splitKey(id)
+        output = self.getEximOutput(['-Mar', id] + recipients.split(), host)
         return self.checkOutput(output,
                 "has been modified", 1, _("modified"))
 
     def editSender(self, id, sender):
         """Change the sender of a message with a given ID."""
-        output = self.getEximOutput(['-Mes', id, sender])
+        id, host = self._splitKey(id)
+        output = self.getEximOutput(['-Mes', id, sender], host)
         return self.checkOutput(output,
                 "has been modified", 1, _("modified"))
 
-    def markAllDelivered(self, ids):
+    def markAllDelivered(self, ids, progress=None):
         """Mark all recipients of messages with given IDs as delivered."""
-        output = self.getEximOutput(['-Mmad'] + ids)
-        return self.checkOutput(output,
-                "has been modified", len(ids), _("marked as delivered"))
+        return self._checkedAction(['-Mmad'], ids,
+                "has been modified", _("marked as delivered"), progress)
+
+
+class QueueDelta:
+    """Changes in the exim queue between two updates.
+
+    `queue` is the complete new mapping from message keys (see Message.key)
+    to messages, `added` and `changed` are lists of Message objects,
+    `removed` is a list of message keys.  `frozen` is the number of frozen
+    messages in `queue`.
+    """
+
+    def __init__(self, queue, added, removed, changed, frozen):
+        self.queue = queue
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.frozen = frozen
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+
+def parse_queue(lines, odd_lines=None):
+    """Parse the output of `exim -bpr`, yielding Message objects.
+
+    `lines` can be any iterable, e.g. a pipe, so that messages are produced
+    as the output arrives.  Lines that cannot be parsed are appended to
+    `odd_lines` if it is given.
+
+    >>> output = [' 5m   300 1AttSl-0002qC-00 <joe@x.org>\\n',
+    ...           '          ann@x.org\\n', '\\n',
+    ...           '25m  2.9K 1AttSm-0002qD-00 <> *** frozen ***\\n',
+    ...           '        D joe@x.org\\n']
+    >>> for m in parse_queue(output):
+    ...     print m.id, m.frozen, m.recipients
+    1AttSl-0002qC-00 False ('ann@x.org',)
+    1AttSm-0002qD-00 True ()
+    """
+    message = None
+    recipients = None   # recipient lines of the current message
+    for line in lines:
+        line = line.rstrip('\n')
+        if recipients is None:
+            try:
+                message = Message(status_line=line)
+            except ValueError:
+                message = None # probably an odd status line, ignore it
+                if odd_lines is not None:
+                    odd_lines.append(line)
+            recipients = []
+        elif line:
+            if message is not None:
+                recipients.append(line)
+            elif odd_lines is not None:
+                odd_lines.append(line)
+        else:
+            if message is not None:
+                message.set_recipients(recipients)
+                yield message
+            recipients = None
+    if message is not None and recipients is not None:
+        message.set_recipients(recipients)
+        yield message
+
+
+def parse_size(size):
+    """Convert a message size as printed by `exim -bp` to bytes.
+
+    >>> parse_size('512'), parse_size('1.2K'), parse_size('2M'), parse_size('')
+    (512, 1228, 2097152, 0)
+    """
+    if not size:
+        return 0
+    multiplier = _SIZE_SUFFIXES.get(size[-1])
+    if multiplier is None:
+        return int(size)
+    return int(float(size[:-1]) * multiplier)
+
+_SIZE_SUFFIXES = {'K': 1024, 'M': 1024*1024, 'G': 1024*1024*1024}
+
+
+def parse_age(age):
+    """Convert a time in queue as printed by `exim -bp` to minutes.
+
+    >>> parse_age('25m'), parse_age('22h'), parse_age('3d'), parse_age('')
+    (25, 1320, 4320, 0)
+    """
+    if not age:
+        return 0
+    multiplier = _AGE_SUFFIXES.get(age[-1])
+    if multiplier is None:
+        return int(age)
+    return int(age[:-1]) * multiplier
+
+_AGE_SUFFIXES = {'m': 1, 'h': 60, 'd': 24*60}
 
 
 class Message:
     """A queued message.
 
+    `size_bytes` and `age` (in minutes) are numeric versions of `size` and
+    `time`, for sorting.  `recipients` is a tuple of the addresses the
+    message has not been delivered to yet, `delivered` is the number of
+    addresses it has been delivered to.  `host` is the host the message is
+    queued on when several hosts are monitored, '' otherwise.
+
     >>> line = '22h  1.2K 1AttSk-0002qB-00 <> *** frozen ***'
     >>> m = Message(line)
     >>> m.id, m.frozen, m.time, m.sender, m.size, m.recipients
-    ('1AttSk-0002qB-00', True, '22h', '<>', '1.2K', [])
-    >>> m.add_recipient(' foobar\\n')
-    >>> m.recipients
-    ['foobar']
+    ('1AttSk-0002qB-00', True, '22h', '<>', '1.2K', ())
+    >>> m.size_bytes, m.age
+    (1228, 1320)
+    >>> m.set_recipients(['  D joe@example.com', '  foobar'])
+    >>> m.delivered, m.recipients
+    (1, ('foobar',))
+    >>> m.recipient_summary()
+    '1 sent, 1 unsent: foobar'
     """
 
+    __slots__ = ('id', 'frozen', 'time', 'size', 'sender', 'age',
+                 'size_bytes', 'delivered', 'recipients', 'host')
+
     def __init__(self, status_line=None):
         """Extract information from a message status line returned by exim."""
-        if not status_line is None:
-            parts = status_line.split()
+        if status_line is None:
+            self.id, self.frozen, self.sender = '', False, ''
+            self.time, self.size, self.age, self.size_bytes = '', '', 0, 0
+        else:
+            # time, size, id, sender and possibly "*** frozen ***"
+            parts = status_line.split(None, 4)
             if len(parts) < 4:
                 raise ValueError(_("Invalid status line: ") + status_line)
-            self.id = parts[2]
-            self.frozen = "frozen" in parts
-            self.time = parts[0]
-            self.size = parts[1]
-            self.sender = parts[3]
-	    self.recipients = ['0','sent,','0','unsent:']
+            self.time, self.size, self.id, self.sender = parts[:4]
+            self.frozen = len(parts) == 5 and 'frozen' in parts[4]
+            try:
+                self.age = parse_age(self.time)
+                self.size_bytes = parse_size(self.size)
+            except ValueError:
+                raise ValueError(_("Invalid status line: ") + status_line)
+        self.delivered = 0
+        self.recipients = ()
+        self.host = ''
+
+    def key(self):
+        """The message id, tagged with the host when watching several."""
+        if self.host:
+            return self.id + '@' + self.host
+        return self.id
+    key = property(key)
+
+    def set_recipients(self, lines):
+        """Set the recipients from the lines listed by `exim -bpr`.
+
+        Delivered addresses are prefixed with "D ".
+        """
+        undelivered = []
+        delivered = 0
+        for line in lines:
+            recipient = line.strip()
+            if recipient.startswith('D '):
+                delivered += 1
+            else:
+                undelivered.append(recipient)
+        self.delivered = delivered
+        self.recipients = tuple(undelivered)
 
     def add_recipient(self, line):
         """Add a recipient to the message."""
-	recipient = line.strip()
-	if recipient[0] == 'D' and recipient[1] == ' ':
-	    self.recipients[0] = str(int(self.recipients[0]) + 1)
-	else:
-	    self.recipients.append(recipient)
-	    self.recipients[2] = str(int(self.recipients[2]) + 1)
-	self.recipients[0] = str(int(self.recipients[0]) + 1)
+        recipient = line.strip()
+        if recipient.startswith('D '):
+            self.delivered += 1
+        else:
+            self.recipients += (recipient,)
+
+    def recipient_summary(self):
+        """Describe the recipients for display."""
+        return "%d sent, %d unsent: %s" % (self.delivered,
+                len(self.recipients), " ".join(self.recipients))
 
     def __eq__(self, other):
         return (self.id == other.id and self.frozen == other.frozen and
                 self.time == other.time and self.size == other.size and
                 self.sender == other.sender and
-                self.recipients == other.recipients)
+                self.delivered == other.delivered and
+                self.recipients == other.recipients and
+                self.host == other.host)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
 
+class ErrorMessage(Message):
+    """A pseudo-message used to show an error in the message list."""
+
+    __slots__ = ()
+
+    def __init__(self, text):
+        Message.__init__(self)
+        self.id, self.frozen, self.recipients = 'error', True, (text,)
+
+    def recipient_summary(self):
+        return self.recipients[0]
+
+
 class ProcessManager(BackgroundJob):
     """Exim process manager.
 
@@ -428,10 +1593,23 @@ class ProcessManager(BackgroundJob):
         self.use_sudo = use_sudo
         self.use_ssh = use_ssh
         self.hostname = hostname
+        self.agent = None
 
     def do_update(self):
         """Collect data from exiwhat in a separate thread."""
-        data = get_output(self.bin_dir, 'exiwhat', use_sudo=self.use_sudo, use_ssh=self.use_ssh, hostname=self.hostname)
+        if self.agent is not None:
+            error = self.agent.check()
+            if error:
+                self.callback({}, error)
+            else:
+                self.callback(*self.agent.get_processes())
+            return
+
+        # process ids are only unique on one host, so only the processes of
+        # the first host are listed; the status says so
+        hosts = host_list(self.use_ssh, self.hostname)
+        host = hosts[0]
+        data = get_output(self.bin_dir, 'exiwhat', use_sudo=self.use_sudo, use_ssh=self.use_ssh, hostname=host)
 
         processes = {}
         if (data.find('Permission denied') != -1 or
@@ -456,5 +1634,8 @@ class ProcessManager(BackgroundJob):
                 process_word = (len(processes) > 1 and _("processes")
                                                     or _("process"))
                 status = _("%d exim %s.") % (len(processes), process_word)
+        if len(hosts) > 1:
+            status = (_("Host %s: %s (Processes on the other %d host(s) "
+                        "are not shown.)") % (host, status, len(hosts) - 1))
 
         self.callback(processes, status)
@@ -21,6 +21,7 @@ VERSION = "0.7.7"
 
 import gettext
 gettext.install('geximon')
+import os
 import sys
 
 try:
@@ -31,7 +32,8 @@ except RuntimeError, e:
 		sys.exit()
 import gobject
 
-from exim import LogWatcher, QueueManager
+from exim import LogWatcher, QueueManager, ssh_connections, host_list
+from agent import AgentConnection
 from gtkhelpers import AlertDialog
 from gtkhelpers import framed, scrolled, show_help
 from widgets import LogWidget, ProcessWidget, QueueWidget
@@ -51,13 +53,22 @@ class GEximonWindow(gtk.Window):
         self.prefs = prefs = Preferences()
         prefs.load()
         prefs.subscribe(self.apply_prefs)
+        ssh_connections.enabled = prefs.ssh_multiplex
 
         self.logwatcher = LogWatcher(prefs.log_dir, prefs.mainlog_name,
-                prefs.bin_dir, prefs.use_sudo, prefs.use_ssh, prefs.hostname)
+                prefs.bin_dir, prefs.use_sudo, prefs.use_ssh, prefs.hostname,
+                index_path=prefs.index_file, stats_path=prefs.stats_file)
+        self.logwatcher.updateIndex()
+
+        self.agent = None
+        self._agent_settings = None
 
         # callback is None, it will be specified by QueueWidget
         self.queue_mgr = QueueManager(None,
-                prefs.bin_dir, prefs.exim_binary, prefs.use_sudo, prefs.use_ssh, prefs.hostname)
+                prefs.bin_dir, prefs.exim_binary, prefs.use_sudo, prefs.use_ssh, prefs.hostname,
+                prefs.read_spool and prefs.spool_dir or None,
+                prefs.action_concurrency, prefs.spool_actions,
+                os.path.join(prefs.log_dir, prefs.mainlog_name))
 
         self._setUpIcons()
 
@@ -70,6 +81,10 @@ class GEximonWindow(gtk.Window):
 
         # set up widgets
         self.plotter = Plotter(self.logwatcher, self.queue_mgr, prefs)
+        if prefs.backfill_minutes > 0 and not prefs.use_ssh:
+            self.plotter.backfill(
+                    os.path.join(prefs.log_dir, prefs.mainlog_name),
+                    prefs.backfill_minutes)
         self.log_widget = LogWidget(self.logwatcher, prefs)
         self.queue_widget = QueueWidget(self,
                 self.logwatcher, self.queue_mgr, prefs)
@@ -244,6 +259,10 @@ class GEximonWindow(gtk.Window):
         self.save_preferences()
         # it would be nice if the following were called automatically
         self.process_window.process_widget.cleanup()
+        self.plotter.cleanup()
+        if self.agent is not None:
+            self.agent.close()
+        ssh_connections.close()
         gtk.main_quit()
         return False
 
@@ -268,6 +287,8 @@ class GEximonWindow(gtk.Window):
         pref_dialog.hide()
 
     def apply_prefs(self, prefs):
+        ssh_connections.enabled = prefs.ssh_multiplex
+        self.connectAgent(prefs)
         self.process_list_menu_item.set_active(prefs.show_process_list)
         self.show_plotter_menu_item.set_active(prefs.show_plotter)
         self.show_statusbar_menu_item.set_active(prefs.show_statusbar)
@@ -278,6 +299,43 @@ class GEximonWindow(gtk.Window):
         self.track_log_menu_item.set_active(prefs.track_log)
 
 
+    def connectAgent(self, prefs):
+        """Start, replace or drop the agent connection according to prefs.
+
+        The agent is only used when a single host is monitored.
+        """
+        single_host = len(host_list(prefs.use_ssh, prefs.hostname)) == 1
+        if (prefs.use_agent and single_host
+                and (prefs.use_ssh or prefs.agent_socket)):
+            args = ('--log-dir %s --mainlog %s --bin-dir %s --exim-binary %s'
+                    ' --queue-interval %d --process-interval %d'
+                    % (prefs.log_dir, prefs.mainlog_name, prefs.bin_dir,
+                       prefs.exim_binary, prefs.queue_interval,
+                       prefs.process_interval))
+            if prefs.read_spool:
+                args += ' --spool-dir %s' % prefs.spool_dir
+            if prefs.use_ssh:
+                settings = (prefs.agent_command, args, prefs.use_sudo,
+                            prefs.hostname, None)
+            else:
+                settings = (None, None, False, '', prefs.agent_socket)
+        else:
+            settings = None
+        if settings == self._agent_settings:
+            return
+
+        if self.agent is not None:
+            self.agent.close()
+        if settings is None:
+            self.agent = None
+        else:
+            self.agent = AgentConnection(*settings)
+        self._agent_settings = settings
+        self.logwatcher.setAgent(self.agent)
+        self.queue_mgr.agent = self.agent
+        self.process_window.process_widget.process_mgr.agent = self.agent
+
+
 class ProcessWindow(gtk.Window):
     """A window that contains the exim process list."""
 
@@ -71,7 +71,7 @@ class PopupWindow(gtk.Window):
         textview.set_editable(False)
         buffer = self.buffer = textview.get_buffer()
         buffer.set_text(text)
-        monospace = buffer.create_tag()
+        monospace = self._monospace = buffer.create_tag()
         monospace.set_property('family', 'Monospace')
         buffer.apply_tag(monospace,
                 buffer.get_start_iter(), buffer.get_end_iter())
@@ -84,6 +84,11 @@ class PopupWindow(gtk.Window):
 
         self.set_default_size(600, 400)
 
+    def append(self, text):
+        """Add text at the end of the window."""
+        self.buffer.insert_with_tags(self.buffer.get_end_iter(), text,
+                                     self._monospace)
+
     def createMenuBar(self):
         ui_string = """<ui>
         <menubar name='menubar'>
@@ -0,0 +1,67 @@
+"""Fixed-size histories of plotted values."""
+
+from array import array
+from collections import deque
+
+__metaclass__ = type
+
+
+class History:
+    """The last `size` values of a series, in a circular array.
+
+    Appending is O(1), and so is finding the largest value: a monotonic
+    deque holds the candidates for the maximum (decreasing values, each
+    with its position), so that values leaving the history are dropped
+    from its front.
+
+    >>> h = History(3)
+    >>> for value in [5, 1, 3, 2]:
+    ...     h.append(value)
+    >>> len(h), h.last(), h.max(), h.window(2)
+    (3, 2.0, 3.0, [3.0, 2.0])
+    >>> h.append(0); h.append(0)
+    >>> h.max(), h.window(5)
+    (2.0, [2.0, 0.0, 0.0])
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._values = array('d', [0.0]) * size
+        self._count = 0 # values ever appended
+        self._maxima = deque() # (position, value), values decreasing
+
+    def __len__(self):
+        return min(self._count, self.size)
+
+    def append(self, value):
+        position = self._count
+        self._values[position % self.size] = value
+        self._count = position + 1
+        maxima = self._maxima
+        while maxima and maxima[-1][1] <= value:
+            maxima.pop()
+        maxima.append((position, value))
+        if maxima[0][0] <= position - self.size:
+            maxima.popleft()
+
+    def last(self):
+        """Return the newest value (0 if there is none)."""
+        if not self._count:
+            return 0.0
+        return self._values[(self._count - 1) % self.size]
+
+    def max(self):
+        """Return the largest value in the history (0 if there is none)."""
+        if not self._maxima:
+            return 0.0
+        return float(self._maxima[0][1])
+
+    def window(self, count):
+        """Return the newest `count` values, oldest first."""
+        count = min(count, len(self))
+        end = self._count % self.size
+        start = end - count
+        if start >= 0:
+            return self._values[start:end].tolist()
+        return (self._values[start:].tolist() +
+                self._values[:end].tolist())
@@ -0,0 +1,323 @@
+"""Following log files as they grow, like `tail -F`."""
+
+import os
+import errno
+import select
+import struct
+
+__metaclass__ = type
+
+READ_SIZE = 64 * 1024
+READ_BUDGET = 1024 * 1024   # most data to return from one readlines() call
+MAX_LAG = 16 * 1024 * 1024  # skip ahead when further behind a local log
+MAX_LINE = 64 * 1024        # longest partial line to keep waiting for
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+
+_EVENT = struct.Struct('iIII')
+
+
+def _load_libc():
+    """Return libc if it has inotify support, None otherwise."""
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+
+class Inotify:
+    """Watch a directory for changes to one of its files.
+
+    Raises OSError if inotify is not available.
+    """
+
+    MASK = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, directory, name):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.name = name
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(_get_errno(), "inotify_init1 failed")
+        if _libc.inotify_add_watch(self.fd, directory, self.MASK) < 0:
+            error = _get_errno()
+            self.close()
+            raise OSError(error, "cannot watch %s" % directory)
+
+    def read_events(self):
+        """Drain pending events.
+
+        Returns True if any of them concern the watched file (or may have,
+        after a queue overflow).  Raises OSError if the watch has gone away,
+        e.g. because the directory was removed.
+        """
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return changed
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+                pos += _EVENT.size
+                name = data[pos:pos + length].rstrip('\0')
+                pos += length
+                if mask & IN_IGNORED:
+                    raise OSError(errno.ENOENT, "the watch has been removed")
+                if mask & IN_Q_OVERFLOW or name == self.name:
+                    changed = True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _get_errno():
+    import ctypes
+    return ctypes.get_errno()
+
+
+class Follower:
+    """Base class for followers: splits what read() returns into lines.
+
+    Subclasses implement read(limit), which returns at most `limit` bytes
+    and sets `skipped` to the number of bytes it had to jump over, and
+    pending(), which tells whether more data was left to read.
+    """
+
+    def __init__(self):
+        self._partial = ''
+        self.skipped = 0
+
+    def readlines(self):
+        """Return the complete lines that have arrived since the last call.
+
+        A line cut across reads is kept until the rest of it arrives.  At
+        most READ_BUDGET bytes are read per call, so a large backlog is
+        worked off over several calls; if data had to be skipped, a note
+        takes the place of the lost lines.
+        """
+        self.skipped = 0
+        data = self.read(READ_BUDGET)
+        notes = []
+        if self.skipped:
+            # the partial line and the start of the data do not belong
+            # together any more
+            data = data[data.find('\n') + 1:]
+            self._partial = ''
+            notes.append(_("geximon: skipped %d bytes of the log")
+                         % self.skipped)
+        if not data:
+            return notes
+        data = self._partial + data
+        end = data.rfind('\n') + 1
+        self._partial = data[end:]
+        lines = data[:end].split('\n')
+        lines.pop()
+        if len(self._partial) > MAX_LINE:
+            lines.append(self._partial)
+            self._partial = ''
+        return notes + lines
+
+
+class LogFollower(Follower):
+    """Follow a local log file, handling rotation and truncation.
+
+    New data is read straight from the file.  Where inotify is available the
+    log's directory is watched, so that an idle log costs nothing and
+    fileno() can be used to wait for changes; otherwise every read() checks
+    the file with stat.  The file is reopened when a file with a different
+    inode appears under its name, after the rest of the old one has been
+    read.
+
+    Raises IOError or OSError if the file cannot be opened.
+    """
+
+    def __init__(self, path, backlog=10, use_inotify=True):
+        Follower.__init__(self)
+        self.path = path
+        self._fd = -1
+        self._stat = None
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = Inotify(os.path.dirname(path) or '.',
+                                        os.path.basename(path))
+            except OSError:
+                pass # fall back to stat
+        try:
+            self._reopen(self._tail(backlog))
+        except:
+            self.close()
+            raise
+        self._pending = True # the backlog (and anything written meanwhile)
+
+    def _tail(self, lines):
+        """Return the offset of the last `lines` lines of the log."""
+        size = os.stat(self.path).st_size
+        if not lines or not size:
+            return size
+        start = max(0, size - READ_SIZE)
+        f = open(self.path, 'rb')
+        try:
+            f.seek(start)
+            data = f.read(size - start)
+        finally:
+            f.close()
+        end = len(data)
+        if data.endswith('\n'):
+            end -= 1
+        for i in range(lines):
+            end = data.rfind('\n', 0, end)
+            if end < 0:
+                return start
+        return start + end + 1
+
+    def _reopen(self, offset=0):
+        """Open the file under our path, starting at `offset`."""
+        fd = os.open(self.path, os.O_RDONLY)
+        if self._fd >= 0:
+            os.close(self._fd)
+        self._fd = fd
+        self._stat = os.fstat(fd)
+        self._pos = os.lseek(fd, offset, 0)
+
+    def fileno(self):
+        """Return a descriptor that becomes readable on changes, or None."""
+        if self._inotify is not None:
+            return self._inotify.fd
+        return None
+
+    def pending(self):
+        """Tell whether the last read() stopped before the end of the log."""
+        return self._pending
+
+    def read(self, limit=None):
+        """Return the data appended to the log since the last call.
+
+        At most `limit` bytes are returned.  If the log is more than MAX_LAG
+        bytes ahead, the reader jumps forward and sets `skipped`.
+        """
+        if self._inotify is not None:
+            try:
+                changed = self._inotify.read_events()
+            except OSError:
+                self._inotify.close()
+                self._inotify = None
+                changed = True
+            if not changed and not self._pending:
+                return ''
+        self._pending = False
+        lag = os.fstat(self._fd).st_size - self._pos
+        if lag > MAX_LAG:
+            self.skipped += lag - READ_BUDGET
+            self._pos = os.lseek(self._fd, self._pos + lag - READ_BUDGET, 0)
+        data = self._readSome(limit)
+        if self._pending:
+            return data # rotation is looked at once the file is done
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return data # rotated away, the new file is not there yet
+        if (st.st_ino, st.st_dev) != (self._stat.st_ino, self._stat.st_dev):
+            try:
+                self._reopen()
+            except (IOError, OSError):
+                return data
+        elif st.st_size < self._pos:
+            self._pos = os.lseek(self._fd, 0, 0) # truncated
+        else:
+            return data
+        if limit is not None:
+            limit -= len(data)
+        return data + self._readSome(limit)
+
+    def _readSome(self, limit):
+        """Read up to `limit` bytes (or to the end of the file)."""
+        chunks = []
+        while limit is None or limit > 0:
+            size = READ_SIZE
+            if limit is not None:
+                size = min(size, limit)
+            chunk = os.read(self._fd, size)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+            self._pos += len(chunk)
+            if limit is not None:
+                limit -= len(chunk)
+        self._pending = True
+        return ''.join(chunks)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PipeFollower(Follower):
+    """Follow the output of a command such as `tail -F` on a remote host."""
+
+    def __init__(self, pipe):
+        Follower.__init__(self)
+        self.pipe = pipe
+        self._eof = False
+        self._pending = False
+
+    def fileno(self):
+        """Return a descriptor that becomes readable on changes, or None."""
+        if self._eof:
+            return None # would be readable all the time
+        return self.pipe.fileno()
+
+    def pending(self):
+        """Tell whether the last read() left data in the pipe."""
+        return self._pending
+
+    def read(self, limit=None):
+        """Return the data that has arrived since the last call.
+
+        At most about `limit` bytes are returned.
+        """
+        chunks = []
+        size = 0
+        fd = self.pipe.fileno()
+        self._pending = False
+        while not self._eof and select.select([fd], [], [], 0)[0]:
+            if limit is not None and size >= limit:
+                self._pending = True
+                break
+            chunk = os.read(fd, READ_SIZE)
+            if not chunk:
+                self._eof = True
+            chunks.append(chunk)
+            size += len(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        self.pipe.close()
@@ -0,0 +1,238 @@
+"""An on-disk index of the exim main logs, for looking up messages."""
+
+import os
+import gzip
+import anydbm
+import threading
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from exim import LogRecord
+
+__metaclass__ = type
+
+
+def open_log(path):
+    """Open a log file, which may be compressed with gzip."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def identify_log(path):
+    """Return an identity for a log file, or None if it is empty.
+
+    The identity is derived from the first line, so it stays the same when
+    the file is rotated, renamed or compressed.
+    """
+    f = open_log(path)
+    try:
+        first_line = f.readline()
+    finally:
+        f.close()
+    if not first_line.endswith('\n'):
+        return None # not even one complete line yet
+    return md5(first_line).hexdigest()
+
+
+def identify_logs(paths):
+    """Return (identity, path) for the log files that are not empty.
+
+    A log that is being compressed is there twice, with the same identity;
+    only the uncompressed file is returned then, as the other one may not
+    be complete yet.  Files that cannot be read are left out.
+    """
+    found = {}
+    order = []
+    for path in paths:
+        try:
+            identity = identify_log(path)
+        except (IOError, OSError):
+            continue # unreadable, or rotated away meanwhile
+        if identity is None:
+            continue
+        if identity not in found:
+            order.append(identity)
+        elif path.endswith('.gz'):
+            continue
+        found[identity] = path
+    return [(identity, found[identity]) for identity in order]
+
+
+def strip_address(address):
+    """Normalize an address as found in the log.
+
+    >>> strip_address('<Joe@Example.com>'), strip_address('<>')
+    ('joe@example.com', '')
+    """
+    return address.strip('<>,:').lower()
+
+
+class LogIndex:
+    """An index of message ids and addresses in the main log and its
+    rotated (possibly gzipped) predecessors.
+
+    For every message id the index holds the places of its log lines; for
+    every sender and recipient address, the ids of its messages.  Log files
+    are identified by their first line, so that they can be found again
+    after they have been rotated, renamed or compressed; places are offsets
+    into the uncompressed data.  A compressed log is read on from where its
+    uncompressed predecessor was left, then marked as done.  update()
+    indexes what has been added since the last time, so it is cheap to call
+    before every lookup.
+    """
+
+    BATCH = 100000 # lines to index before writing to the database
+
+    def __init__(self, index_path, log_dir, mainlog_name):
+        """Open the index at `index_path`, creating it if necessary.
+
+        Raises IOError if that cannot be done.
+        """
+        self.log_dir = log_dir
+        self.mainlog_name = mainlog_name
+        try:
+            self._db = anydbm.open(index_path, 'c')
+        except anydbm.error, e:
+            raise IOError(str(e))
+        self._paths = {} # file identity -> current path
+        self._lock = threading.Lock()
+
+    def update(self):
+        """Index new log files and new data in the existing ones."""
+        self._lock.acquire()
+        try:
+            paths = [os.path.join(self.log_dir, name)
+                     for name in os.listdir(self.log_dir)
+                     if name.startswith(self.mainlog_name)]
+            logs = identify_logs(paths)
+            for identity, path in logs:
+                try:
+                    self._indexFile(identity, path)
+                except (IOError, OSError):
+                    continue # unreadable, or rotated away meanwhile
+            self._paths = dict(logs)
+            if hasattr(self._db, 'sync'):
+                self._db.sync()
+        finally:
+            self._lock.release()
+
+    def _indexFile(self, identity, path):
+        """Index a log file from where the last update left off."""
+        key = 'file:' + identity
+        offset = int(self._db.get(key, '0'))
+        compressed = path.endswith('.gz')
+        if compressed:
+            if 'done:' + identity in self._db:
+                return # compressed logs do not grow
+        elif os.stat(path).st_size <= offset:
+            return
+        places = {}
+        addresses = {}
+        lines = 0
+        f = open_log(path)
+        try:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    break # incomplete; will be indexed next time
+                record = LogRecord(line[:-1])
+                if record.id:
+                    places.setdefault(record.id, []).append(
+                            '%s:%d' % (identity, offset))
+                    address = strip_address(record.address())
+                    if address:
+                        addresses.setdefault(address, set()).add(record.id)
+                offset += len(line)
+                lines += 1
+                if lines % self.BATCH == 0:
+                    self._store(places, addresses)
+                    places, addresses = {}, {}
+                    self._db[key] = str(offset)
+        finally:
+            f.close()
+        self._store(places, addresses)
+        self._db[key] = str(offset)
+        if compressed:
+            self._db['done:' + identity] = '1'
+
+    def _store(self, places, addresses):
+        db = self._db
+        for id, new_places in places.iteritems():
+            key = 'id:' + id
+            old = db.get(key)
+            db[key] = ' '.join((old and [old] or []) + new_places)
+        for address, ids in addresses.iteritems():
+            key = 'addr:' + address
+            old = db.get(key, '').split()
+            ids = ids.difference(old)
+            if ids:
+                db[key] = ' '.join(old + sorted(ids))
+
+    def lookup_address(self, address):
+        """Return the ids of the messages from or to an address."""
+        self._lock.acquire()
+        try:
+            return self._db.get('addr:' + strip_address(address), '').split()
+        finally:
+            self._lock.release()
+
+    def lookup_id(self, id):
+        """Return the log lines of a message, oldest first."""
+        self._lock.acquire()
+        try:
+            places = self._db.get('id:' + id, '').split()
+            paths = self._paths
+        finally:
+            self._lock.release()
+        by_file = {}
+        for place in places:
+            identity, offset = place.split(':')
+            by_file.setdefault(identity, []).append(int(offset))
+        lines = []
+        for identity, offsets in by_file.iteritems():
+            path = paths.get(identity)
+            if path is None:
+                continue # the file has been removed
+            try:
+                f = open_log(path)
+                try:
+                    for offset in sorted(offsets):
+                        f.seek(offset)
+                        lines.append(f.readline().rstrip('\n'))
+                finally:
+                    f.close()
+            except IOError:
+                continue
+        lines.sort() # they start with the date and time
+        return lines
+
+    def search(self, strings):
+        """Find the log lines of messages with the given ids or addresses.
+
+        Returns the text in the format of exigrep: the lines of each
+        message, messages separated by empty lines.
+        """
+        ids = []
+        for string in strings:
+            string = string.strip()
+            if len(string) == 16 and string[6] == '-' and string[13] == '-':
+                found = [string]
+            else:
+                found = self.lookup_address(string)
+            ids += [id for id in found if id not in ids]
+        texts = []
+        for id in ids:
+            lines = self.lookup_id(id)
+            if lines:
+                texts.append('\n'.join(lines))
+        return '\n\n'.join(texts)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
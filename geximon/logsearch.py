@@ -0,0 +1,216 @@
+"""Searching the exim main logs in parallel, like exigrep."""
+
+import os
+import re
+import gzip
+import time
+import Queue
+import threading
+import multiprocessing
+
+__metaclass__ = type
+
+ID_LENGTH = 16
+
+# the last line exim writes about a message
+END_OF_MESSAGE = ' Completed'
+
+BATCH = 100 # groups to send from a worker at a time
+BATCH_DELAY = 0.5 # seconds after which found groups are sent anyway
+CHECK_LINES = 10000 # lines to search between looking at the time
+
+
+def log_files(log_dir, mainlog_name):
+    """Return the main log and its rotations in `log_dir`, newest first."""
+    paths = []
+    for name in os.listdir(log_dir):
+        if name.startswith(mainlog_name):
+            path = os.path.join(log_dir, name)
+            try:
+                paths.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+    paths.sort()
+    paths.reverse()
+    return [path for mtime, path in paths]
+
+
+def _message_id(line):
+    """Return the message id of a log line, or None.
+
+    >>> _message_id('2004-12-03 12:34:56 1AttSk-0002qB-00 Completed')
+    '1AttSk-0002qB-00'
+    >>> _message_id('2004-12-03 12:34:56.789 +0100 [4321] '
+    ...             '1AttSk-0002qB-00 <= <>')
+    '1AttSk-0002qB-00'
+    >>> _message_id('2004-12-03 12:34:56 Start queue run: pid=4321')
+    """
+    for word in line.split(' ', 5)[2:5]:
+        if len(word) == ID_LENGTH and word[6] == '-' and word[13] == '-':
+            return word
+    return None
+
+
+def grep_lines(lines, regex):
+    """Generate the groups of log lines that exigrep would show.
+
+    A group holds all the lines of a message of which at least one matches
+    `regex` (a compiled regular expression), or a single matching line
+    that does not belong to any message.  Groups are in the order of the
+    messages' last lines; messages that are not completed come last.
+
+    >>> lines = ['t 1 1AttSk-0002qB-00 <= joe@x.org', 't 2 1AttSl-0002qC-00 <=',
+    ...          't 3 1AttSk-0002qB-00 Completed', 't 4 joe@x.org: rejected',
+    ...          't 5 1AttSl-0002qC-00 => joe@x.org']
+    >>> for group in grep_lines(lines, re.compile('joe')):
+    ...     print group; print '--'
+    t 1 1AttSk-0002qB-00 <= joe@x.org
+    t 3 1AttSk-0002qB-00 Completed
+    --
+    t 4 joe@x.org: rejected
+    --
+    t 2 1AttSl-0002qC-00 <=
+    t 5 1AttSl-0002qC-00 => joe@x.org
+    --
+    """
+    saved = {} # message id -> its lines so far
+    matched = {}
+    for line in lines:
+        id = _message_id(line)
+        if id is None:
+            if regex.search(line):
+                yield line
+            continue
+        saved.setdefault(id, []).append(line)
+        if regex.search(line):
+            matched[id] = True
+        if line.endswith(END_OF_MESSAGE):
+            message = saved.pop(id)
+            if matched.pop(id, False):
+                yield '\n'.join(message)
+    incomplete = [(message[0], id) for id, message in saved.iteritems()
+                  if id in matched]
+    incomplete.sort()
+    for first_line, id in incomplete:
+        yield '\n'.join(saved[id])
+
+
+def grep_file(path, pattern, flags, send):
+    """Search one log file.
+
+    The groups found are passed to send(path, groups, False) as they are
+    completed: the first one at once, then in batches of up to BATCH groups
+    or when BATCH_DELAY seconds have passed.  Finally send(path, groups,
+    True) is called with the rest.  If the file cannot be read, the last
+    group is an error message.
+
+    >>> sent = []
+    >>> grep_file('/nonexistent', 'x', 0, lambda *args: sent.append(args))
+    >>> [(path, len(groups), done) for path, groups, done in sent]
+    [('/nonexistent', 1, True)]
+    """
+    regex = re.compile(pattern, flags)
+    batch = []
+    sent = [0] # when groups were last sent
+    def flush():
+        send(path, batch[:], False)
+        del batch[:]
+        sent[0] = time.time()
+    def lines(f):
+        count = 0
+        for line in f:
+            count += 1
+            if (batch and count % CHECK_LINES == 0
+                    and time.time() - sent[0] >= BATCH_DELAY):
+                flush()
+            yield line.rstrip('\n')
+    try:
+        if path.endswith('.gz'):
+            f = gzip.open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+        try:
+            for group in grep_lines(lines(f), regex):
+                batch.append(group)
+                if (len(batch) >= BATCH
+                        or time.time() - sent[0] >= BATCH_DELAY):
+                    flush()
+        finally:
+            f.close()
+    except IOError, e:
+        batch.append("geximon: cannot read %s: %s" % (path, e.strerror or e))
+    send(path, batch, True)
+
+
+_results = None # where a worker process sends the groups it finds
+
+def _start_worker(results):
+    global _results
+    _results = results
+
+def _grep_worker(path, pattern, flags):
+    """Search one log file in a worker process of a LogSearch."""
+    try:
+        grep_file(path, pattern, flags, lambda *args: _results.put(args))
+    except Exception, e:
+        _results.put((path, ["geximon: cannot search %s: %s" % (path, e)],
+                      True))
+
+
+class LogSearch:
+    """A search for a pattern in several log files at once.
+
+    Every file is searched by a process of a multiprocessing pool, so that
+    rotated logs are read and decompressed in parallel.  The workers send
+    the matching groups (see grep_lines) back through a queue in batches as
+    they find them (see grep_file); `found` is called with the path and the
+    groups of every batch, in no particular order across files, and
+    `finished` once all the files are done or the search has been
+    cancelled.  Both are called from a background thread.
+
+    `pattern` is a Python regular expression, or a plain string if
+    `literal` is True; like exigrep, matching ignores case.  Raises
+    ValueError if the pattern is invalid.
+    """
+
+    def __init__(self, paths, pattern, literal, found, finished,
+                 processes=None):
+        if literal:
+            pattern = re.escape(pattern)
+        try:
+            re.compile(pattern)
+        except re.error, e:
+            raise ValueError(str(e))
+        self.cancelled = False
+        self._found = found
+        self._results = multiprocessing.Queue()
+        self._pool = multiprocessing.Pool(processes or
+                min(len(paths), multiprocessing.cpu_count()) or 1,
+                _start_worker, (self._results,))
+        for path in paths:
+            self._pool.apply_async(_grep_worker, (path, pattern, re.I))
+        self._pool.close()
+        thread = threading.Thread(target=self._wait,
+                                  args=(len(paths), finished))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _wait(self, files, finished):
+        """Pass on the batches of groups until all the files are done."""
+        while files and not self.cancelled:
+            try:
+                path, groups, done = self._results.get(timeout=0.2)
+            except Queue.Empty:
+                continue
+            if groups and not self.cancelled:
+                self._found(path, groups)
+            if done:
+                files -= 1
+        self._pool.join()
+        finished()
+
+    def cancel(self):
+        """Stop the search; the files not searched yet are left out."""
+        if not self.cancelled:
+            self.cancelled = True
+            self._pool.terminate()
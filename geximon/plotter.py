@@ -1,5 +1,8 @@
 """Plotting of exim stats."""
+import os
 import sys
+import time
+import threading
 try:
         import gtk
 except RuntimeError, e:
@@ -8,9 +11,12 @@ except RuntimeError, e:
                 sys.exit()
 
 import gobject
-import re
 
 from gtkhelpers import Timer
+from history import History
+from tsdb import TimeSeriesStore
+from exim import DEFAULT_PLOT_SERIES, LogClassifier, parse_plot_series
+from exim import read_log_tail
 
 KEEP_HISTORY = 2000
 DELTA = 0.0000001
@@ -18,18 +24,14 @@ DELTA = 0.0000001
 class Plotter(gtk.DrawingArea):
     """A widget that contains multiple color-coded plots."""
 
-    config = [# label,   regexp,               color
-               ('in',    ' <= ',               'yellow'),
-               ('out',   ' => ',               'red'),
-               ('local', ' => .+ R=local',     'blue'),
-               ('smtp',  ' => .+ T=[^ ]*smtp', 'green'),
-               ('queue', None,                 'white'),
-             ]
+    START_X = 18 # room for the scale on the left
+    LABEL_HEIGHT = 20 # room for the labels at the bottom
+    MAX_SCROLL = 16 # redraw everything when more updates were missed
 
     def __init__(self, logwatcher, queue_mgr, prefs):
         gtk.DrawingArea.__init__(self)
 
-        self._logwatcher = logwatcher
+        self._log_reader = logwatcher.reader()
         self._queue_mgr = queue_mgr
 
         self.set_size_request(-1, prefs.plot_area_height)
@@ -45,124 +47,352 @@ class Plotter(gtk.DrawingArea):
                              colormap.alloc_color('#555555'),
                              colormap.alloc_color('#222222')]
 
-        self.plots = []
-        for label, regex, color in self.config:
-            compiled_regex = regex and re.compile(regex) or None
-            mapped_color = colormap.alloc_color(color)
-            history = []
-            self.plots.append((label, compiled_regex, mapped_color, history))
+        self._pixmap = None
+        self._pixmap_size = None
+        self._drawn_state = None
+        self.set_double_buffered(False) # the pixmap is our buffer
+
+        self.store = None
+        self.resolution = prefs.plot_resolution
+        self._bucket = None
+        self.plot_series = self.history_file = None
+        self._setUpSeries(prefs.plot_series, prefs.history_file)
 
         self.connect('expose-event', self._redraw)
         self.timer = Timer(self.interval, self.update)
 
     def _redraw(self, area, event):
-        """Redraw the plots.
+        """Copy the plots to the screen.
         
-        Must not be invoked directly, because double-buffering won't work;
-        queue_redraw() should be used instead.
+        Must not be invoked directly; queue_redraw() should be used instead.
+        The plots are drawn into an offscreen pixmap first (see _render).
         """
-        geometry = self.window.get_geometry()
-        width, height = geometry[2], geometry[3]
         if not self.gc:
             self.gc = self.window.new_gc()
+        self._render()
+        rect = event.area
+        self.window.draw_drawable(self.gc, self._pixmap, rect.x, rect.y,
+                                  rect.x, rect.y, rect.width, rect.height)
+        return True
+
+    def _render(self):
+        """Bring the offscreen pixmap up to date with the plot data.
+
+        Normally the plot area is scrolled by a column per update and only
+        the newest segments are drawn.  Everything is redrawn when the size,
+        the series or a scale have changed, or when many updates were missed.
+        """
+        width, height = self.window.get_size()
+        scales = tuple([self.get_scale(history)
+                        for label, mapped_color, history in self.plots])
+        state = (width, height, scales, id(self.plots))
+        new_ticks = self._ticks - self._drawn_ticks
+        if (state != self._drawn_state or new_ticks > self.MAX_SCROLL
+                or new_ticks >= width - self.START_X):
+            if self._pixmap_size != (width, height):
+                self._pixmap = gtk.gdk.Pixmap(self.window, width, height)
+                self._pixmap_size = (width, height)
+            self._drawAll(width, height, scales)
+        elif new_ticks:
+            self._scroll(width, height, scales, new_ticks)
+        self._drawn_state = state
+        self._drawn_ticks = self._ticks
 
-        # clear drawing area
+    def _drawAll(self, width, height, scales):
+        """Draw everything."""
+        pixmap = self._pixmap
         self.gc.set_foreground(self.background_color)
-        self.window.draw_rectangle(self.gc, True, 0, 0, width, height)
+        pixmap.draw_rectangle(self.gc, True, 0, 0, width, height)
 
-        start_x = 18
+        start_x = self.START_X
         point_count = width - start_x
-        plot_height = height - 20
-        label_offset = start_x + 10
+        plot_height = height - self.LABEL_HEIGHT
         self._draw_guides(width, plot_height, start_x)
-        for label, compiled_regex, mapped_color, history in self.plots:
-            scale = self.get_scale(history)
+        for (label, mapped_color, history), scale in zip(self.plots, scales):
             self.gc.set_foreground(mapped_color)
             if len(history) > 1:
-                # transform data points to screen coordinates
-                points = enumerate(history[-point_count:])
+                # transform the visible data points to screen coordinates
+                points = enumerate(history.window(point_count))
                 coord_list = [(start_x + index, 
                                int(plot_height * (1 - value*scale)))
                                for index, value in points]
-                self.window.draw_lines(self.gc, coord_list)
-            # draw label
-            if label_offset < width:
-                suffix = ": %.1f" % (history and history[-1] or 0)
-                if abs(scale - 0.1) > DELTA:
-                    suffix = (" (%dx)" % (0.1/scale)) + suffix
-                self.pangolayout.set_text(label + suffix)
-                self.window.draw_layout(self.gc, label_offset, plot_height,
-                                                            self.pangolayout)
-                label_offset += len(label + suffix) * 9 # XXX text width
-        return True
+                pixmap.draw_lines(self.gc, coord_list)
+        self._drawLabels(width, height, scales)
+
+    def _scroll(self, width, height, scales, new_ticks):
+        """Add the points of the last `new_ticks` updates to the pixmap.
+
+        Once the plots fill the width, the plot area is shifted to the left
+        to make room for them.
+        """
+        pixmap = self._pixmap
+        start_x = self.START_X
+        point_count = width - start_x
+        plot_height = height - self.LABEL_HEIGHT
+        length = min(self._ticks, KEEP_HISTORY)
+        visible = min(length, point_count)
+        # the history may have been full already before these updates
+        drawn = min(self._ticks - new_ticks, KEEP_HISTORY, point_count)
+        shift = new_ticks - (visible - drawn)
+        if shift:
+            pixmap.draw_drawable(self.gc, pixmap, start_x + shift, 0,
+                                 start_x, 0, point_count - shift,
+                                 plot_height + 1)
+            self._draw_guide_lines(width - shift, width, plot_height)
+        count = min(new_ticks + 1, visible)
+        first_x = start_x + visible - count
+        for (label, mapped_color, history), scale in zip(self.plots, scales):
+            if count < 2:
+                break
+            self.gc.set_foreground(mapped_color)
+            coord_list = [(first_x + index,
+                           int(plot_height * (1 - value*scale)))
+                          for index, value in enumerate(history.window(count))]
+            pixmap.draw_lines(self.gc, coord_list)
+        self._drawLabels(width, height, scales)
+
+    def _drawLabels(self, width, height, scales):
+        """Draw the labels (with the latest values) below the plots."""
+        plot_height = height - self.LABEL_HEIGHT
+        self.gc.set_foreground(self.background_color)
+        self._pixmap.draw_rectangle(self.gc, True, 0, plot_height + 1,
+                                    width, height - plot_height - 1)
+        label_offset = self.START_X + 10
+        for (label, mapped_color, history), scale in zip(self.plots, scales):
+            if label_offset >= width:
+                break
+            suffix = ": %.1f" % history.last()
+            if abs(scale - 0.1) > DELTA:
+                suffix = (" (%dx)" % (0.1/scale)) + suffix
+            self.gc.set_foreground(mapped_color)
+            self.pangolayout.set_text(label + suffix)
+            self._pixmap.draw_layout(self.gc, label_offset, plot_height,
+                                     self.pangolayout)
+            label_offset += len(label + suffix) * 9 # XXX text width
     
     def _draw_guides(self, width, plot_height, start_x):
         """Draw guide lines."""
-        # draw main boundaries
-        self.gc.set_foreground(self.guide_colors[0])
-        self.window.draw_line(self.gc, start_x, 0, width, 0)
-        self.window.draw_line(self.gc,
-                start_x, plot_height, width, plot_height)
+        pixmap = self._pixmap
         # draw numbers
         # XXX hardcoding font sizes
+        self.gc.set_foreground(self.guide_colors[0])
         number_offset = 0
         self.pangolayout.set_text("10")
-        self.window.draw_layout(self.gc, number_offset,
+        pixmap.draw_layout(self.gc, number_offset,
                 -2, self.pangolayout)
         self.pangolayout.set_text("  5")
-        self.window.draw_layout(self.gc, number_offset,
+        pixmap.draw_layout(self.gc, number_offset,
                 plot_height / 2 - 8, self.pangolayout)
         self.pangolayout.set_text("  0")
-        self.window.draw_layout(self.gc, number_offset,
+        pixmap.draw_layout(self.gc, number_offset,
                 plot_height - 16, self.pangolayout)
+        self._draw_guide_lines(start_x, width, plot_height)
+
+    def _draw_guide_lines(self, start_x, end_x, plot_height):
+        """Clear the plot area between two columns and draw guide lines."""
+        pixmap = self._pixmap
+        self.gc.set_foreground(self.background_color)
+        pixmap.draw_rectangle(self.gc, True, start_x, 0,
+                              end_x - start_x, plot_height + 1)
+        # draw main boundaries
+        self.gc.set_foreground(self.guide_colors[0])
+        pixmap.draw_line(self.gc, start_x, 0, end_x, 0)
+        pixmap.draw_line(self.gc, start_x, plot_height, end_x, plot_height)
         # draw a nice line indicating 5
         self.gc.set_foreground(self.guide_colors[1])
-        self.window.draw_line(self.gc,
-                start_x, plot_height / 2, width, plot_height / 2)
+        pixmap.draw_line(self.gc,
+                start_x, plot_height / 2, end_x, plot_height / 2)
         # draw minor lines
         self.gc.set_foreground(self.guide_colors[2])
         for v in [1, 2, 3, 4, 6, 7, 8, 9]:
             y =  int(plot_height * (v / 10.0))
-            self.window.draw_line(self.gc, start_x, y, width, y)
+            pixmap.draw_line(self.gc, start_x, y, end_x, y)
 
-    def get_scale(self, list):
-        """Calculate a scaling value for a list of floats.
+    def get_scale(self, history):
+        """Calculate a scaling value for a History.
 
         Returns a floating point value - a multiplier to normalize the data.
         """
-        if len(list) < 2 or max(list) < 10:
+        largest = history.max()
+        if len(history) < 2 or largest < 10:
             return 0.1
-        largest = max(list)
         scale = 1.0
         while largest*scale > 1:
             scale /= 10
         return scale
 
+    def _setUpSeries(self, spec, history_file):
+        """Set up the plots from a series specification (see prefs).
+
+        The history of the series is kept in `history_file`, if it is set.
+        Returns False if nothing has changed.
+        """
+        if (spec, history_file) == (self.plot_series, self.history_file):
+            return False
+        colormap = self.get_colormap()
+        try:
+            series = parse_plot_series(spec)
+            plots = [(label, colormap.alloc_color(color),
+                      History(KEEP_HISTORY))
+                     for label, condition, color in series]
+        except ValueError, e:
+            print >> sys.stderr, _("Invalid plot series setting:"), e
+            series = parse_plot_series(DEFAULT_PLOT_SERIES)
+            plots = [(label, colormap.alloc_color(color),
+                      History(KEEP_HISTORY))
+                     for label, condition, color in series]
+        self.plot_series = spec
+        self.history_file = history_file
+        self.plots = plots
+        self._is_queue = [condition is None
+                          for label, condition, color in series]
+        self._conditions = [condition for label, condition, color in series]
+        self.classifier = LogClassifier(self._conditions)
+
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        if history_file:
+            try:
+                self.store = TimeSeriesStore(os.path.expanduser(history_file),
+                        ['%s %r' % (label, condition)
+                         for label, condition, color in series])
+            except EnvironmentError, e:
+                print >> sys.stderr, _("Cannot use the plot history file:"), e
+        self._fillHistory()
+        return True
+
+    def _step(self):
+        """Return the number of seconds between points."""
+        if self.resolution and self.store is not None:
+            return self.resolution
+        return max(1, int(round(self.interval / 1000.0)))
+
+    def _fillHistory(self):
+        """Start the plots afresh, with the history from the store."""
+        self._ticks = self._drawn_ticks = 0 # points since the plots started
+        self._drawn_state = None
+        self._bucket = None
+        for index, (label, mapped_color, history) in enumerate(self.plots):
+            self.plots[index] = (label, mapped_color, History(KEEP_HISTORY))
+        if self.store is None:
+            return
+        data = self.store.fetch(self._step(), KEEP_HISTORY)
+        for (label, mapped_color, history), values in zip(self.plots, data):
+            for value in values:
+                history.append(value)
+        self._ticks = len(data[0])
+
     def update(self, *ignored_arguments):
-        """Update plot data."""
-        new_loglines = self._logwatcher.get_for_processing()
-        for label, compiled_regex, mapped_color, history in self.plots:
-            if label == 'queue':
-                norm_count = float(self._queue_mgr.queue_length)
+        """Update plot data.
+
+        With a plot resolution set, a point is added whenever a period of
+        that many seconds is over: the mean of the samples in the store.
+        """
+        now = time.time()
+        counts = self.classifier.count(self._log_reader.read())
+        values = []
+        for index in range(len(self.plots)):
+            if self._is_queue[index]:
+                values.append(float(self._queue_mgr.queue_length))
             else:
-                count = self.count_matches(compiled_regex, new_loglines)
-                norm_count = count * (1000.0 / self.interval) # normalize
-            history.append(norm_count)
-            if len(history) > KEEP_HISTORY:
-                history.pop(0)
+                values.append(counts[index] * (1000.0 / self.interval))
+        if self.store is not None:
+            self.store.add(now, values)
+            if self.resolution:
+                bucket = int(now) / self.resolution
+                previous, self._bucket = self._bucket, bucket
+                if previous is None or bucket == previous:
+                    return
+                data = self.store.fetch(self.resolution, 1,
+                                        end=bucket * self.resolution)
+                values = [series and series[0] or 0.0 for series in data]
+        for (label, mapped_color, history), value in zip(self.plots, values):
+            history.append(value)
+        self._ticks += 1
+        self.queue_draw()
+
+    def backfill(self, path, minutes):
+        """Fill in the plots from the last `minutes` of the log at `path`.
+
+        The log is read in a background thread; the plots are updated when
+        it is done.  The queue length cannot be recovered from the log, so
+        the queue plot stays empty.
+        """
+        until = time.time()
+        # the store works in seconds and takes care of coarser periods
+        use_store = self.store is not None
+        step = use_store and 1 or self._step()
+        thread = threading.Thread(target=self._backfill,
+                args=(path, until - minutes * 60, until, self.plots,
+                      list(self._conditions), use_store, step))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _backfill(self, path, since, until, plots, conditions, use_store,
+                  step):
+        """Count log lines per series and period (in a background thread).
+
+        Everything it depends on is passed in, as the series and settings
+        may change meanwhile.
+        """
+        try:
+            records = read_log_tail(path, since, until)
+        except IOError:
+            return
+        buckets = int(until - since) / step + 1
+        counts = [[0] * buckets for condition in conditions]
+        classifier = LogClassifier(conditions)
+        for record in records:
+            bucket = int(record.timestamp() - since) / step
+            for index in classifier.classify(record):
+                counts[index][bucket] += 1
+        rates = [[count / float(step) for count in series]
+                 for series in counts]
+        gobject.idle_add(self._applyBackfill, since, step, rates, plots,
+                         use_store)
+
+    def _applyBackfill(self, since, step, rates, plots, use_store):
+        if (plots is not self.plots or use_store != (self.store is not None)
+                or not use_store and step != self._step()):
+            return False # the series or settings have changed meanwhile
+        first = 0 # skip the time before the log starts
+        while first < len(rates[0]) and not [1 for series in rates
+                                             if series[first]]:
+            first += 1
+        if self.store is not None:
+            for bucket in range(first, len(rates[0])):
+                self.store.fill(since + bucket * step,
+                                [series[bucket] for series in rates])
+            self._fillHistory()
+        else:
+            for index, (label, mapped_color, history) in enumerate(plots):
+                new_history = History(KEEP_HISTORY)
+                for value in rates[index][first:] + \
+                             history.window(len(history)):
+                    new_history.append(value)
+                plots[index] = (label, mapped_color, new_history)
+            self._ticks = len(plots[0][2])
+            self._drawn_state = None
         self.queue_draw()
+        return False
 
-    def count_matches(self, regex, lines):
-        count = 0
-        for line in lines:
-            if regex.search(line):
-                count += 1
-        return count
+    def cleanup(self):
+        """Write out the plot history."""
+        if self.store is not None:
+            self.store.close()
+            self.store = None
 
     def apply_prefs(self, prefs):
         self.set_size_request(-1, prefs.plot_area_height)
+        refill = (self.interval, self.resolution) != \
+                 (prefs.plotting_interval, prefs.plot_resolution)
         self.interval = prefs.plotting_interval
+        self.resolution = prefs.plot_resolution
         self.timer.update_interval(self.interval)
+        if (not self._setUpSeries(prefs.plot_series, prefs.history_file)
+                and refill):
+            self._fillHistory()
         if prefs.show_plotter != self.visible:
             self.set_visible(prefs.show_plotter)
         self.queue_draw()
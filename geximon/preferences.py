@@ -13,6 +13,8 @@ except RuntimeError, e:
 import gobject
 import ConfigParser
 
+from exim import DEFAULT_PLOT_SERIES
+
 __metaclass__ = type
 
 
@@ -23,19 +25,36 @@ class Preferences:
     show_process_list = False
     show_plotter = True
     show_statusbar = True
+    plot_series = DEFAULT_PLOT_SERIES # this is not accessible in GUI
+    backfill_minutes = 60 # this is not accessible in GUI
 
     log_dir = '/var/log/exim'
     bin_dir = '/usr/sbin'
     exim_binary = 'exim'
     mainlog_name = 'mainlog'
+    spool_dir = '/var/spool/exim'
+    read_spool = False
+    # this is not accessible in GUI; needs read_spool and write access to
+    # the spool and the main log
+    spool_actions = False
     use_sudo = False
     use_ssh = False
+    ssh_multiplex = True
+    action_concurrency = 4 # this is not accessible in GUI
     hostname = ''
+    use_agent = False
+    agent_command = 'geximon-agent'
+    agent_socket = ''
+    history_file = '~/.geximon-history'
+    index_file = '~/.geximon-index'
+    stats_file = '~/.geximon-stats'
 
     log_interval = 200 # this is not accessible in GUI
     queue_interval = 2000
     process_interval = 5000
     plotting_interval = 1000
+    plot_resolution = 0 # seconds per plotted point, 0 for live plots;
+                        # this is not accessible in GUI
 
     remember_sizes = True
     window_width = 600
@@ -56,6 +75,8 @@ class Preferences:
         """Check if using exim4 rather than v3, change paths accordingly."""
         if os.path.exists('/var/log/exim4'):
             self.log_dir = '/var/log/exim4'
+        if os.path.exists('/var/spool/exim4'):
+            self.spool_dir = '/var/spool/exim4'
         if os.path.exists('/usr/sbin/exim4'):
             self.exim_binary = 'exim4'
         if os.path.exists(os.path.join(self.log_dir, 'main.log')):
@@ -90,19 +111,33 @@ class Preferences:
         load_str('display', 'wrap_log')
         self.wrap_log = gtk.WRAP_CHAR
         load_bool('display', 'show_process_list')
+        load_str('display', 'plot_series')
+        load_int('display', 'backfill_minutes')
 
         load_str('paths', 'log_dir')
         load_str('paths', 'bin_dir')
         load_str('paths', 'exim_binary')
         load_str('paths', 'mainlog_name')
+        load_str('paths', 'spool_dir')
+        load_bool('paths', 'read_spool')
+        load_bool('paths', 'spool_actions')
         load_bool('paths', 'use_sudo')
         load_bool('paths', 'use_ssh')
+        load_bool('paths', 'ssh_multiplex')
+        load_int('paths', 'action_concurrency')
         load_str('paths', 'hostname')
+        load_bool('paths', 'use_agent')
+        load_str('paths', 'agent_command')
+        load_str('paths', 'agent_socket')
+        load_str('paths', 'history_file')
+        load_str('paths', 'index_file')
+        load_str('paths', 'stats_file')
 
         load_int('timers', 'log_interval')
         load_int('timers', 'queue_interval')
         load_int('timers', 'process_interval')
         load_int('timers', 'plotting_interval')
+        load_int('timers', 'plot_resolution')
 
         load_bool('dimensions', 'remember_sizes')
         load_int('dimensions', 'window_width')
@@ -124,21 +159,35 @@ class Preferences:
         parser.set('display', 'track_log', self.track_log)
         parser.set('display', 'show_process_list', self.show_process_list)
         parser.set('display', 'wrap_log', self.wrap_log)
+        parser.set('display', 'plot_series', self.plot_series)
+        parser.set('display', 'backfill_minutes', self.backfill_minutes)
 
         parser.add_section('paths')
         parser.set('paths', 'log_dir', self.log_dir)
         parser.set('paths', 'bin_dir', self.bin_dir)
         parser.set('paths', 'exim_binary', self.exim_binary)
         parser.set('paths', 'mainlog_name', self.mainlog_name)
+        parser.set('paths', 'spool_dir', self.spool_dir)
+        parser.set('paths', 'read_spool', self.read_spool)
+        parser.set('paths', 'spool_actions', self.spool_actions)
         parser.set('paths', 'use_sudo', self.use_sudo)
         parser.set('paths', 'use_ssh', self.use_ssh)
+        parser.set('paths', 'ssh_multiplex', self.ssh_multiplex)
+        parser.set('paths', 'action_concurrency', self.action_concurrency)
         parser.set('paths', 'hostname', self.hostname)
+        parser.set('paths', 'use_agent', self.use_agent)
+        parser.set('paths', 'agent_command', self.agent_command)
+        parser.set('paths', 'agent_socket', self.agent_socket)
+        parser.set('paths', 'history_file', self.history_file)
+        parser.set('paths', 'index_file', self.index_file)
+        parser.set('paths', 'stats_file', self.stats_file)
 
         parser.add_section('timers')
         parser.set('timers', 'log_interval', self.log_interval)
         parser.set('timers', 'queue_interval', self.queue_interval)
         parser.set('timers', 'process_interval', self.process_interval)
         parser.set('timers', 'plotting_interval', self.plotting_interval)
+        parser.set('timers', 'plot_resolution', self.plot_resolution)
 
         parser.add_section('dimensions')
         parser.set('dimensions', 'remember_sizes', self.remember_sizes)
@@ -219,6 +268,14 @@ class PreferencesDialog(gtk.Dialog):
                 _("Path to exim _binaries:"), prefs.bin_dir)
         self._exim_binary = packedPathEntry(
                 _("_Name of exim binary:"), prefs.exim_binary)
+        self._spool_dir = packedPathEntry(
+                _("Exim s_pool directory:"), prefs.spool_dir)
+
+        self._read_spool = gtk.CheckButton(
+                _("_Read the queue from the spool directory"))
+        if prefs.read_spool:
+            self._read_spool.set_active(1)
+        paths.pack_start(self._read_spool)
 
         self._use_sudo = gtk.CheckButton(_("Use _sudo"))
         if prefs.use_sudo:
@@ -229,8 +286,24 @@ class PreferencesDialog(gtk.Dialog):
         if prefs.use_ssh:
             self._use_ssh.set_active(1)
         paths.pack_start(self._use_ssh)
-        
-        self._hostname = packedPathEntry(_("Remote Hostname"), prefs.hostname)
+
+        self._ssh_multiplex = gtk.CheckButton(
+                _("Share one ssh _connection per host"))
+        if prefs.ssh_multiplex:
+            self._ssh_multiplex.set_active(1)
+        paths.pack_start(self._ssh_multiplex)
+
+        self._hostname = packedPathEntry(_("Remote Hostnames"), prefs.hostname)
+
+        self._use_agent = gtk.CheckButton(_("Use the geximon _agent"))
+        if prefs.use_agent:
+            self._use_agent.set_active(1)
+        paths.pack_start(self._use_agent)
+
+        self._agent_command = packedPathEntry(
+                _("Remote agent command:"), prefs.agent_command)
+        self._agent_socket = packedPathEntry(
+                _("Local agent socket:"), prefs.agent_socket)
 
     def _setup_timer_settings(self, prefs):
         timers = self.newStyleFrame(_("Update intervals"))
@@ -332,9 +405,15 @@ class PreferencesDialog(gtk.Dialog):
         prefs.exim_binary = self._exim_binary.get_text()
         prefs.use_sudo = self._use_sudo.get_active()
         prefs.use_ssh = self._use_ssh.get_active()
+        prefs.ssh_multiplex = bool(self._ssh_multiplex.get_active())
         prefs.hostname = self._hostname.get_text()
+        prefs.use_agent = bool(self._use_agent.get_active())
+        prefs.agent_command = self._agent_command.get_text()
+        prefs.agent_socket = self._agent_socket.get_text()
         prefs.log_dir = self._log_dir.get_text()
         prefs.mainlog_name = self._mainlog_name.get_text()
+        prefs.spool_dir = self._spool_dir.get_text()
+        prefs.read_spool = bool(self._read_spool.get_active())
 
         prefs.queue_interval = \
                 int(self._queue_interval.get_value() * 1000)
@@ -0,0 +1,485 @@
+"""Direct access to the exim spool directory."""
+
+import os
+import pwd
+import errno
+import fcntl
+import tempfile
+import time
+
+__metaclass__ = type
+
+
+def format_size(size):
+    """Format a message size the way `exim -bp` does.
+
+    >>> format_size(0), format_size(512), format_size(1234)
+    ('', '512', '1.2K')
+    >>> format_size(123456), format_size(2500000), format_size(52428800)
+    ('121K', '2.4M', '50M')
+    """
+    if size <= 0:
+        return ''
+    elif size < 1024:
+        return '%d' % size
+    elif size < 10*1024:
+        return '%.1fK' % (size / 1024.0)
+    elif size < 1024*1024:
+        return '%dK' % ((size + 512) / 1024)
+    elif size < 10*1024*1024:
+        return '%.1fM' % (size / (1024.0 * 1024.0))
+    else:
+        return '%dM' % ((size + 512*1024) / (1024*1024))
+
+
+def format_age(seconds):
+    """Format the time a message has spent in the queue like `exim -bp`.
+
+    >>> format_age(25*60), format_age(5*3600), format_age(4*24*3600)
+    ('25m', '5h', '4d')
+    """
+    minutes = int(seconds) / 60
+    if minutes > 90:
+        hours = (minutes + 30) / 60
+        if hours > 72:
+            return '%dd' % ((hours + 12) / 24)
+        return '%dh' % hours
+    return '%dm' % minutes
+
+
+class SpoolFormatError(ValueError):
+    """A spool header file could not be parsed."""
+
+
+class SpoolEntry:
+    """The envelope of a queued message, as read from its -H file."""
+
+    def __init__(self, id, sender, received, frozen, header_size,
+                 recipients, delivered):
+        self.id = id
+        self.sender = sender
+        self.received = received
+        self.frozen = frozen
+        self.header_size = header_size
+        self.recipients = recipients
+        self.delivered = delivered
+
+
+def parse_header_file(data):
+    """Parse the contents of a spool -H file.
+
+    Returns a SpoolEntry; raises SpoolFormatError if the data is not a
+    complete header file (e.g. exim is in the middle of writing it).
+
+    >>> data = ('1AttSk-0002qB-00-H\\nexim 8 12\\n<joe@example.com>\\n'
+    ...         '1102081456 0\\n-ident exim\\n-frozen 1102081500\\n'
+    ...         'NN ann@example.com\\n2\\nann@example.com\\n'
+    ...         'bob@example.com  0,-1#1\\n\\n'
+    ...         '017  Subject: testing\\n021* Bcc: ann@example.com\\n')
+    >>> e = parse_header_file(data)
+    >>> e.id, e.sender, e.received, e.frozen, e.header_size
+    ('1AttSk-0002qB-00', '<joe@example.com>', 1102081456, True, 17)
+    >>> e.recipients, e.delivered
+    (['ann@example.com', 'bob@example.com'], ['ann@example.com'])
+    """
+    try:
+        line, pos = _readline(data, 0)
+        if not line.endswith('-H'):
+            raise SpoolFormatError("not a spool header file")
+        id = line[:-2]
+        line, pos = _readline(data, pos) # login, uid, gid
+        sender, pos = _readline(data, pos)
+        line, pos = _readline(data, pos)
+        received = int(line.split()[0])
+
+        options, pos = _read_options(data, pos)
+        frozen = False
+        for start, end, option in options:
+            if option.startswith('-frozen'):
+                frozen = True
+
+        # the non-recipients (delivered addresses) are stored as a binary
+        # tree in preorder; "XX" marks an empty tree
+        delivered = []
+        pending = 1
+        while pending:
+            node, pos = _readline(data, pos)
+            if node == 'XX':
+                break
+            pending += (node[0] == 'Y') + (node[1] == 'Y') - 1
+            delivered.append(node[3:])
+
+        line, pos = _readline(data, pos)
+        recipients = []
+        for i in range(int(line)):
+            line, pos = _readline(data, pos)
+            recipients.append(_strip_recipient_data(line))
+        line, pos = _readline(data, pos)
+        if line:
+            raise SpoolFormatError("no header section in %s" % id)
+
+        # headers are stored as "NNNf text" where NNN is the length of the
+        # text and f is a flag; headers flagged with '*' are not transmitted
+        header_size = 0
+        while pos < len(data):
+            digits_end = pos
+            while data[digits_end].isdigit():
+                digits_end += 1
+            length = int(data[pos:digits_end])
+            if data[digits_end] != '*':
+                header_size += length
+            pos = digits_end + 2 + length
+    except (IndexError, ValueError):
+        raise SpoolFormatError("bad spool header file")
+
+    return SpoolEntry(id, sender, received, frozen, header_size,
+                      recipients, delivered)
+
+
+def _read_options(data, pos):
+    """Read the option lines of a header file, starting at `pos`.
+
+    Returns a list of (start, end, option line) and the position after the
+    options.  ACL variables carry a value of the given length that may span
+    several lines; it is part of the option's span, but not of the line.
+    """
+    options = []
+    while data.startswith('-', pos):
+        start = pos
+        option, pos = _readline(data, pos)
+        if option.startswith('-acl'):
+            pos += int(option.split()[-1]) + 1
+        options.append((start, pos, option))
+    return options, pos
+
+
+def _strip_recipient_data(line):
+    """Strip the errors_to/DSN data exim may append to a recipient line.
+
+    >>> _strip_recipient_data('joe@example.com')
+    'joe@example.com'
+    >>> _strip_recipient_data('joe@example.com err@example.com 15,0#1')
+    'joe@example.com'
+    >>> _strip_recipient_data('joe@example.com rfc822;x@y 10,2  0,-1#3')
+    'joe@example.com'
+    """
+    if '#' not in line:
+        return line
+    rest, flags = line.rsplit('#', 1)
+    try:
+        flags = int(flags)
+    except ValueError:
+        return line
+    # the extra fields are stored back to front, each followed by its length
+    for flag in (0x01, 0x02):
+        if not flags & flag:
+            continue
+        rest, numbers = rest.rsplit(' ', 1)
+        length = int(numbers.split(',')[0])
+        rest = rest[:len(rest) - length - 1]
+    return rest
+
+
+def _readline(data, pos):
+    """Return the line starting at `pos` and the position of the next one."""
+    end = data.index('\n', pos)
+    return data[pos:end], end + 1
+
+
+class SpoolReader:
+    """Read the exim queue straight from the spool directory.
+
+    The reader keeps the parsed -H files between calls and only reads files
+    that are new or have changed; directories whose modification time has
+    not changed are not even listed again.
+    """
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.input_dir = os.path.join(spool_dir, 'input')
+        self._dirs = {}     # (directory, kind) -> (mtime, names)
+        self._entries = {}  # path -> (mtime, size, SpoolEntry, data size)
+        self._scanned = 0
+
+    def read(self):
+        """Return a list of (SpoolEntry, message size) for queued messages.
+
+        Raises OSError if the spool directory cannot be read.
+        """
+        now = time.time()
+        paths = []
+        for directory in self._directories():
+            for name in self._listHeaderFiles(directory):
+                paths.append(os.path.join(directory, name))
+        self._scanned = now
+
+        entries = {}
+        result = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # the message has just left the queue
+            cached = self._entries.get(path)
+            if (cached is None or cached[0] != st.st_mtime
+                                or cached[1] != st.st_size):
+                cached = self._readEntry(path, st)
+                if cached is None:
+                    continue
+            entries[path] = cached
+            entry, data_size = cached[2], cached[3]
+            result.append((entry, entry.header_size + data_size))
+        self._entries = entries
+        return result
+
+    def _directories(self):
+        """List the input directory and its split_spool_directory subdirs."""
+        directories = [self.input_dir]
+        for name in self._listDir(self.input_dir, 'subdirs'):
+            directories.append(os.path.join(self.input_dir, name))
+        return directories
+
+    def _listHeaderFiles(self, directory):
+        return self._listDir(directory, 'headers')
+
+    def _listDir(self, directory, kind):
+        """List a directory unless it is known not to have changed.
+
+        A modification time within a second of the last scan is not trusted,
+        as the directory may have been changed again within that second.
+        """
+        mtime = os.stat(directory).st_mtime
+        key = (directory, kind)
+        cached = self._dirs.get(key)
+        if cached is not None and cached[0] == mtime \
+                and mtime < self._scanned - 1:
+            return cached[1]
+        names = os.listdir(directory)
+        if kind == 'subdirs':
+            names = [name for name in names if len(name) == 1 and
+                     os.path.isdir(os.path.join(directory, name))]
+        else:
+            names = [name for name in names if name.endswith('-H')]
+        self._dirs[key] = (mtime, names)
+        return names
+
+    def _readEntry(self, path, st):
+        """Parse a -H file; return a cache record or None."""
+        try:
+            f = open(path)
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            entry = parse_header_file(data)
+            # the data file starts with a line holding the message id
+            data_size = os.stat(path[:-1] + 'D').st_size \
+                        - (len(entry.id) + 3) + 1
+        except (IOError, OSError, SpoolFormatError):
+            return None # being written or removed; try again next time
+        return (st.st_mtime, st.st_size, entry, data_size)
+
+
+# exim locks this many bytes at the start of a -D file while it works on the
+# message (the message id line); older versions lock the whole file, which
+# conflicts with this lock just the same
+SPOOL_DATA_START_OFFSET = 16 + 3
+
+
+class SpoolLockedError(Exception):
+    """Another process (e.g. a delivery) is working on the message."""
+
+
+class SpoolEditor:
+    """Freeze, thaw and remove messages by editing the spool directly.
+
+    This does what `exim -Mf`, `-Mt` and `-Mrm` do without starting exim:
+    the message's -D file is locked the way exim locks it, so messages that
+    are being delivered are left alone, the -H file is rewritten through a
+    temporary file and renamed into place, and the action is noted in the
+    message log and, with the lines exim would write, in the main log at
+    `mainlog_path` (if given and it exists).  The process needs write access
+    to the spool and the main log.
+
+    The action methods take a list of message ids and return the output
+    exim would have given, one line per message.
+    """
+
+    def __init__(self, spool_dir, mainlog_path=None):
+        self.spool_dir = spool_dir
+        self.mainlog_path = mainlog_path
+        self.input_dir = os.path.join(spool_dir, 'input')
+        self.msglog_dir = os.path.join(spool_dir, 'msglog')
+        try:
+            self.user = pwd.getpwuid(os.getuid())[0]
+        except KeyError:
+            self.user = str(os.getuid())
+
+    def freezeMessages(self, ids):
+        return self._forMessages(ids, self._freeze)
+
+    def thawMessages(self, ids):
+        return self._forMessages(ids, self._thaw)
+
+    def removeMessages(self, ids):
+        return self._forMessages(ids, self._remove)
+
+    def _forMessages(self, ids, action):
+        lines = []
+        for id in ids:
+            try:
+                lines.append(action(id))
+            except SpoolLockedError:
+                lines.append("Spool file for %s is locked (another process "
+                             "is handling this message)" % id)
+            except (IOError, OSError), e:
+                lines.append("Spool error for %s: %s"
+                             % (id, e.strerror or e))
+            except SpoolFormatError, e:
+                lines.append("Spool error for %s: %s" % (id, e))
+        return '\n'.join(lines)
+
+    def _subdir(self, id):
+        """Return the subdirectory a message is in ('' if not split)."""
+        if os.path.exists(os.path.join(self.input_dir, id + '-H')):
+            return ''
+        return id[5] # split_spool_directory
+
+    def _lock(self, id, subdir):
+        """Lock the message's -D file like exim; return its descriptor."""
+        fd = os.open(os.path.join(self.input_dir, subdir, id + '-D'),
+                     os.O_RDWR)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB,
+                        SPOOL_DATA_START_OFFSET, 0, 0)
+        except IOError, e:
+            os.close(fd)
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                raise SpoolLockedError(id)
+            raise
+        return fd
+
+    def _editHeader(self, id, edit):
+        """Lock a message and rewrite its -H file with edit(data).
+
+        `edit` returns the new contents, or None to leave the file alone.
+        Returns True if the file was changed.
+        """
+        subdir = self._subdir(id)
+        fd = self._lock(id, subdir)
+        try:
+            path = os.path.join(self.input_dir, subdir, id + '-H')
+            f = open(path)
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            parse_header_file(data) # make sure it is complete
+            data = edit(data)
+            if data is None:
+                return False
+            st = os.stat(path)
+            temp_fd, temp_path = tempfile.mkstemp(prefix='hdr.',
+                    dir=os.path.dirname(path))
+            try:
+                os.write(temp_fd, data)
+                os.fsync(temp_fd)
+                os.fchmod(temp_fd, st.st_mode & 07777)
+                try:
+                    os.fchown(temp_fd, st.st_uid, st.st_gid)
+                except OSError:
+                    pass # not root; the file stays ours
+                os.close(temp_fd)
+                temp_fd = -1
+                os.rename(temp_path, path)
+            except:
+                if temp_fd >= 0:
+                    os.close(temp_fd)
+                os.unlink(temp_path)
+                raise
+            return True
+        finally:
+            os.close(fd)
+
+    def _setOptions(self, data, remove, add):
+        """Return data with the options starting with `remove` replaced by
+        the `add` lines."""
+        line, pos = _readline(data, 0)
+        for i in range(3):
+            line, pos = _readline(data, pos)
+        options, end = _read_options(data, pos)
+        kept = [data[start:stop] for start, stop, option in options
+                if not option.startswith(remove)]
+        added = [option + '\n' for option in add]
+        return data[:pos] + ''.join(kept + added) + data[end:]
+
+    def _freeze(self, id):
+        def freeze(data):
+            if parse_header_file(data).frozen:
+                return None
+            return self._setOptions(data, ('-frozen', '-manual_thaw'),
+                                    ['-frozen %d' % time.time()])
+        if not self._editHeader(id, freeze):
+            return "Message %s is already frozen" % id
+        self._noteInMessageLog(id, "frozen by %s" % self.user)
+        self._noteInMainLog(id, ["frozen by %s" % self.user])
+        return "Message %s is now frozen" % id
+
+    def _thaw(self, id):
+        def thaw(data):
+            if not parse_header_file(data).frozen:
+                return None
+            return self._setOptions(data, ('-frozen', '-manual_thaw'),
+                                    ['-manual_thaw'])
+        if not self._editHeader(id, thaw):
+            return "Message %s is not frozen" % id
+        self._noteInMessageLog(id, "unfrozen by %s" % self.user)
+        self._noteInMainLog(id, ["unfrozen by %s" % self.user])
+        return "Message %s is no longer frozen" % id
+
+    def _remove(self, id):
+        subdir = self._subdir(id)
+        fd = self._lock(id, subdir)
+        try:
+            # the -D file goes last, the lock is on it
+            for path in [os.path.join(self.msglog_dir, subdir, id),
+                         os.path.join(self.input_dir, subdir, id + '-J'),
+                         os.path.join(self.input_dir, subdir, id + '-H'),
+                         os.path.join(self.input_dir, subdir, id + '-D')]:
+                try:
+                    os.unlink(path)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        finally:
+            os.close(fd)
+        self._noteInMainLog(id, ["removed by %s" % self.user, "Completed"])
+        return "Message %s has been removed" % id
+
+    def _noteInMessageLog(self, id, text):
+        path = os.path.join(self.msglog_dir, self._subdir(id), id)
+        try:
+            f = open(path, 'a')
+            try:
+                f.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                     text))
+            finally:
+                f.close()
+        except IOError:
+            pass # the message log is not essential
+
+    def _noteInMainLog(self, id, texts):
+        """Append lines about a message to the main log, like exim."""
+        if not self.mainlog_path:
+            return
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        data = ''.join(['%s %s %s\n' % (now, id, text) for text in texts])
+        try:
+            # exim creates the log; lines are appended in a single write
+            fd = os.open(self.mainlog_path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass # not there, or not writable
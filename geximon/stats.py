@@ -0,0 +1,263 @@
+"""Mail statistics from the exim main logs, like eximstats."""
+
+import os
+import tempfile
+import threading
+import cPickle as pickle
+
+from exim import LogRecord
+from spool import format_size
+from logindex import open_log, identify_logs, strip_address
+from logsearch import log_files
+
+__metaclass__ = type
+
+TOP = 20 # entries to show in each top list
+
+
+def _domain(address):
+    """Return the domain of an address from the log.
+
+    >>> _domain('<Joe@X.org>'), _domain('<>'), _domain('postmaster')
+    ('x.org', '', '')
+    """
+    address = strip_address(address)
+    if '@' not in address:
+        return ''
+    return address[address.rfind('@') + 1:]
+
+
+class LogStats:
+    """Message counts and byte totals aggregated from main log records.
+
+    Arrivals and deliveries are counted in total and by hour, by domain,
+    by remote host and by transport.  Counts from different logs can be
+    merged.
+
+    >>> stats = LogStats()
+    >>> for line in ['2004-12-03 12:00:00 1AttSk-0002qB-00 <= joe@x.org '
+    ...              'H=a [10.0.0.1] P=esmtp S=1000',
+    ...              '2004-12-03 12:00:01 1AttSk-0002qB-00 => ann@y.org '
+    ...              'R=dnslookup T=remote_smtp H=mx.y.org [10.0.0.2]',
+    ...              '2004-12-03 12:00:01 1AttSk-0002qB-00 -> bob@y.org '
+    ...              'R=dnslookup T=remote_smtp H=mx.y.org [10.0.0.2]',
+    ...              '2004-12-03 12:00:02 1AttSk-0002qB-00 Completed',
+    ...              '2004-12-03 12:00:03 1AttSl-0002qC-00 ==',
+    ...              '1AttSk-0002qB-00 => joe@x.org R=r T=remote_smtp']:
+    ...     stats.add(LogRecord(line))
+    >>> stats.received, stats.delivered, stats.delivered_bytes, stats.deferred
+    (1, 2, 2000, 1)
+    >>> stats.hours, stats.transports
+    ({'2004-12-03 12': [1, 2]}, {'remote_smtp': [2, 2000]})
+    >>> stats.sender_domains, stats.recipient_domains['y.org']
+    ({'x.org': [1, 1000]}, [2, 2000])
+    """
+
+    def __init__(self):
+        self.received = self.received_bytes = 0
+        self.delivered = self.delivered_bytes = 0
+        self.deferred = self.failed = 0
+        self.hours = {} # 'YYYY-MM-DD HH' -> [arrivals, deliveries]
+        # these map names to [messages, bytes]
+        self.sender_domains = {}
+        self.recipient_domains = {}
+        self.sending_hosts = {}
+        self.receiving_hosts = {}
+        self.transports = {}
+        self._sizes = {} # id -> size, for messages not completed yet
+
+    def add(self, record):
+        """Count a log record.
+
+        Records without a date (the remains of torn lines) are left out.
+        """
+        if not record.date or not record.time:
+            return
+        flag = record.flag
+        if not flag:
+            if record.id and record.line.endswith(' Completed'):
+                self._sizes.pop(record.id, None)
+            return
+        address = record.address()
+        hour = self.hours.setdefault(record.date + ' ' + record.time[:2],
+                                     [0, 0])
+        if flag == '<=':
+            size = record.size
+            self._sizes[record.id] = size
+            self.received += 1
+            self.received_bytes += size
+            hour[0] += 1
+            _count(self.sender_domains, _domain(address), size)
+            _count(self.sending_hosts, record.host or 'local', size)
+        elif flag in ('=>', '->'):
+            size = self._sizes.get(record.id, 0)
+            self.delivered += 1
+            self.delivered_bytes += size
+            hour[1] += 1
+            _count(self.recipient_domains, _domain(address), size)
+            _count(self.receiving_hosts, record.host or 'local', size)
+            _count(self.transports, record.transport or 'unknown', size)
+        elif flag == '==':
+            self.deferred += 1
+        elif flag == '**':
+            self.failed += 1
+
+    def merge(self, other):
+        """Add the counts of another LogStats to these."""
+        self.received += other.received
+        self.received_bytes += other.received_bytes
+        self.delivered += other.delivered
+        self.delivered_bytes += other.delivered_bytes
+        self.deferred += other.deferred
+        self.failed += other.failed
+        for table in ('hours', 'sender_domains', 'recipient_domains',
+                      'sending_hosts', 'receiving_hosts', 'transports'):
+            mine = getattr(self, table)
+            for key, values in getattr(other, table).iteritems():
+                counts = mine.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    counts[i] += value
+
+    def report(self):
+        """Return the statistics as text, in the spirit of eximstats."""
+        lines = [_("Grand total summary"), '',
+                 _("Received:  %8d messages  %8s") %
+                        (self.received, format_size(self.received_bytes)),
+                 _("Delivered: %8d messages  %8s") %
+                        (self.delivered, format_size(self.delivered_bytes)),
+                 _("Deferred:  %8d") % self.deferred,
+                 _("Failed:    %8d") % self.failed]
+
+        by_hour = [[0, 0] for hour in range(24)]
+        for hour, counts in self.hours.iteritems():
+            for i, count in enumerate(counts):
+                by_hour[int(hour[-2:])][i] += count
+        lines += ['', _("Messages by hour of day (received, delivered)"),
+                  '']
+        for hour, (received, delivered) in enumerate(by_hour):
+            lines.append('%02d-%02d  %8d  %8d'
+                         % (hour, (hour + 1) % 24, received, delivered))
+
+        for title, table in [
+                (_("Top %d sending domains"), self.sender_domains),
+                (_("Top %d local and destination domains"),
+                                            self.recipient_domains),
+                (_("Top %d sending hosts"), self.sending_hosts),
+                (_("Top %d receiving hosts"), self.receiving_hosts),
+                (_("Top %d transports"), self.transports)]:
+            lines += ['', title % TOP, '']
+            rows = [(-messages, -size, name or '<>')
+                    for name, (messages, size) in table.iteritems()]
+            rows.sort()
+            for messages, size, name in rows[:TOP]:
+                lines.append('%8d  %8s  %s'
+                             % (-messages, format_size(-size), name))
+        return '\n'.join(lines)
+
+
+def _count(table, key, size):
+    counts = table.get(key)
+    if counts is None:
+        table[key] = [1, size]
+    else:
+        counts[0] += 1
+        counts[1] += size
+
+
+class StatsStore:
+    """Statistics for every main log file, kept in a file between runs.
+
+    Each log file is read only once: rotated logs are identified by their
+    first line (see logindex.py) and the main log is read on from where the
+    last update left off; a compressed log is finished once and then left
+    alone.  The store is saved with pickle.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self._files = {} # identity -> [offset, finished, LogStats]
+        self._lock = threading.Lock()
+        try:
+            f = open(path, 'rb')
+            try:
+                version, files = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return # start afresh
+        if version == self.VERSION:
+            for identity, (offset, finished, state) in files.iteritems():
+                stats = LogStats()
+                stats.__dict__.update(state)
+                self._files[identity] = [offset, finished, stats]
+
+    def statistics(self, log_dir, mainlog_name, all_logs=True):
+        """Return a LogStats for the main log (and its rotations).
+
+        New data in the logs is read and the store saved first.
+        """
+        self._lock.acquire()
+        try:
+            if all_logs:
+                paths = log_files(log_dir, mainlog_name)
+            else:
+                paths = [os.path.join(log_dir, mainlog_name)]
+            total = LogStats()
+            changed = False
+            for identity, path in identify_logs(paths):
+                try:
+                    changed = self._update(identity, path) or changed
+                except (IOError, OSError):
+                    continue # unreadable, or rotated away meanwhile
+                total.merge(self._files[identity][2])
+            if changed:
+                self._save()
+            return total
+        finally:
+            self._lock.release()
+
+    def _update(self, identity, path):
+        """Read what is new in a log file; return True if there was any."""
+        entry = self._files.get(identity)
+        if entry is None:
+            entry = self._files[identity] = [0, False, LogStats()]
+        elif entry[1] or (not path.endswith('.gz')
+                          and os.stat(path).st_size <= entry[0]):
+            return False
+        offset, finished, stats = entry
+        start = offset
+        f = open_log(path)
+        try:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    break # incomplete; will be read next time
+                offset += len(line)
+                stats.add(LogRecord(line[:-1]))
+        finally:
+            f.close()
+        entry[0] = offset
+        entry[1] = path.endswith('.gz') # compressed logs do not grow
+        return offset != start or entry[1]
+
+    def _save(self):
+        fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path) or '.')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                # plain data, so that the file does not depend on classes
+                files = dict([(identity, (offset, finished, stats.__dict__))
+                              for identity, (offset, finished, stats)
+                              in self._files.iteritems()])
+                pickle.dump((self.VERSION, files), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
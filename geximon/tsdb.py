@@ -0,0 +1,150 @@
+"""A small round-robin time series store for the plot history."""
+
+import os
+import mmap
+import struct
+import time
+
+__metaclass__ = type
+
+MAGIC = 'GXTS'
+VERSION = 1
+HEADER = struct.Struct('<4sII128s1024s')
+
+
+class TimeSeriesStore:
+    """Per-series values at several resolutions in a fixed-size file.
+
+    Every level is a ring of `slots` slots of `resolution` seconds.  A slot
+    holds its start time, the number of samples added to it and the sum of
+    the sampled values of every series, so coarser levels are downsampled
+    automatically as samples come in and a slot's value is the mean of its
+    samples.  The file is memory-mapped; it is recreated if it was written
+    with different series or levels.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> store = TimeSeriesStore(path, ['in', 'out'], ((1, 10), (5, 10)))
+    >>> for t in range(100, 110):
+    ...     store.add(t, [1.0, t - 100])
+    >>> store.fetch(1, 3, end=110)
+    [[1.0, 1.0, 1.0], [7.0, 8.0, 9.0]]
+    >>> store.fetch(5, 2, end=110)
+    [[1.0, 1.0], [2.0, 7.0]]
+    >>> store.fill(105, [0.0, 0.0]), store.fill(111, [5.0, 5.0])
+    (False, True)
+    >>> store.fill(99, [5.0, 5.0]) # its slot holds 109 now
+    False
+    >>> store.close()
+    >>> TimeSeriesStore(path, ['in', 'out'], ((1, 10), (5, 10))).fetch(5, 1,
+    ...                                                           end=110)
+    [[1.0], [7.0]]
+    >>> os.unlink(path)
+    """
+
+    LEVELS = ((1, 3600), (60, 1440), (3600, 24*60)) # (resolution, slots)
+
+    def __init__(self, path, labels, levels=LEVELS):
+        self.labels = list(labels)
+        self.levels = []
+        self._record = struct.Struct('<%dd' % (len(self.labels) + 2))
+        offset = HEADER.size
+        for resolution, slots in levels:
+            self.levels.append((resolution, slots, offset))
+            offset += slots * self._record.size
+        header = HEADER.pack(MAGIC, VERSION, len(self.labels),
+                ','.join(['%dx%d' % level for level in levels]),
+                '\0'.join(self.labels))
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            existing = os.read(fd, HEADER.size)
+            if existing != header or os.fstat(fd).st_size != offset:
+                # new, or written for other series: start afresh
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, offset)
+                os.lseek(fd, 0, 0)
+                os.write(fd, header)
+            self._map = mmap.mmap(fd, offset)
+        finally:
+            os.close(fd)
+
+    def add(self, timestamp, values):
+        """Add a sample of every series taken at `timestamp`."""
+        record = self._record
+        timestamp = int(timestamp)
+        for resolution, slots, offset in self.levels:
+            start = timestamp - timestamp % resolution
+            position = offset + (start / resolution % slots) * record.size
+            data = list(record.unpack_from(self._map, position))
+            if data[0] != start:
+                data = [start, 0] + [0.0] * len(values)
+            data[1] += 1
+            for i, value in enumerate(values):
+                data[i + 2] += value
+            record.pack_into(self._map, position, *data)
+
+    def fill(self, timestamp, values):
+        """Add a sample unless there is data for its slot already.
+
+        Only the finest level is looked at; if its slot holds a later period
+        (the sample is older than the level reaches back), the sample is
+        dropped so that the newer data is kept.  Returns True if the sample
+        was added.
+        """
+        resolution, slots, offset = self.levels[0]
+        timestamp = int(timestamp)
+        start = timestamp - timestamp % resolution
+        data = self._record.unpack_from(self._map,
+                offset + (start / resolution % slots) * self._record.size)
+        if data[0] >= start and data[1]:
+            return False
+        self.add(timestamp, values)
+        return True
+
+    def fetch(self, step, count, end=None):
+        """Return the last `count` values of every series, `step` s apart.
+
+        The values are means over periods of `step` seconds ending at `end`
+        (now by default), oldest first, taken from the coarsest level that
+        is fine enough and covers the whole range (or, failing that, the
+        one with the best coverage).  Leading periods for which there is no
+        data are left out; later ones without data are 0.
+        """
+        if end is None:
+            end = time.time()
+        end = int(end) - int(end) % step
+        begin = end - step * count
+        usable = [level for level in self.levels if level[0] <= step]
+        if not usable:
+            usable = self.levels[:1]
+        covering = [level for level in usable
+                    if level[0] * level[1] >= step * count]
+        resolution, slots, offset = (covering or usable)[-1]
+
+        series = len(self.labels)
+        sums = [[0.0] * count for i in range(series)]
+        samples = [0] * count
+        record = self._record
+        for slot in xrange(slots):
+            data = record.unpack_from(self._map, offset + slot * record.size)
+            start = int(data[0])
+            if not data[1] or not begin <= start < end:
+                continue
+            bucket = (start - begin) / step
+            samples[bucket] += data[1]
+            for i in range(series):
+                sums[i][bucket] += data[i + 2]
+
+        first = 0
+        while first < count and not samples[first]:
+            first += 1
+        return [[samples[j] and sums[i][j] / samples[j] or 0.0
+                 for j in range(first, count)]
+                for i in range(series)]
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.close()
@@ -4,7 +4,8 @@ import sys
 import os
 import datetime
 import signal
-import re   # needed to escape exigrep patterns
+import threading
+import time
 
 try:
         import gtk
@@ -15,7 +16,7 @@ except RuntimeError, e:
 
 import gobject
 
-from exim import ProcessManager, QueueManager
+from exim import ProcessManager, QueueManager, host_list, action_pool
 from gtkhelpers import Timer, WrappedTextView
 from gtkhelpers import PopupWindow, EntryDialog, AlertDialog
 
@@ -33,6 +34,7 @@ class LogWidget(WrappedTextView):
         prefs.subscribe(self.apply_prefs)
 
         self._logwatcher = logwatcher
+        self._log_reader = logwatcher.reader()
 
         self.buffer = self.get_buffer()
         self.buffer.create_tag('monospace', family='Monospace')
@@ -46,41 +48,77 @@ class LogWidget(WrappedTextView):
                 _("geximon started at %s") % datetime.datetime.now(),
                 'monospace', 'info')
 
+        self._watch_fd = None
+        self._watch_source = None
+        self._log_interval = prefs.log_interval
         self.timer = Timer(prefs.log_interval, self.update)
+        self._updateWatch()
+
+    def _updateWatch(self):
+        """Wait for log data on the watcher's descriptor, if it has one.
+
+        The timer is only used when the log watcher has to be polled.
+        """
+        fd = self._logwatcher.fileno()
+        if fd == self._watch_fd:
+            return
+        if self._watch_source is not None:
+            gobject.source_remove(self._watch_source)
+            self._watch_source = None
+        if fd is not None:
+            self._watch_source = gobject.io_add_watch(fd,
+                    gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR
+                    | gobject.IO_NVAL, self._logReady)
+        self._watch_fd = fd
+        self.timer.set_paused(fd is not None)
+
+    def _logReady(self, fd, condition):
+        # let the lines that arrive during the next interval accumulate
+        self._watch_source = None
+        gobject.timeout_add(self._log_interval, self._resumeWatch)
+        self.update()
+        return False
+
+    def _resumeWatch(self):
+        self.update()
+        if self._logwatcher.pending():
+            return True # there is more to read already
+        if self._watch_source is None:
+            self._watch_fd = None # watch it again
+            self._updateWatch()
+        return False
 
     def update(self):
         self._logwatcher.update()
-        unseen = self._logwatcher.get_unseen()
-        # remove the date (like eximon)
-        unseen = \
-            map(lambda s: s[s.find(' ')+1:], unseen)
-
-        # show the new data
-        for line in unseen:
-            # check for time signature
-            if len(line) > 9 and line[2] == ':' and line[5] == ':':
-                self.buffer.insert_with_tags_by_name(
-                        self.buffer.get_end_iter(),
-                        "\n" + line[:9],
-                        'monospace', 'time')
-            else: # no time signature, print everything and continue
-                self.buffer.insert_with_tags_by_name(
-                        self.buffer.get_end_iter(),
-                        "\n" + line,
-                        'monospace')
+        self._updateWatch()
+        unseen = self._log_reader.read()
+        if self._log_reader.dropped:
+            self.buffer.insert_with_tags_by_name(self.buffer.get_end_iter(),
+                    "\n" + _("(%d lines dropped)") % self._log_reader.dropped,
+                    'monospace', 'info')
+
+        # show the new data, without the date (like eximon)
+        end_iter = self.buffer.get_end_iter
+        for record in unseen:
+            line = record.text
+            if not record.time:
+                # no time signature, print everything and continue
+                self.buffer.insert_with_tags_by_name(end_iter(),
+                        "\n" + line, 'monospace')
                 continue
-            # check for message id
-            if len(line) > 25 and line[15] == '-' and line[22] == '-':
-                self.buffer.insert_with_tags_by_name(
-                        self.buffer.get_end_iter(), line[9:25],
-                        'monospace', 'message_id')
-                self.buffer.insert_with_tags_by_name(
-                        self.buffer.get_end_iter(), line[25:],
-                        'monospace', 'info')
-            else: # no message id, print everything and continue
-                self.buffer.insert_with_tags_by_name(
-                        self.buffer.get_end_iter(), line[9:],
-                        'monospace', 'info')
+            # the time goes with the timezone and pid, if they are logged
+            if record.id:
+                id_start = line.find(record.id)
+                id_end = id_start + len(record.id)
+            else:
+                id_start = id_end = len(record.time) + 1
+            self.buffer.insert_with_tags_by_name(end_iter(),
+                    "\n" + line[:id_start], 'monospace', 'time')
+            if record.id:
+                self.buffer.insert_with_tags_by_name(end_iter(),
+                        record.id, 'monospace', 'message_id')
+            self.buffer.insert_with_tags_by_name(end_iter(),
+                    line[id_end:], 'monospace', 'info')
 
         if unseen: # if there was new data
             # discard old data if there's too much of it
@@ -97,6 +135,7 @@ class LogWidget(WrappedTextView):
         self._track_log = prefs.track_log
         self.set_wrap_mode(prefs.wrap_log)
         self.timer.update_interval(prefs.log_interval)
+        self._log_interval = prefs.log_interval
         self._logwatcher.use_sudo = prefs.use_sudo
         self._logwatcher.use_ssh = prefs.use_ssh
         self._logwatcher.hostname = prefs.hostname
@@ -269,10 +308,14 @@ class ProcessContextMenu(gtk.Menu):
 class QueueWidget(gtk.TreeView):
     """A widget that displays the exim message queue."""
 
+    UPDATE_CHUNK = 1000 # rows to modify while holding the GDK lock
+    UPDATE_PAUSE = 0.005 # seconds to release the lock for between chunks
+
     def __init__(self, main_win, logwatcher, queue_mgr, prefs):
         self._main_win = main_win # needed for popups
         self._statusbar = main_win.statusbar
         self._old_queue = {}
+        self._rows = {} # message key -> model iter (ListStore iters persist)
         self.queue_mgr = queue_mgr
         self.queue_mgr.callback = self.do_update
         self.logwatcher = logwatcher
@@ -282,7 +325,11 @@ class QueueWidget(gtk.TreeView):
                                    gobject.TYPE_STRING, # 2 sender
                                    gobject.TYPE_STRING, # 3 size
                                    gobject.TYPE_STRING, # 4 time in queue
-                                   gobject.TYPE_STRING) # 5 recipients
+                                   gobject.TYPE_STRING, # 5 recipients
+                                   gobject.TYPE_INT64,  # 6 size in bytes
+                                   gobject.TYPE_INT,    # 7 minutes in queue
+                                   gobject.TYPE_STRING, # 8 host
+                                   gobject.TYPE_STRING) # 9 message key
 
         # GTK's recent addition, 'fixed_height_mode' would be really useful
         # to speed things up, however, it is not yet supported by pyGTK
@@ -298,6 +345,8 @@ class QueueWidget(gtk.TreeView):
 
         self.total_str = ""
         self.selected_str = ""
+        self.actions_str = ""
+        self._actions = {} # running action -> (messages done, total)
         self.get_selection().connect('changed', self.selectionChanged)
 
         renderer = gtk.CellRendererText()
@@ -307,13 +356,18 @@ class QueueWidget(gtk.TreeView):
                  [(2, _("Sender")), (3, _("Size")), (4, _("Time")),
                   (5, _("Recipients"))]])
 
-        for index, column in enumerate(columns):
+        # the host column is only shown when several hosts are monitored
+        self.host_column = gtk.TreeViewColumn(_("Host"), renderer, text=8)
+        columns.insert(1, self.host_column)
+
+        # size and time are sorted by the hidden numeric columns
+        for column, sort_column in zip(columns, [1, 8, 2, 6, 7, 5]):
             column.set_reorderable(True)
             column.set_resizable(True)
-            column.set_sort_column_id(index + 1) # not very neat, but it works
+            column.set_sort_column_id(sort_column)
             self.append_column(column)
-
-        self._setUpSorting()
+        self.host_column.set_visible(
+                len(host_list(prefs.use_ssh, prefs.hostname)) > 1)
 
         self.get_selection().set_mode(gtk.SELECTION_MULTIPLE)
         self.set_headers_clickable(True)
@@ -326,119 +380,60 @@ class QueueWidget(gtk.TreeView):
         prefs.subscribe(self.apply_prefs)
         self.timer = Timer(prefs.queue_interval, self.update)
 
-    def _setUpSorting(self):
-        """Set up correct sorting by size and time."""
-
-        def sort_func(treemodel, iter1, iter2, data):
-            col_number, coef = data
-            val1 = treemodel.get_value(iter1, col_number)
-            val2 = treemodel.get_value(iter2, col_number)
-
-            def eval_suffix(s, coef):
-                if s is None or len(s) == 0:
-                    return 0
-                suffix = s[-1]
-                if suffix in coef:
-                    return float(s[:-1]) * coef[suffix]
-                else:
-                    return float(s)
-
-            result = cmp(eval_suffix(val1, coef), eval_suffix(val2, coef))
-            return result
-
-        self.model.set_sort_func(3, sort_func,
-                (3, {'K': 1024, 'M': 1048576}))
-        self.model.set_sort_func(4, sort_func,
-                (4, {'m': 1, 'h': 60, 'd': 24*60}))
-
     def update(self):
         """Schedule an immediate update of the queue list."""
         self.queue_mgr.schedule_update()
 
-    def do_update(self, queue):
-        """Update the process list.
+    def do_update(self, delta):
+        """Update the message list with a QueueDelta.
+
+        Only the rows of added, removed and changed messages are touched.
+        The model is modified in chunks of UPDATE_CHUNK rows; the GDK lock
+        is taken once per chunk and released in between, so the main loop
+        gets a chance to handle events during long updates.
 
         Called from a background thread.
         """
-        # XXX this method is too long and needs to be split up
-
-        gtk.gdk.threads_enter()
         if self._initializing:
             # the first update tends to be massive, so it is worth unbinding
             # the model from the view temporarily for performance reasons
+            gtk.gdk.threads_enter()
             self.set_model(None)
             self.model.set_sort_column_id(0, gtk.SORT_ASCENDING)
+            gtk.gdk.threads_leave()
 
-        old_queue = self._old_queue
-
-        # remove messages no longer in the queue from display
-        iter = self.model.get_iter_first()
-        while iter is not None:
-            next = self.model.iter_next(iter)
-            id = self.model.get_value(iter, 1)
-            if id not in queue:
-                self.model.remove(iter)
-            elif queue[id] != old_queue[id]:
-                msg = queue[id]
-                self.model.set(iter,
-                        0, msg.frozen and "#FF0000" or "#000000",
-                        1, msg.id, 2, msg.sender, 3, msg.size,
-                        4, msg.time, 5, " ".join(msg.recipients))
-            iter = next
-        gtk.gdk.threads_leave()
-
-        # it is safe to do this now because the obsolete messages have been
-        # removed and only new ones will be added
-        self._old_queue = queue
-
-        # find all messages which should be added to the model
-        new_rows = []
-        for id in queue:
-            if id not in old_queue:
-                msg = queue[id]
-                row = (msg.frozen and "#FF0000" or "#000000",
-                           msg.id, msg.sender, msg.size, msg.time,
-                           " ".join(msg.recipients))
-                new_rows.append(row)
+        # the context menu looks messages up here
+        self._old_queue = delta.queue
 
         # reflect that the list is being updated in the statusbar;
         # only bother if there are many new messages
-        worth_bothering = len(queue) > 100 and len(new_rows) > 10
+        worth_bothering = len(delta.queue) > 100 and len(delta.added) > 10
         if self._initializing or worth_bothering:
             self.total_str = (_("Updating message list..."))
             gtk.gdk.threads_enter()
             self.updateStatusbar()
             gtk.gdk.threads_leave()
 
-        if self._initializing:
-            # the model is unbound so there is no need to call threads_enter()
-            # and threads_leave() in every iteration; once is enough
-            gtk.gdk.threads_enter()
-            for row in new_rows:
-                self.model.append(row)
-            gtk.gdk.threads_leave()
-        else:
-            # the model is bound, so we need to do things the slow way
+        self._inChunks(delta.removed, self._removeRows)
+        self._inChunks(delta.changed, self._changeRows)
+        if delta.added:
             # temporarily disabling sorting helps quite a bit
-            if worth_bothering:
-                gtk.gdk.threads_enter() # I HATE THESE!
+            if worth_bothering and not self._initializing:
+                gtk.gdk.threads_enter()
                 sort_mode = self.model.get_sort_column_id()
                 self.model.set_sort_column_id(0, gtk.SORT_ASCENDING)
                 gtk.gdk.threads_leave()
-            for row in new_rows:
-                gtk.gdk.threads_enter()
-                self.model.append(row)
-                gtk.gdk.threads_leave()
-            if worth_bothering:
+            self._inChunks(delta.added, self._addRows)
+            if worth_bothering and not self._initializing:
                 gtk.gdk.threads_enter()
                 self.model.set_sort_column_id(*sort_mode)
                 gtk.gdk.threads_leave()
 
         # update the statusbar data
-        msg_word = len(queue) > 1 and _("messages") or _("message")
-        frozen = len(filter(lambda id: queue[id].frozen, queue))
+        queue_length = len(delta.queue)
+        msg_word = queue_length > 1 and _("messages") or _("message")
         self.total_str = (_("%d %s in queue (%d frozen).") %
-                                            (len(queue), msg_word, frozen))
+                                    (queue_length, msg_word, delta.frozen))
 
         gtk.gdk.threads_enter()
         self.updateStatusbar()
@@ -450,6 +445,46 @@ class QueueWidget(gtk.TreeView):
 
         gtk.gdk.threads_leave()
 
+    def _inChunks(self, items, apply):
+        """Call `apply` on consecutive slices of `items`.
+
+        The GDK lock is held during each call and released in between.
+        """
+        for start in xrange(0, len(items), self.UPDATE_CHUNK):
+            if start:
+                time.sleep(self.UPDATE_PAUSE) # let the main loop run
+            gtk.gdk.threads_enter()
+            try:
+                apply(items[start:start + self.UPDATE_CHUNK])
+            finally:
+                gtk.gdk.threads_leave()
+
+    def _removeRows(self, keys):
+        rows = self._rows
+        for key in keys:
+            iter = rows.pop(key, None)
+            if iter is not None:
+                self.model.remove(iter)
+
+    def _changeRows(self, messages):
+        rows = self._rows
+        for msg in messages:
+            self.model.set(rows[msg.key],
+                    0, msg.frozen and "#FF0000" or "#000000",
+                    1, msg.id, 2, msg.sender, 3, msg.size,
+                    4, msg.time, 5, msg.recipient_summary(),
+                    6, msg.size_bytes, 7, msg.age, 8, msg.host)
+
+    def _addRows(self, messages):
+        rows = self._rows
+        append = self.model.append
+        for msg in messages:
+            rows[msg.key] = append((msg.frozen and "#FF0000" or "#000000",
+                                    msg.id, msg.sender, msg.size, msg.time,
+                                    msg.recipient_summary(),
+                                    msg.size_bytes, msg.age,
+                                    msg.host, msg.key))
+
     def click(self, widget, event):
         """Handle a click in the queue widget."""
         if event.type == gtk.gdk.BUTTON_PRESS and event.button == 3:
@@ -465,12 +500,17 @@ class QueueWidget(gtk.TreeView):
         menu.popup(None, None, None, button, gtk.get_current_event_time())
 
     def selectionChanged(self, selection):
-        """Update statusbar on selection change."""
-        messages = [0]
+        """Update statusbar on selection change.
+
+        The headers of the selected messages are fetched in the background,
+        so that they show up at once when asked for.
+        """
+        keys = []
         def callback(model, path, iter):
-            messages[0] += 1
+            keys.append(model[path[0]][9])
         selection.selected_foreach(callback)
-        messages = messages[0]
+        self.queue_mgr.prefetchHeaders(keys)
+        messages = len(keys)
         # this could be done with a single line:
         # messages = selection.count_selected_rows()
         # but I think the current way is more compatible
@@ -486,7 +526,55 @@ class QueueWidget(gtk.TreeView):
         """Update the statusbar."""
         # XXX this gets called from multiple threads, locking would be nice
         self._statusbar.pop(0)
-        self._statusbar.push(0, self.total_str + ' ' + self.selected_str)
+        self._statusbar.push(0, ' '.join([self.total_str, self.selected_str,
+                                          self.actions_str]))
+
+    def runAction(self, callable, args, done, progress=False):
+        """Call callable(*args) in the background, then done(result).
+
+        Actions run on a bounded pool of worker threads (action_pool), so
+        the interface stays responsive while exim is busy; `done` is called
+        from the main loop.  If `callable` raises an exception, the result
+        is (False, error message), like that of a failed QueueManager
+        action.  If `progress` is True, callable is passed a `progress`
+        keyword argument to report the number of messages done.  The
+        running actions and their progress are shown in the statusbar.
+        """
+        action = object()
+        def work():
+            kwargs = {}
+            if progress:
+                kwargs['progress'] = lambda count, total: gobject.idle_add(
+                        self._actionProgress, action, count, total)
+            try:
+                result = callable(*args, **kwargs)
+            except Exception, e:
+                result = (False, str(e))
+            gobject.idle_add(finish, result)
+        def finish(result):
+            del self._actions[action]
+            self._actionProgress(None, 0, 0)
+            done(result)
+            return False
+        self._actions[action] = (0, 0)
+        self._actionProgress(None, 0, 0)
+        action_pool.submit(work)
+
+    def _actionProgress(self, action, count, total):
+        if action in self._actions:
+            self._actions[action] = (count, total)
+        running = len(self._actions)
+        if running:
+            self.actions_str = _("%d action(s) running.") % running
+            total = sum([total for count, total in self._actions.values()])
+            if total:
+                count = sum([count for count, t in self._actions.values()])
+                self.actions_str += ' ' + _("%d of %d messages done.") \
+                                                % (count, total)
+        else:
+            self.actions_str = ""
+        self.updateStatusbar()
+        return False
 
     def cleanup(self):
         """Clean up when the widget is destroyed."""
@@ -497,6 +585,13 @@ class QueueWidget(gtk.TreeView):
         self.queue_mgr.use_sudo = prefs.use_sudo
         self.queue_mgr.use_ssh = prefs.use_ssh
         self.queue_mgr.hostname = prefs.hostname
+        self.queue_mgr.spool_dir = prefs.read_spool and prefs.spool_dir or None
+        self.queue_mgr.setConcurrency(prefs.action_concurrency)
+        self.queue_mgr.spool_actions = prefs.spool_actions
+        self.queue_mgr.mainlog_path = os.path.join(prefs.log_dir,
+                                                   prefs.mainlog_name)
+        self.host_column.set_visible(
+                len(host_list(prefs.use_ssh, prefs.hostname)) > 1)
         self.confirm_actions = prefs.confirm_actions
         self.report_success = prefs.report_success
         self.timer.update_interval(prefs.queue_interval)
@@ -610,10 +705,10 @@ class QueueContextMenu(gtk.Menu):
                  _("Add recipients to "), _("Enter the new recipients:"))
 
     def selectedMessageIds(self, selection):
-        """Return ids of selected messages."""
+        """Return keys of selected messages (see Message.key)."""
         messages = []
         def callback(model, path, iter):
-            messages.append(model[path[0]][1])
+            messages.append(model[path[0]][9])
         selection.selected_foreach(callback)
         return messages
 
@@ -621,7 +716,7 @@ class QueueContextMenu(gtk.Menu):
         """Perform an action on message(s).
 
         Shows the user a dialog requesting to confirm the action. Calls
-        `callable`, shows a dialog with the result.
+        `callable` in the background, shows a dialog with the result.
         `callable` is expected to return a tuple: (action_successful, message).
         `msg_info` is a tuple of two strings describing the action.
         `message_ids` is a list of strings (message ids).
@@ -636,7 +731,12 @@ class QueueContextMenu(gtk.Menu):
             response = dialog.ask()
             if not response:
                 return
-        (success, status_msg) = callable(message_ids)
+        self._queue_widget.runAction(callable, (message_ids,),
+                                     self._actionDone, progress=True)
+
+    def _actionDone(self, result):
+        """Report the result of an action, update the queue."""
+        (success, status_msg) = result
         if status_msg and (not success or self.report_success):
             if success:
                 AlertDialog(self._main_win, _("Action successful."),
@@ -649,13 +749,15 @@ class QueueContextMenu(gtk.Menu):
 
     def _exim_popup(self, menuitem, callable, id, title_prefix):
         """Show a popup window with the string returned by callable."""
-        (success, text) = callable(id)
-        if success:
-            popup = PopupWindow(title_prefix + id, text)
-            popup.show_all()
-        else:
-            AlertDialog(self._main_win, _("An error occured."),
-                    text, error=True).ask()
+        def show(result):
+            (success, text) = result
+            if success:
+                popup = PopupWindow(title_prefix + id, text)
+                popup.show_all()
+            else:
+                AlertDialog(self._main_win, _("An error occured."),
+                        text, error=True).ask()
+        self._queue_widget.runAction(callable, (id,), show)
 
     def _exim_entry(self, menuitem, callable, id, title_prefix, label_text):
         """Show an entry dialog, input data ant pass it to `callable`.
@@ -668,25 +770,29 @@ class QueueContextMenu(gtk.Menu):
                             label_text=label_text)
         input = popup.get_input()
         if input:
-            (success, status_msg) = callable(id, input)
-            if not success:
-                AlertDialog(self._main_win, _("An error occured."),
-                        status_msg, error=True).ask()
-            elif self.report_success:
-                AlertDialog(self._main_win, _("Action successful."),
-                        status_msg).ask()
-            self._queue_widget.update()
+            self._queue_widget.runAction(callable, (id, input),
+                                         self._entryDone)
+
+    def _entryDone(self, result):
+        (success, status_msg) = result
+        if not success:
+            AlertDialog(self._main_win, _("An error occured."),
+                    status_msg, error=True).ask()
+        elif self.report_success:
+            AlertDialog(self._main_win, _("Action successful."),
+                    status_msg).ask()
+        self._queue_widget.update()
 
     def _exigrep(self, menuitem, messages, field):
-        """Run exigrep with data of selected messages.
+        """Show the log entries of messages related to the selected ones.
 
         `messages` is a list of Message objects (not ids).
-        `field` is a string indicating the field to run exigrep on.
+        `field` is a string indicating the field to look for.
         """
         if field == 'id':
             strings = [msg.id for msg in messages]
         elif field == 'sender':
-            strings = [msg.sender for msg in messages]
+            strings = [msg.sender.strip('<>') for msg in messages]
         elif field == 'recipients':
             strings = []
             for msg in messages:
@@ -694,14 +800,29 @@ class QueueContextMenu(gtk.Menu):
         else:
             raise ValueError("Invalid field identifier.")
 
-        pattern = '|'.join([re.escape(s) for s in strings])
-        text = self.logwatcher.runExigrep(pattern, False, True)
-        if text:
-            PopupWindow("Exigrep: " + pattern, text.strip()).show_all()
+        strings = [s for s in strings if s]
+        if not strings:
+            self._exigrepDone(strings, (True, ''))
+            return
+        # the log index may be busy being updated, so search in the
+        # background
+        def search(strings):
+            return True, self.logwatcher.searchMessages(strings)
+        self._queue_widget.runAction(search, (strings,),
+                lambda result: self._exigrepDone(strings, result))
+
+    def _exigrepDone(self, strings, result):
+        (success, text) = result
+        if not success:
+            AlertDialog(self._main_win, _("An error occured."),
+                    text, error=True).ask()
+        elif text:
+            PopupWindow("Exigrep: " + ', '.join(strings),
+                        text.strip()).show_all()
         else:
-            text = _()
-            AlertDialog(self._main_win, "Empty output from exigrep.",
-                  _("exigrep returned no data.")).ask()
+            AlertDialog(self._main_win, _("No log entries found."),
+                  _("No messages matching the selection were found in "
+                    "the logs.")).ask()
 
 
 class ExigrepDialog(EntryDialog):
@@ -727,18 +848,59 @@ class ExigrepDialog(EntryDialog):
 
     def go(self, logwatcher):
         pattern = self.get_input()
-        if pattern:
-            text = logwatcher.runExigrep(pattern,
-                    not self.regexp.get_active(), self.all_logs.get_active())
-            if text:
-                popup = PopupWindow("Exigrep: " + pattern, text.strip())
-                popup.show_all()
-            else:
-                text = _("Empty output from exigrep.")
-                AlertDialog(self._main_win, text,
-                      _("exigrep returned no data. You may want to "
-                        "refine your search terms or try a search on all "
-                        "the log files.")).ask()
+        if not pattern:
+            return
+        literal = not self.regexp.get_active()
+        all_logs = self.all_logs.get_active()
+        popup = PopupWindow(_("Exigrep: %s (searching...)") % pattern, "")
+        try:
+            search = logwatcher.startExigrep(pattern, literal, all_logs,
+                    lambda path, groups: gobject.idle_add(self._found,
+                                                          popup, groups),
+                    lambda: gobject.idle_add(self._finished, popup, pattern))
+        except ValueError, e:
+            popup.destroy()
+            AlertDialog(self._main_win, _("Invalid regular expression."),
+                        str(e), error=True).ask()
+            return
+        if search is None:
+            popup.destroy()
+            self._runExigrep(logwatcher, pattern, literal, all_logs)
+            return
+        popup.search = search
+        popup.found = False
+        popup.connect('destroy', lambda window: search.cancel())
+        popup.show_all()
+
+    def _found(self, popup, groups):
+        """Add the messages found in a log file to the results."""
+        if groups and not popup.search.cancelled:
+            popup.append('\n\n'.join(groups) + '\n\n')
+            popup.found = True
+        return False
+
+    def _finished(self, popup, pattern):
+        if popup.search.cancelled:
+            return False # the window has been closed
+        popup.set_title("Exigrep: " + pattern)
+        if not popup.found:
+            popup.append(_("No matches found. You may want to refine your "
+                           "search terms or try a search on all the log "
+                           "files."))
+        return False
+
+    def _runExigrep(self, logwatcher, pattern, literal, all_logs):
+        """Run exigrep on the (remote) logs, wait for its output."""
+        text = logwatcher.runExigrep(pattern, literal, all_logs)
+        if text:
+            popup = PopupWindow("Exigrep: " + pattern, text.strip())
+            popup.show_all()
+        else:
+            text = _("Empty output from exigrep.")
+            AlertDialog(self._main_win, text,
+                  _("exigrep returned no data. You may want to "
+                    "refine your search terms or try a search on all "
+                    "the log files.")).ask()
 
 
 class EximstatsDialog(EntryDialog):
@@ -748,7 +910,8 @@ class EximstatsDialog(EntryDialog):
     def __init__(self, main_window=None):
         EntryDialog.__init__(self, main_window,
                 title=_("Run eximstats"),
-                label_text=_("Arguments to eximstats:"))
+                label_text=_("Arguments to eximstats (leave empty for "
+                             "built-in statistics):"))
         self._statusbar = main_window.statusbar
         self.all_logs = gtk.CheckButton(_("Scan all logfiles"))
         self.all_logs.set_active(True)
@@ -760,7 +923,30 @@ class EximstatsDialog(EntryDialog):
         args = self.entry.get_text()
         all_logs = self.all_logs.get_active()
         self.destroy()
-        if response == gtk.RESPONSE_OK:
+        if response != gtk.RESPONSE_OK:
+            return
+        if not args.strip() and logwatcher.canCollectStatistics():
+            # statistics are collected in the background, and only new log
+            # entries are read
+            popup = PopupWindow(_("Statistics (collecting...)"), "")
+            popup.show_all()
+            def collect():
+                try:
+                    text = logwatcher.getStatistics(all_logs)
+                    title = _("Statistics")
+                except Exception, e:
+                    text = _("The statistics could not be collected: %s") % e
+                    title = _("Statistics (failed)")
+                gobject.idle_add(self._show, popup, title, text)
+            thread = threading.Thread(target=collect)
+            thread.setDaemon(True)
+            thread.start()
+        else:
             text = logwatcher.runEximstats(args, all_logs)
             popup = PopupWindow("Eximstats", text.strip())
             popup.show_all()
+
+    def _show(self, popup, title, text):
+        popup.set_title(title)
+        popup.append(text)
+        return False
@@ -12,7 +12,7 @@ distutils.core.setup(
         description="exim MTA monitor",
         long_description=long_description,
         url='http://geximon.planetwatson.co.uk/',
-        scripts=['scripts/geximon'],
+        scripts=['scripts/geximon', 'scripts/geximon-agent'],
         data_files=[('share/doc/geximon', ['README', 'doc/geximon.html']),
                     ('share/doc/geximon/docbook', ['doc/geximon-C.xml']),
                     ('share/man/man8', ['doc/geximon.8']),
@@ -3,10 +3,46 @@
 
 import unittest
 import doctest
+import gettext
+import os
+import shutil
+import tempfile
+import time
 
 import sys
 sys.path.insert(0, '..')
 
+gettext.install('geximon')
+
+
+def write_spool_message(spool_dir, id, sender, recipients, delivered=(),
+                        frozen=False, received=None, body='Hello.\n'):
+    """Write a message into a synthetic exim spool directory."""
+    input_dir = os.path.join(spool_dir, 'input')
+    if not os.path.isdir(input_dir):
+        os.makedirs(input_dir)
+    if received is None:
+        received = int(time.time())
+    lines = [id + '-H', 'exim 8 12', '<%s>' % sender, '%d 0' % received,
+             '-ident exim']
+    if frozen:
+        lines.append('-frozen %d' % received)
+    if delivered:
+        lines += ['NN ' + address for address in delivered[:1]]
+    else:
+        lines.append('XX')
+    lines.append(str(len(recipients)))
+    lines += list(recipients)
+    lines.append('')
+    header = 'Subject: test\n'
+    f = open(os.path.join(input_dir, id + '-H'), 'w')
+    f.write('\n'.join(lines) + '\n' + '%03d  %s' % (len(header), header))
+    f.close()
+    f = open(os.path.join(input_dir, id + '-D'), 'w')
+    f.write(id + '-D\n' + body)
+    f.close()
+
+
 class TestWindows(unittest.TestCase):
 
     def test_createGEximonWindow(self):
@@ -24,6 +60,742 @@ class TestWindows(unittest.TestCase):
         w = PopupWindow("title", "text")
 
 
+class TestSpoolReader(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_read(self):
+        from geximon.spool import SpoolReader
+        write_spool_message(self.spool_dir, '1AttSk-0002qB-00', 'joe@x.org',
+                            ['ann@x.org', 'bob@x.org'], ['ann@x.org'],
+                            frozen=True)
+        write_spool_message(self.spool_dir, '1AttSl-0002qC-00', 'ann@x.org',
+                            ['joe@x.org'])
+        entries = SpoolReader(self.spool_dir).read()
+        entries.sort(key=lambda (entry, size): entry.id)
+        self.assertEqual([e.id for e, size in entries],
+                         ['1AttSk-0002qB-00', '1AttSl-0002qC-00'])
+        first, size = entries[0]
+        self.assertEqual(first.sender, '<joe@x.org>')
+        self.assert_(first.frozen)
+        self.assertEqual(first.delivered, ['ann@x.org'])
+        self.assertEqual(size, len('Subject: test\n') + len('Hello.\n') + 1)
+
+    def test_rereadOnlyChanged(self):
+        from geximon.spool import SpoolReader
+        write_spool_message(self.spool_dir, '1AttSk-0002qB-00', 'joe@x.org',
+                            ['ann@x.org'])
+        reader = SpoolReader(self.spool_dir)
+        first = reader.read()[0][0]
+        self.assert_(reader.read()[0][0] is first)
+        os.remove(os.path.join(self.spool_dir, 'input',
+                               '1AttSk-0002qB-00-H'))
+        write_spool_message(self.spool_dir, '1AttSk-0002qB-00', 'joe@x.org',
+                            ['ann@x.org'], frozen=True, received=1)
+        self.assert_(reader.read()[0][0].frozen)
+
+    def test_editor(self):
+        from geximon.spool import SpoolReader, SpoolEditor
+        write_spool_message(self.spool_dir, '1AttSk-0002qB-00', 'joe@x.org',
+                            ['ann@x.org'])
+        write_spool_message(self.spool_dir, '1AttSl-0002qC-00', 'ann@x.org',
+                            ['joe@x.org'], frozen=True)
+        os.mkdir(os.path.join(self.spool_dir, 'msglog'))
+        msglog = os.path.join(self.spool_dir, 'msglog', '1AttSk-0002qB-00')
+        open(msglog, 'w').close()
+        mainlog = os.path.join(self.spool_dir, 'mainlog')
+        open(mainlog, 'w').close()
+        editor = SpoolEditor(self.spool_dir, mainlog)
+        reader = SpoolReader(self.spool_dir)
+        frozen = lambda: dict([(entry.id, entry.frozen)
+                               for entry, size in reader.read()])
+
+        self.assertEqual(editor.freezeMessages(['1AttSk-0002qB-00',
+                                                '1AttSl-0002qC-00']),
+                         'Message 1AttSk-0002qB-00 is now frozen\n'
+                         'Message 1AttSl-0002qC-00 is already frozen')
+        self.assertEqual(frozen(), {'1AttSk-0002qB-00': True,
+                                    '1AttSl-0002qC-00': True})
+        self.assert_('frozen by' in open(msglog).read())
+        self.assertEqual(editor.thawMessages(['1AttSl-0002qC-00']),
+                         'Message 1AttSl-0002qC-00 is no longer frozen')
+        self.assertEqual(frozen(), {'1AttSk-0002qB-00': True,
+                                    '1AttSl-0002qC-00': False})
+        self.assert_('\n-manual_thaw\n' in open(os.path.join(self.spool_dir,
+                'input', '1AttSl-0002qC-00-H')).read())
+
+        # a message being delivered is left alone
+        data_file = os.path.join(self.spool_dir, 'input',
+                                 '1AttSl-0002qC-00-D')
+        import subprocess
+        locker = subprocess.Popen([sys.executable, '-c',
+                'import fcntl, sys; f = open(sys.argv[1], "r+"); '
+                'fcntl.lockf(f, fcntl.LOCK_EX, 19); print 1; '
+                'sys.stdout.flush(); sys.stdin.read()', data_file],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            locker.stdout.readline()
+            self.assert_('is locked' in
+                         editor.removeMessages(['1AttSl-0002qC-00']))
+        finally:
+            locker.stdin.close()
+            locker.wait()
+
+        output = editor.removeMessages(['1AttSk-0002qB-00',
+                                        '1AttSm-0002qD-00'])
+        self.assertEqual(output.splitlines()[0],
+                         'Message 1AttSk-0002qB-00 has been removed')
+        self.assert_(output.splitlines()[1].startswith(
+                         'Spool error for 1AttSm-0002qD-00'))
+        self.failIf(os.path.exists(msglog))
+        self.assertEqual(frozen(), {'1AttSl-0002qC-00': False})
+        # the main log has what exim would have written
+        self.assertEqual([line[20:].split(' by ')[0] for line
+                          in open(mainlog).read().splitlines()],
+                         ['1AttSk-0002qB-00 frozen',
+                          '1AttSl-0002qC-00 unfrozen',
+                          '1AttSk-0002qB-00 removed',
+                          '1AttSk-0002qB-00 Completed'])
+
+    def test_spoolActions(self):
+        from geximon.exim import QueueManager
+        write_spool_message(self.spool_dir, '1AttSk-0002qB-00', 'joe@x.org',
+                            ['ann@x.org'])
+        mgr = QueueManager(None, '', 'exim', False, False, '',
+                           self.spool_dir, spool_actions=True)
+        mgr.stop()
+        mgr.getEximOutput = lambda args, host: self.fail("exim was run")
+        self.assertEqual(mgr.freezeMessages(['1AttSk-0002qB-00']),
+                         (True, '1 message has been frozen.'))
+        self.assertEqual(mgr.removeMessages(['1AttSk-0002qB-00']),
+                         (True, '1 message has been removed.'))
+        self.assertEqual(os.listdir(os.path.join(self.spool_dir, 'input')),
+                         [])
+
+    def test_viewCache(self):
+        from geximon.exim import QueueManager
+        write_spool_message(self.spool_dir, '1AttSk-0002qB-00', 'joe@x.org',
+                            ['ann@x.org'])
+        mgr = QueueManager(lambda delta: None, '', 'exim', False, False, '',
+                           self.spool_dir)
+        mgr.stop()
+        commands = []
+        def run(args, host):
+            commands.append(args)
+            return 'output %d' % len(commands)
+        mgr.getEximOutput = run
+        self.assertEqual(mgr.getMessageHeaders('1AttSk-0002qB-00'),
+                         (True, 'output 1'))
+        self.assertEqual(mgr.getMessageHeaders('1AttSk-0002qB-00'),
+                         (True, 'output 1'))
+        self.assertEqual(mgr.getMessageBody('1AttSk-0002qB-00'),
+                         (True, 'output 2'))
+
+        # exim replaces the -H file when it changes the message
+        path = os.path.join(self.spool_dir, 'input', '1AttSk-0002qB-00-H')
+        shutil.copy(path, path + '.new')
+        os.rename(path + '.new', path)
+        self.assertEqual(mgr.getMessageHeaders('1AttSk-0002qB-00'),
+                         (True, 'output 3'))
+        self.assertEqual(mgr.getMessageBody('1AttSk-0002qB-00'),
+                         (True, 'output 2'))
+
+        mgr.do_update()
+        mgr.prefetchHeaders(['1AttSk-0002qB-00', 'unknown'])
+        for i in range(100):
+            if not mgr._prefetching:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(commands), 3) # the headers are cached
+
+    def test_queueManager(self):
+        from geximon.exim import QueueManager
+        write_spool_message(self.spool_dir, '1AttSk-0002qB-00', 'joe@x.org',
+                            ['ann@x.org', 'bob@x.org'], ['ann@x.org'],
+                            received=time.time() - 3600)
+        queues = []
+        mgr = QueueManager(queues.append, '', 'exim', False, False, '',
+                           self.spool_dir)
+        mgr.do_update()
+        mgr.stop()
+        msg = queues[0].queue['1AttSk-0002qB-00']
+        self.assertEqual((msg.sender, msg.time, msg.frozen),
+                         ('<joe@x.org>', '60m', False))
+        self.assert_('bob@x.org' in msg.recipients)
+        self.failIf('ann@x.org' in msg.recipients)
+
+
+class TestQueueParser(unittest.TestCase):
+
+    def test_oddLines(self):
+        from geximon.exim import parse_queue
+        output = ['exim: permission denied\n', 'sh: exim: not found\n']
+        odd_lines = []
+        self.assertEqual(list(parse_queue(output, odd_lines)), [])
+        self.assertEqual(odd_lines,
+                ['exim: permission denied', 'sh: exim: not found'])
+
+    def test_streaming(self):
+        from geximon.exim import QueueManager
+        deltas = []
+        mgr = QueueManager(deltas.append, '', 'exim', False, False, '')
+        mgr.stop()
+        mgr.STREAM_BATCH = 2
+        lines = []
+        for i in range(7):
+            lines += ['%2dm   300 1AttS%d-0002qC-00 <joe@x.org>\n' % (i, i),
+                      '          ann@x.org\n', '\n']
+        mgr.getEximPipe = lambda args, host=None: FakePipe(lines)
+        mgr.do_update()
+        self.assertEqual([len(d.added) for d in deltas], [2, 2, 3])
+        self.assertEqual(len(deltas[-1].queue), 7)
+        mgr.do_update()
+        self.failIf(deltas[-1])
+
+
+class FakePipe(list):
+
+    def close(self):
+        pass
+
+
+class TestQueueDelta(unittest.TestCase):
+
+    def test_publish(self):
+        from geximon.exim import QueueManager, Message
+        deltas = []
+        mgr = QueueManager(deltas.append, '', 'exim', False, False, '')
+        mgr.stop()
+        a = Message('22h  1.2K 1AttSk-0002qB-00 <> *** frozen ***')
+        b = Message(' 5m   300 1AttSl-0002qC-00 <joe@x.org>')
+        mgr._publish({a.id: a, b.id: b})
+        self.assertEqual(len(deltas[0].added), 2)
+        self.assertEqual(deltas[0].frozen, 1)
+
+        b2 = Message(' 6m   300 1AttSl-0002qC-00 <joe@x.org>')
+        c = Message(' 1m   300 1AttSm-0002qD-00 <ann@x.org>')
+        mgr._publish({b.id: b2, c.id: c})
+        delta = deltas[1]
+        self.assertEqual(delta.added, [c])
+        self.assertEqual(delta.removed, [a.id])
+        self.assertEqual(delta.changed, [b2])
+        self.assertEqual(delta.frozen, 0)
+
+        mgr._publish({b.id: b2, c.id: c})
+        self.failIf(deltas[2])
+
+
+class TestMultiHost(unittest.TestCase):
+
+    def test_merge(self):
+        from geximon.exim import QueueManager
+        deltas = []
+        mgr = QueueManager(deltas.append, '', 'exim', False, True, 'a, b c')
+        mgr.stop()
+        outputs = {
+            'a': ['5m   300 1AttSk-0002qB-00 <joe@x.org>\n', '  ann@x.org\n'],
+            'b': ['5m   300 1AttSk-0002qB-00 <ann@x.org>\n', '  joe@x.org\n'],
+            'c': ['sh: exim: not found\n']}
+        mgr.getEximPipe = lambda args, host: FakePipe(outputs[host])
+        mgr.do_update()
+        queue = deltas[-1].queue
+        self.assertEqual(sorted(queue.keys()),
+                ['1AttSk-0002qB-00@a', '1AttSk-0002qB-00@b', 'error@c'])
+        self.assertEqual(queue['1AttSk-0002qB-00@b'].sender, '<ann@x.org>')
+
+        commands = []
+        def run(args, host):
+            commands.append((host, args))
+            return ''
+        mgr.getEximOutput = run
+        mgr.freezeMessages(['1AttSk-0002qB-00@a', '1AttSl-0002qC-00@b',
+                            '1AttSk-0002qB-00@b'])
+        self.assertEqual(sorted(commands),
+                [('a', ['-Mf', '1AttSk-0002qB-00']),
+                 ('b', ['-Mf', '1AttSl-0002qC-00', '1AttSk-0002qB-00'])])
+
+    def test_chunks(self):
+        from geximon import exim
+        mgr = exim.QueueManager(None, '', 'exim', False, False, '',
+                                concurrency=3)
+        mgr.stop()
+        ids = ['1AttSk-%06d-00' % i for i in range(10000)]
+        commands = []
+        def run(args, host):
+            commands.append(args)
+            return '\n'.join(['Message %s has been removed' % id
+                              for id in args[1:]])
+        mgr.getEximOutput = run
+        reports = []
+        success, text = mgr.removeMessages(ids,
+                lambda count, total: reports.append((count, total)))
+        self.assert_(len(commands) > 1)
+        for args in commands:
+            self.assert_(len(' '.join(args)) < exim.MAX_ID_BYTES + 10)
+        self.assertEqual(sorted(sum([args[1:] for args in commands], [])),
+                         ids)
+        self.assertEqual(reports[-1], (10000, 10000))
+        self.assertEqual(len(reports), len(commands))
+        self.assertEqual(success, True)
+        self.assertEqual(text, '10000 messages have been removed.')
+
+        mgr.getEximOutput = lambda args, host: 'exim: permission denied'
+        success, text = mgr.removeMessages(ids)
+        self.assertEqual(success, False)
+        self.assertEqual(text.splitlines(),
+                         ['exim: permission denied'] * len(commands))
+
+    def test_remoteViewCache(self):
+        from geximon.exim import QueueManager
+        mgr = QueueManager(lambda delta: None, '', 'exim', False, True, 'a')
+        mgr.stop()
+        listing = ['5m   300 1AttSk-0002qB-00 <joe@x.org>\n', '  ann@x.org\n']
+        mgr.getEximPipe = lambda args, host: FakePipe(listing)
+        commands = []
+        def run(args, host):
+            commands.append(args)
+            return 'output %d' % len(commands)
+        mgr.getEximOutput = run
+        mgr.do_update()
+        key = '1AttSk-0002qB-00'
+        self.assertEqual(mgr.getMessageHeaders(key), (True, 'output 1'))
+        self.assertEqual(mgr.getMessageHeaders(key), (True, 'output 1'))
+        # the sender has been changed
+        listing[0] = '5m   300 1AttSk-0002qB-00 <ann@x.org>\n'
+        mgr.do_update()
+        self.assertEqual(mgr.getMessageHeaders(key), (True, 'output 2'))
+
+    def test_processes(self):
+        from geximon import exim
+        results = []
+        mgr = exim.ProcessManager(lambda *args: results.append(args),
+                                  '', False, True, 'a b')
+        mgr.stop()
+        get_output = exim.get_output
+        exim.get_output = lambda bin_dir, filename, args='', use_sudo=False, \
+                use_ssh=False, hostname='': '4321 %s: handling' % hostname
+        try:
+            mgr.do_update()
+        finally:
+            exim.get_output = get_output
+        processes, status = results[-1]
+        self.assertEqual(processes, {4321: 'a: handling'})
+        self.assert_(status.startswith('Host a: 1 exim process.'))
+
+    def test_sshBackoff(self):
+        from geximon.exim import SSHMultiplexer
+        mux = SSHMultiplexer()
+        started = []
+        def start(hostname, path):
+            started.append(hostname)
+            return False
+        mux._startMaster = start
+        self.assertEqual(mux.command('a'), 'ssh a ')
+        self.assertEqual(mux.command('a'), 'ssh a ')
+        self.assertEqual(mux.command('b'), 'ssh b ')
+        self.assertEqual(started, ['a', 'b'])
+        # the next try is due
+        mux._failed['a'] = (0, mux.RETRY)
+        mux.command('a')
+        self.assertEqual(started, ['a', 'b', 'a'])
+        self.assertEqual(mux._failed['a'][1], mux.RETRY * 2)
+        mux.close()
+
+    def test_pool(self):
+        from geximon.exim import WorkerPool
+        pool = WorkerPool(2)
+        self.assertEqual(pool.map(lambda x: x * 2, range(5)), [0, 2, 4, 6, 8])
+        self.assertRaises(ZeroDivisionError, pool.submit(lambda: 1 / 0).wait)
+
+        # lowering the size reduces parallelism
+        import threading
+        lock = threading.Lock()
+        running = [0, 0] # now, at most
+        def job(x):
+            lock.acquire()
+            running[0] += 1
+            running[1] = max(running)
+            lock.release()
+            time.sleep(0.02)
+            lock.acquire()
+            running[0] -= 1
+            lock.release()
+        pool = WorkerPool(8)
+        pool.map(job, range(8))
+        self.assert_(running[1] > 2)
+        pool.size = 2
+        running[1] = 0
+        pool.map(job, range(20))
+        self.assertEqual(running[1], 2)
+
+
+class TestLogFollower(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.log_dir, 'mainlog')
+        self.append(''.join(['line %d\n' % i for i in range(20)]))
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def append(self, data, path=None):
+        f = open(path or self.path, 'a')
+        f.write(data)
+        f.close()
+
+    def check(self, use_inotify):
+        from geximon.logfollow import LogFollower
+        follower = LogFollower(self.path, backlog=2, use_inotify=use_inotify)
+        try:
+            self.assertEqual(follower.read(), 'line 18\nline 19\n')
+            self.assertEqual(follower.read(), '')
+            self.append('new\n')
+            self.assertEqual(follower.read(), 'new\n')
+
+            # rotation: the rest of the old file comes before the new one
+            os.rename(self.path, self.path + '.1')
+            self.append('late\n', self.path + '.1')
+            self.append('rotated\n')
+            self.assertEqual(follower.read(), 'late\nrotated\n')
+
+            open(self.path, 'w').close()
+            self.append('cut\n')
+            self.assertEqual(follower.read(), 'cut\n')
+        finally:
+            follower.close()
+
+    def test_stat(self):
+        self.check(False)
+
+    def test_readTail(self):
+        from geximon import exim
+        start = time.mktime((2004, 12, 3, 12, 0, 0, 0, 0, -1))
+        f = open(self.path, 'w')
+        for minute in range(60):
+            f.write(time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(start + minute * 60)) +
+                    ' 1AttSk-0002qB-00 <= joe@x.org S=%d\n' % minute)
+        f.write('2004-12-03 13:00:00 incomplete')
+        f.close()
+        old_size = exim.READ_SIZE
+        exim.READ_SIZE = 100
+        try:
+            records = exim.read_log_tail(self.path, start + 50 * 60,
+                                         start + 55 * 60)
+        finally:
+            exim.READ_SIZE = old_size
+        self.assertEqual([r.size for r in records], [50, 51, 52, 53, 54])
+
+    def test_readlines(self):
+        from geximon import logfollow
+        follower = logfollow.LogFollower(self.path, backlog=0)
+        try:
+            self.append('complete\npart')
+            self.assertEqual(follower.readlines(), ['complete'])
+            self.append('ial\n')
+            self.assertEqual(follower.readlines(), ['partial'])
+
+            # a large backlog is read in several goes
+            self.append('x' * 99 + '\n' + 'y' * 99 + '\n')
+            old_budget = logfollow.READ_BUDGET
+            logfollow.READ_BUDGET = 150
+            try:
+                self.assertEqual(follower.readlines(), ['x' * 99])
+                self.assert_(follower.pending())
+                self.assertEqual(follower.readlines(), ['y' * 99])
+            finally:
+                logfollow.READ_BUDGET = old_budget
+        finally:
+            follower.close()
+
+    def test_inotify(self):
+        from geximon import logfollow
+        if logfollow._libc is None:
+            return
+        self.check(True)
+
+
+class TestLogIndex(unittest.TestCase):
+
+    lines = [
+        '2004-12-03 12:00:00 1AttSk-0002qB-00 <= joe@x.org H=a [10.0.0.1]',
+        '2004-12-03 12:00:01 1AttSl-0002qC-00 <= <> H=b [10.0.0.2]',
+        '2004-12-03 12:00:02 1AttSk-0002qB-00 => Ann@Y.org R=r T=t',
+        '2004-12-03 12:00:03 1AttSk-0002qB-00 Completed',
+        '2004-12-03 12:00:04 1AttSl-0002qC-00 ** joe@x.org: unrouteable',
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log_dir = os.path.join(self.dir, 'log')
+        os.mkdir(self.log_dir)
+        self.path = os.path.join(self.log_dir, 'mainlog')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, lines, path=None, mode='a'):
+        f = open(path or self.path, mode)
+        f.write(''.join([line + '\n' for line in lines]))
+        f.close()
+
+    def test_tornLine(self):
+        from geximon.logindex import LogIndex
+        index = LogIndex(os.path.join(self.dir, 'index'),
+                         self.log_dir, 'mainlog')
+        self.write(['2004-12-03 12:00:00 1AttSk-0002qB-00 <='] +
+                   self.lines[4:])
+        index.update()
+        self.assertEqual(index.lookup_address('joe@x.org'),
+                         ['1AttSl-0002qC-00'])
+        self.assertEqual(len(index.lookup_id('1AttSk-0002qB-00')), 1)
+        index.close()
+
+    def test_index(self):
+        import gzip
+        from geximon.logindex import LogIndex
+        index = LogIndex(os.path.join(self.dir, 'index'),
+                         self.log_dir, 'mainlog')
+        self.write(self.lines[:2])
+        f = open(self.path, 'a')
+        f.write(self.lines[2][:50]) # a line still being written
+        f.close()
+        index.update()
+        self.assertEqual(index.lookup_id('1AttSk-0002qB-00'),
+                         self.lines[:1])
+        self.assertEqual(index.lookup_address('<JOE@x.org>'),
+                         ['1AttSk-0002qB-00'])
+
+        # complete the partial line, then rotate and compress the log with
+        # a line that has not been indexed yet
+        self.write(self.lines[:3], mode='w')
+        index.update()
+        self.write(self.lines[3:4])
+        f = gzip.open(self.path + '.1.gz', 'wb')
+        f.write(open(self.path).read())
+        f.close()
+        os.unlink(self.path)
+        self.write(self.lines[4:])
+        index.update()
+        self.assertEqual(index.lookup_id('1AttSk-0002qB-00'),
+                         [self.lines[0], self.lines[2], self.lines[3]])
+        self.assertEqual(index.lookup_address('ann@y.org'),
+                         ['1AttSk-0002qB-00'])
+        self.assertEqual(index.lookup_address('joe@x.org'),
+                         ['1AttSk-0002qB-00', '1AttSl-0002qC-00'])
+        self.assertEqual(index.search(['1AttSl-0002qC-00']),
+                         self.lines[1] + '\n' + self.lines[4])
+        index.close()
+
+        # the index persists
+        index = LogIndex(os.path.join(self.dir, 'index'),
+                         self.log_dir, 'mainlog')
+        index.update()
+        self.assertEqual(len(index.search(['ann@y.org']).split('\n')), 3)
+        index.close()
+
+
+class TestLogSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def test_search(self):
+        import gzip
+        import threading
+        from geximon.logsearch import LogSearch, log_files
+        for i in range(4):
+            name = i and 'mainlog.%d.gz' % i or 'mainlog'
+            path = os.path.join(self.log_dir, name)
+            f = i and gzip.open(path, 'wb') or open(path, 'w')
+            f.write('2004-12-0%d 12:00:00 1AttSk-0002q%d-00 <= Joe@x.org\n'
+                    '2004-12-0%d 12:00:01 1AttSk-0002q%d-00 Completed\n'
+                    '2004-12-0%d 12:00:02 other\n'
+                    % ((i + 1, i) * 2 + (i + 1,)))
+            f.close()
+            os.utime(path, (1000 - i, 1000 - i))
+        paths = log_files(self.log_dir, 'mainlog')
+        self.assertEqual([os.path.basename(path) for path in paths],
+                ['mainlog', 'mainlog.1.gz', 'mainlog.2.gz', 'mainlog.3.gz'])
+
+        results = {}
+        done = threading.Event()
+        def found(path, groups):
+            results.setdefault(os.path.basename(path), []).extend(groups)
+        LogSearch(paths, 'joe@', True, found, done.set, processes=2)
+        done.wait(10)
+        self.assert_(done.isSet())
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results['mainlog.2.gz'],
+                ['2004-12-03 12:00:00 1AttSk-0002q2-00 <= Joe@x.org\n'
+                 '2004-12-03 12:00:01 1AttSk-0002q2-00 Completed'])
+
+        self.assertRaises(ValueError, LogSearch, paths, '(', False,
+                          found, done.set)
+
+    def test_batches(self):
+        from geximon.logsearch import grep_file, BATCH
+        path = os.path.join(self.log_dir, 'mainlog')
+        f = open(path, 'w')
+        for i in range(BATCH * 2):
+            f.write('2004-12-03 12:00:00 joe@x.org: rejected %d\n' % i)
+        f.close()
+        sent = []
+        grep_file(path, 'joe', 0, lambda *args: sent.append(args))
+        # the first group is sent at once, then full batches
+        self.assertEqual([(len(groups), done) for p, groups, done in sent],
+                         [(1, False), (BATCH, False), (BATCH - 1, True)])
+
+
+class TestStats(unittest.TestCase):
+
+    arrival = ('2004-12-0%d 1%d:00:00 1AttSk-0002q%d-00 <= joe@x.org '
+               'H=a [10.0.0.1] P=esmtp S=100\n')
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'mainlog')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_store(self):
+        import gzip
+        from geximon.stats import StatsStore
+        f = gzip.open(self.path + '.1.gz', 'wb')
+        f.write(self.arrival % (1, 1, 1))
+        f.close()
+        f = open(self.path, 'w')
+        f.write(self.arrival % (2, 2, 2))
+        f.close()
+        store_path = os.path.join(self.dir, 'stats')
+        stats = StatsStore(store_path).statistics(self.dir, 'mainlog')
+        self.assertEqual((stats.received, stats.received_bytes), (2, 200))
+        stats = StatsStore(store_path).statistics(self.dir, 'mainlog', False)
+        self.assertEqual(stats.received, 1)
+
+        # only the new entries are read
+        f = open(self.path, 'a')
+        f.write(self.arrival % (2, 3, 3))
+        f.close()
+        f = gzip.open(self.path + '.1.gz', 'wb')
+        f.write(self.arrival % (1, 1, 1) + self.arrival % (1, 4, 4))
+        f.close()
+        stats = StatsStore(store_path).statistics(self.dir, 'mainlog')
+        self.assertEqual(stats.received, 3)
+        self.assertEqual(sorted(stats.hours), ['2004-12-01 11',
+                         '2004-12-02 12', '2004-12-02 13'])
+        self.assert_('Received:         3 messages' in stats.report())
+
+    def test_compressing(self):
+        import gzip
+        from geximon.stats import StatsStore
+        # mainlog.1 is being compressed
+        f = open(self.path + '.1', 'w')
+        f.write(self.arrival % (1, 1, 1))
+        f.close()
+        f = gzip.open(self.path + '.1.gz', 'wb')
+        f.write(self.arrival % (1, 1, 1))
+        f.close()
+        stats = StatsStore(os.path.join(self.dir, 'stats')).statistics(
+                self.dir, 'mainlog')
+        self.assertEqual(stats.received, 1)
+
+
+class TestAgent(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_socket(self):
+        import socket
+        import threading
+        from geximon.agent import Agent, AgentConnection
+        spool_dir = os.path.join(self.tmp_dir, 'spool')
+        write_spool_message(spool_dir, '1AttSk-0002qB-00', 'joe@x.org',
+                            ['ann@x.org'])
+        mainlog = os.path.join(self.tmp_dir, 'mainlog')
+        open(mainlog, 'w').close()
+        agent = Agent(self.tmp_dir, 'mainlog', self.tmp_dir, 'exim',
+                      spool_dir, log_interval=20, queue_interval=50)
+        path = os.path.join(self.tmp_dir, 'socket')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        def serve():
+            client, address = server.accept()
+            agent.serve(client.makefile('wb'))
+        thread = threading.Thread(target=serve)
+        thread.setDaemon(True)
+        thread.start()
+
+        conn = AgentConnection(socket_path=path)
+        time.sleep(0.5)
+        f = open(mainlog, 'a')
+        f.write('2004-11-30 12:00:00 1AttSk-0002qB-00 <= joe@x.org\n')
+        f.close()
+        lines = []
+        for i in range(50):
+            time.sleep(0.1)
+            lines += conn.get_log_lines()
+            if lines and conn.get_queue():
+                break
+        conn.close()
+        agent.stop()
+        self.assertEqual(conn.get_queue().keys(), ['1AttSk-0002qB-00'])
+        self.assert_(lines[-1].endswith('<= joe@x.org'))
+
+    def test_closeSession(self):
+        import threading
+        from geximon import agent
+        class Commands:
+            def command(self, hostname):
+                return ''
+        ssh_connections = agent.ssh_connections
+        agent.ssh_connections = Commands()
+        try:
+            conn = agent.AgentConnection('sleep', '5', False, 'host', None)
+        finally:
+            agent.ssh_connections = ssh_connections
+        process = conn._process
+        time.sleep(0.2) # the reader is waiting for the first frame
+        started = time.time()
+        conn.close()
+        for i in range(100):
+            if process.returncode is not None:
+                break
+            time.sleep(0.01)
+        self.assert_(time.time() - started < 2)
+        self.assertNotEqual(process.returncode, None)
+        self.assert_(process.stdout.closed)
+
+    def test_reconnect(self):
+        import threading
+        from geximon.agent import AgentConnection
+        conn = AgentConnection(socket_path=os.path.join(self.tmp_dir, 'none'))
+        self.assert_(conn.check())
+        conn._started -= conn.RESTART_DELAY + 1
+        starts = []
+        conn._start = lambda: starts.append(1)
+        threads = [threading.Thread(target=conn.check) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(starts), 1)
+
+
 class TestPreferences(unittest.TestCase):
 
     def test_createDialog(self):
@@ -36,7 +808,33 @@ if __name__ == '__main__':
     suite = unittest.TestSuite()
 
     from geximon import exim
-    suite.addTest(doctest.DocTestSuite(exim))
+    # doctest clobbers the gettext `_` builtin
+    reinstall_gettext = lambda test: gettext.install('geximon')
+    suite.addTest(doctest.DocTestSuite(exim, tearDown=reinstall_gettext))
+    from geximon import spool
+    suite.addTest(doctest.DocTestSuite(spool, tearDown=reinstall_gettext))
+    from geximon import history
+    suite.addTest(doctest.DocTestSuite(history, tearDown=reinstall_gettext))
+    from geximon import tsdb
+    suite.addTest(doctest.DocTestSuite(tsdb, tearDown=reinstall_gettext))
+    from geximon import logindex
+    suite.addTest(doctest.DocTestSuite(logindex, tearDown=reinstall_gettext))
+    from geximon import logsearch
+    suite.addTest(doctest.DocTestSuite(logsearch, tearDown=reinstall_gettext))
+    from geximon import stats
+    suite.addTest(doctest.DocTestSuite(stats, tearDown=reinstall_gettext))
+    from geximon import cache
+    suite.addTest(doctest.DocTestSuite(cache, tearDown=reinstall_gettext))
+
+    suite.addTest(unittest.makeSuite(TestSpoolReader))
+    suite.addTest(unittest.makeSuite(TestQueueParser))
+    suite.addTest(unittest.makeSuite(TestQueueDelta))
+    suite.addTest(unittest.makeSuite(TestMultiHost))
+    suite.addTest(unittest.makeSuite(TestLogFollower))
+    suite.addTest(unittest.makeSuite(TestLogIndex))
+    suite.addTest(unittest.makeSuite(TestLogSearch))
+    suite.addTest(unittest.makeSuite(TestStats))
+    suite.addTest(unittest.makeSuite(TestAgent))
 
     suite.addTest(unittest.makeSuite(TestWindows))
     suite.addTest(unittest.makeSuite(TestPreferences))